@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# (c) Valik mailto:vasnake@gmail.com
+
+'''
+Benchmark for Seismodensity project density engines
+
+Synthetic 2D survey layouts (no arcpy, no Oracle, no testdata.gdb needed):
+    grid - parallel lines in two directions, regular survey;
+    walk - random walks, irregular old profiles;
+    dense - many small surveys overlapping in few clusters.
+Polygon workloads:
+    tiny - small squares, license block parts;
+    basin - large ellipses, third of extent;
+    many - circles with thousands of noisy vertices;
+    concave - stars.
+Engines:
+    clip - seismoclip, all segments clipped (skipped for layouts above --brute-max segments);
+    index - STR R-tree candidates clipped (seismoindex);
+    pyramid - length pyramid (seismopyramid);
+    service - resident service over local HTTP, store in temp folder (seismoservice);
+    parallel - index candidates clipped by worker processes over store in temp folder (seismoparallel);
+    sqlite - seismodb calls over sqlite3 stand-in (clips all segments, as clip engine).
+For each layout, engine and workload: build time, query latency p50/p95/p99, throughput,
+process peak memory; profiles length of every engine compared with first engine in list
+(area is seismoclip.polygonArea in all engines).
+
+Usage
+    python seismobench.py [--layouts grid,walk,dense] [--segments 1e3,1e4,1e5] [--engines clip,index,pyramid,service]
+        [--polygons 20] [--seed 1] [--tolerance 1e-6] [--json results.json]
+Exit code 1 if engines disagree.
+
+Doctests
+>>> import numpy as np
+>>> rng = np.random.RandomState(1)
+>>> [layoutProfiles(name, 1000, rng).segmentCount() for name in layouts]
+[1000, 1000, 1000]
+>>> polys = workloadPolygons('concave', 3, rng)
+>>> len(polys), min(seismoclip.polygonArea(p) for p in polys) > 0 # clockwise
+(3, True)
+>>> prof = layoutProfiles('grid', 2000, rng)
+>>> res = runBenchmark(prof, {'tiny': polys[:1], 'basin': workloadPolygons('basin', 2, rng)}, ['clip', 'index', 'pyramid'])
+>>> sorted(set(r['engine'] for r in res)), max(r['maxError'] for r in res) < 1e-6
+(['clip', 'index', 'pyramid'], True)
+'''
+
+import os, sys, time
+import json
+import math
+import shutil
+import tempfile
+import threading
+import numpy as np
+
+import seismoclip
+import seismoindex
+import seismopyramid
+import seismometrics
+
+extentSize = 1000000.0 # meters, synthetic survey area is extentSize x extentSize
+layouts = ('grid', 'walk', 'dense')
+workloads = ('tiny', 'basin', 'many', 'concave')
+engines = ('clip', 'index', 'pyramid', 'service', 'sqlite', 'parallel')
+defaultEngines = ('clip', 'index', 'pyramid', 'service')
+benchWkid = 32640 # synthetic profiles SR, service store exported and requests sent in it (no projection)
+bruteMax = 100000 # segments, clip and sqlite engines skipped on larger layouts
+
+
+def linesProfiles(x, y):
+    ''' ProfileSet from (lines, vertices) coords arrays, one part per line
+    '''
+    nlines, nverts = x.shape
+    return seismoclip.ProfileSet(x.ravel(), y.ravel(), np.arange(nlines + 1, dtype=np.int64) * nverts)
+#def linesProfiles(x, y):
+
+
+def gridLayout(nseg, rng, size=extentSize):
+    ''' Parallel lines, half west-east and half south-north, nseg segments total
+    '''
+    perLine = max(1, int(math.sqrt(nseg)))
+    while nseg % perLine:
+        perLine -= 1
+    nlines = nseg // perLine
+    t = np.linspace(0.0, size, perLine + 1)
+    pos = (np.arange(nlines) + rng.uniform(0.1, 0.9, nlines)) * size / nlines
+    jitter = rng.normal(0.0, size * 1e-5, (nlines, perLine + 1))
+    along = np.tile(t, (nlines, 1))
+    across = pos[:, None] + jitter
+    horizontal = (np.arange(nlines) % 2 == 0)[:, None]
+    x = np.where(horizontal, along, across)
+    y = np.where(horizontal, across, along)
+    return linesProfiles(x, y)
+#def gridLayout(nseg, rng, size=extentSize):
+
+
+def walkLayout(nseg, rng, size=extentSize, perWalk=100):
+    ''' Random walks with smoothly turning heading, perWalk segments each
+    '''
+    perWalk = min(perWalk, nseg)
+    nwalks = nseg // perWalk
+    step = size / 2000.0
+    heading = rng.uniform(0, 2 * math.pi, (nwalks, 1)) + np.cumsum(rng.normal(0, 0.1, (nwalks, perWalk)), axis=1)
+    dx = np.hstack([rng.uniform(0, size, (nwalks, 1)), step * np.cos(heading)])
+    dy = np.hstack([rng.uniform(0, size, (nwalks, 1)), step * np.sin(heading)])
+    return linesProfiles(np.cumsum(dx, axis=1), np.cumsum(dy, axis=1))
+#def walkLayout(nseg, rng, size=extentSize, perWalk=100):
+
+
+def denseLayout(nseg, rng, size=extentSize, perLine=10, clusters=5):
+    ''' Small rotated surveys (straight lines of perLine segments) crowded around few cluster centers
+    '''
+    perLine = min(perLine, nseg)
+    nlines = nseg // perLine
+    centers = rng.uniform(0.2 * size, 0.8 * size, (clusters, 2))
+    which = rng.randint(0, clusters, nlines)
+    cx = centers[which, 0] + rng.normal(0, size / 20.0, nlines)
+    cy = centers[which, 1] + rng.normal(0, size / 20.0, nlines)
+    angle = rng.uniform(0, math.pi, nlines)
+    length = rng.uniform(size / 200.0, size / 50.0, nlines)
+    t = np.linspace(-0.5, 0.5, perLine + 1)[None, :] * length[:, None]
+    x = cx[:, None] + t * np.cos(angle)[:, None]
+    y = cy[:, None] + t * np.sin(angle)[:, None]
+    return linesProfiles(x, y)
+#def denseLayout(nseg, rng, size=extentSize, perLine=10, clusters=5):
+
+
+def layoutProfiles(name, nseg, rng, size=extentSize):
+    return {'grid': gridLayout, 'walk': walkLayout, 'dense': denseLayout}[name](int(nseg), rng, size)
+
+
+def clockwiseRing(cx, cy, radius, angles):
+    ''' Closed clockwise ring, radius is number or array (one per angle)
+    '''
+    x = cx + radius * np.cos(-angles)
+    y = cy + radius * np.sin(-angles)
+    ring = np.column_stack([x, y]).tolist()
+    return ring + ring[:1]
+#def clockwiseRing(cx, cy, radius, angles):
+
+
+def workloadPolygons(name, count, rng, size=extentSize):
+    ''' List of polygons (list of rings), clockwise, inside extent
+    '''
+    polys = []
+    for i in range(count):
+        cx, cy = rng.uniform(0.1 * size, 0.9 * size, 2)
+        if name == 'tiny':
+            angles = np.linspace(0, 2 * math.pi, 4, endpoint=False) + math.pi / 4
+            polys.append([clockwiseRing(cx, cy, size / 1000.0, angles)])
+        elif name == 'basin':
+            angles = np.linspace(0, 2 * math.pi, 64, endpoint=False)
+            ring = np.array(clockwiseRing(0, 0, 1.0, angles))
+            rx, ry = rng.uniform(size / 8.0, size / 5.0, 2)
+            polys.append([np.column_stack([0.5 * size + ring[:, 0] * rx, 0.5 * size + ring[:, 1] * ry]).tolist()])
+        elif name == 'many':
+            angles = np.linspace(0, 2 * math.pi, 5000, endpoint=False)
+            radius = size / 20.0 * (1 + rng.uniform(-0.05, 0.05, len(angles)))
+            polys.append([clockwiseRing(cx, cy, radius, angles)])
+        elif name == 'concave':
+            angles = np.linspace(0, 2 * math.pi, 24, endpoint=False)
+            radius = np.where(np.arange(24) % 2 == 0, size / 20.0, size / 50.0)
+            polys.append([clockwiseRing(cx, cy, radius, angles)])
+        else:
+            raise NameError("Unknown workload '%s'" % name)
+    return polys
+#def workloadPolygons(name, count, rng, size=extentSize):
+
+
+def peakMemoryMB():
+    ''' Process peak resident memory, MB; None if not available (Windows)
+    '''
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / 1048576.0 # bytes
+    return peak / 1024.0 # kilobytes
+#def peakMemoryMB():
+
+
+class Engine(object):
+    ''' Density engine under test: build() once per layout, length(rings) per polygon, meters
+    '''
+
+    def __init__(self, name, profiles):
+        self.name = name
+        self.profiles = profiles
+        self.tmpDir = None
+
+    def build(self):
+        pr = self.profiles
+        if self.name == 'index':
+            self.index = seismoindex.segmentsTree(pr)
+        elif self.name == 'pyramid':
+            self.pyramid = seismopyramid.LengthPyramid()
+            self.pyramid.build(pr)
+        elif self.name == 'service':
+            import seismostore, seismoservice
+            self.tmpDir = tempfile.mkdtemp()
+            storeDir = os.path.join(self.tmpDir, 'bench' + seismostore.storeDirExt)
+            seismostore.exportStore(storeDir, pr, wkid=benchWkid, stamp='bench')
+            service = seismoservice.DensityService(storeDir, os.path.join(self.tmpDir, 'bench.rtree.npz'),
+                os.path.join(self.tmpDir, 'bench.pyramid.npz'))
+            service.cache.maxItems = 0 # measure engine, not cache
+            self.server = seismoservice.DensityServer(('127.0.0.1', 0), service)
+            thread = threading.Thread(target=self.server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            self.url = 'http://127.0.0.1:%s' % self.server.server_address[1]
+        elif self.name == 'sqlite':
+            import seismodb
+            self.pool = seismodb.standInPool(pr)
+        elif self.name == 'parallel':
+            import seismostore, seismoparallel
+            self.tmpDir = tempfile.mkdtemp()
+            storeDir = os.path.join(self.tmpDir, 'bench' + seismostore.storeDirExt)
+            seismostore.exportStore(storeDir, pr, stamp='bench')
+            self.index = seismoindex.segmentsTree(pr)
+            self.clipPool = seismoparallel.ClipPool(storeDir)
+        else:
+            pr.segments()
+
+    def length(self, rings):
+        if self.name == 'index':
+            return seismoclip.clippedLength(self.profiles, rings, self.index.query(seismoclip.ringsExtent(rings)))
+        if self.name == 'pyramid':
+            return self.pyramid.query(self.profiles, rings)
+        if self.name == 'service':
+            import seismoservice
+            return seismoservice.requestDensity(rings, benchWkid, self.url)[1] * 1000.0
+        if self.name == 'sqlite':
+            import seismodb
+            return seismodb.calcDensity(self.pool, rings, 0, seismodb.standInFuncName)[1] * 1000.0
+        if self.name == 'parallel':
+            return self.clipPool.clippedLength(rings, self.index.query(seismoclip.ringsExtent(rings)))
+        return seismoclip.clippedLength(self.profiles, rings)
+
+    def close(self):
+        if self.name == 'service':
+            self.server.shutdown()
+            self.server.server_close()
+            self.server.service.close()
+        if self.name == 'parallel':
+            self.clipPool.close()
+        if self.tmpDir:
+            shutil.rmtree(self.tmpDir, True)
+#class Engine(object):
+
+
+def runBenchmark(profiles, polygons, engineNames, tolerance=1e-6, log=None):
+    ''' Time engines on one profiles layout.
+    polygons: workload name => list of polygons.
+    Return list of dicts, one per (engine, workload); maxError is max relative length difference
+    with first engine, in sqlite engine lengths are rounded to meters by stand-in answer format.
+    '''
+    res = []
+    reference = {} # (workload, polygon number) => length
+    for name in engineNames:
+        engine = Engine(name, profiles)
+        start = seismometrics.clock()
+        engine.build()
+        buildTime = seismometrics.clock() - start
+        try:
+            for wname in sorted(polygons):
+                latencies, maxError = [], 0.0
+                for num, rings in enumerate(polygons[wname]):
+                    start = seismometrics.clock()
+                    length = engine.length(rings)
+                    latencies.append(seismometrics.clock() - start)
+                    ref = reference.setdefault((wname, num), length)
+                    tol = tolerance
+                    if name == 'sqlite':
+                        tol = max(tolerance, 1.0 / max(ref, 1.0))
+                    err = abs(length - ref) / max(abs(ref), 1.0)
+                    if err > tol and log:
+                        log.write("mismatch: engine '%s', workload '%s', polygon %s: %r vs %r\n" % (
+                            name, wname, num, length, ref))
+                    maxError = max(maxError, err > tol and err or 0.0)
+                total = math.fsum(latencies)
+                p50, p95, p99 = seismometrics.percentiles(latencies, (50, 95, 99))
+                res.append({'engine': name, 'workload': wname, 'polygons': len(latencies),
+                    'segments': profiles.segmentCount(), 'build': buildTime,
+                    'p50': p50, 'p95': p95, 'p99': p99,
+                    'qps': total > 0 and len(latencies) / total or 0.0,
+                    'peakMB': peakMemoryMB(), 'maxError': maxError})
+        finally:
+            engine.close()
+    return res
+#def runBenchmark(profiles, polygons, engineNames, tolerance=1e-6, log=None):
+
+
+def formatRow(rec):
+    peak = rec['peakMB'] is not None and '%8.1f' % rec['peakMB'] or '%8s' % '-'
+    return '%-6s %10s %-8s %-8s %5s %9.3f %9.3f %9.3f %9.3f %9.1f %s %9.2g\n' % (
+        rec.get('layout', ''), rec['segments'], rec['engine'], rec['workload'], rec['polygons'], rec['build'],
+        rec['p50'] * 1000, rec['p95'] * 1000, rec['p99'] * 1000, rec['qps'], peak, rec['maxError'])
+#def formatRow(rec):
+
+
+def main():
+    import optparse
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--layouts', default=','.join(layouts))
+    parser.add_option('--segments', default='1e3,1e4,1e5', help='comma separated segments counts, up to 1e7')
+    parser.add_option('--engines', default=','.join(defaultEngines), help='from %s' % ','.join(engines))
+    parser.add_option('--workloads', default=','.join(workloads))
+    parser.add_option('--polygons', type='int', default=20, help='polygons per workload')
+    parser.add_option('--seed', type='int', default=1)
+    parser.add_option('--tolerance', type='float', default=1e-6, help='max relative length difference')
+    parser.add_option('--brute-max', type='int', default=bruteMax, dest='bruteMax')
+    parser.add_option('--json', default='', help='write results list into file')
+    opts, args = parser.parse_args()
+
+    rng = np.random.RandomState(opts.seed)
+    results = []
+    sys.stdout.write('%-6s %10s %-8s %-8s %5s %9s %9s %9s %9s %9s %8s %9s\n' % ('layout', 'segments',
+        'engine', 'workload', 'polys', 'build s', 'p50 ms', 'p95 ms', 'p99 ms', 'q/s', 'peak MB', 'maxErr'))
+    for layout in opts.layouts.split(','):
+        for nseg in [int(float(x)) for x in opts.segments.split(',')]:
+            profiles = layoutProfiles(layout, nseg, rng)
+            polygons = dict((w, workloadPolygons(w, opts.polygons, rng)) for w in opts.workloads.split(','))
+            names = [e for e in opts.engines.split(',')
+                if e not in ('clip', 'sqlite') or profiles.segmentCount() <= opts.bruteMax]
+            for rec in runBenchmark(profiles, polygons, names, opts.tolerance, sys.stderr):
+                rec['layout'] = layout
+                results.append(rec)
+                sys.stdout.write(formatRow(rec))
+                sys.stdout.flush()
+
+    if opts.json:
+        fh = open(opts.json, 'w')
+        try:
+            json.dump(results, fh, indent=1, sort_keys=True)
+        finally:
+            fh.close()
+    bad = [r for r in results if r['maxError'] > 0]
+    if bad:
+        sys.stdout.write('agreement: FAILED, %s engine/workload pairs differ more than %s\n' % (len(bad), opts.tolerance))
+        return 1
+    sys.stdout.write('agreement: OK, tolerance %s\n' % opts.tolerance)
+    return 0
+#def main():
+
+
+if __name__ == "__main__":
+    if '--test' in sys.argv:
+        import doctest
+        doctest.testmod(verbose=True)
+    else:
+        sys.exit(main())
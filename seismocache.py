@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# (c) Valik mailto:vasnake@gmail.com
+
+'''
+Density results cache for Seismodensity project
+
+Same license block reopened from a bookmark gives the same polygon again and again;
+cache keeps (density, length, area) for it, so clip (or Oracle calc_seismodensity call) is skipped.
+
+Key
+    canonical hash of input geometry, taken after projection to working SR:
+    coords rounded to keyPrecision, closing vertex and repeated vertices dropped,
+    every ring turned clockwise and started from its lowest vertex, rings sorted.
+    So same polygon drawn from other vertex or in other direction gives the same key.
+Eviction
+    LRU, bounded by maxItems.
+Invalidation
+    cache keeps data stamp of profiles FeatureClass (seismoclip.dataStamp) or table;
+    other stamp drops all cached results.
+Persistence
+    optional, pickle file; save() merges entries other processes saved there and writes
+    unique temp file, then renames it (see save for what is not guaranteed).
+
+Doctests
+>>> ring = [[0, 0], [0, 10], [10, 10], [10, 0], [0, 0]]
+>>> polygonKey([ring], 3857) == polygonKey([[[10, 10], [10, 0], [0, 0], [0, 10]]], 3857)
+True
+>>> polygonKey([ring], 3857) == polygonKey([ring[::-1]], 3857)
+True
+>>> cache = ResultCache(maxItems=2, stamp='v1')
+>>> cache.put('a', (1, 2, 3)); cache.put('b', (4, 5, 6)); cache.get('a')
+(1, 2, 3)
+>>> cache.put('c', (7, 8, 9)); cache.get('b') is None
+True
+>>> cache.checkStamp('v2'); cache.get('a') is None
+True
+>>> import tempfile, shutil
+>>> tmp = tempfile.mkdtemp(); fileName = os.path.join(tmp, 'c.pkl')
+>>> one, two = ResultCache(stamp='v1', fileName=fileName), ResultCache(stamp='v1', fileName=fileName)
+>>> one.put('a', 1); one.save(); two.put('b', 2); two.save() # other process entry kept
+>>> sorted(ResultCache(stamp='v1', fileName=fileName)._items.items()), os.listdir(tmp)
+([('a', 1), ('b', 2)], ['c.pkl'])
+>>> shutil.rmtree(tmp)
+'''
+
+import os
+import hashlib
+import tempfile
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    from collections import OrderedDict
+except ImportError:
+    OrderedDict = None # python 2.6
+
+keyPrecision = 3 # decimal digits, millimeters in metric SR
+maxItems = 1000
+
+
+def normalizeRing(ring, precision=keyPrecision):
+    ''' Ring as tuple of rounded (x, y): no closing and repeated vertices,
+    clockwise, starts from lowest (min y, then min x) vertex.
+    '''
+    pts = []
+    for pnt in ring:
+        p = (round(float(pnt[0]), precision), round(float(pnt[1]), precision))
+        if not pts or pts[-1] != p:
+            pts.append(p)
+    while len(pts) > 1 and pts[0] == pts[-1]:
+        pts.pop()
+    if len(pts) < 3:
+        return tuple(pts)
+    area2 = 0.0
+    for i in range(len(pts)):
+        x0, y0 = pts[i - 1]
+        x1, y1 = pts[i]
+        area2 += x0 * y1 - x1 * y0
+    if area2 > 0: # counterclockwise
+        pts.reverse()
+    start = min(range(len(pts)), key=lambda i: (pts[i][1], pts[i][0]))
+    return tuple(pts[start:] + pts[:start])
+#def normalizeRing(ring, precision=keyPrecision):
+
+
+def polygonKey(rings, wkid, precision=keyPrecision):
+    ''' Cache key: sha1 hex of normalized rings and SR WKID
+    '''
+    norm = sorted(normalizeRing(r, precision) for r in rings)
+    return hashlib.sha1(repr((int(wkid or 0), norm)).encode('utf-8')).hexdigest()
+#def polygonKey(rings, wkid, precision=keyPrecision):
+
+
+class ResultCache(object):
+    ''' LRU cache key => result with data stamp invalidation and optional pickle file
+    '''
+
+    def __init__(self, maxItems=maxItems, stamp='', fileName=''):
+        self.maxItems = maxItems
+        self.stamp = stamp
+        self.fileName = fileName
+        self.hits = self.misses = 0
+        self._items = self._newItems()
+        if fileName and os.path.exists(fileName):
+            self.load()
+
+    def _newItems(self):
+        if OrderedDict is None:
+            return {}
+        return OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def checkStamp(self, stamp):
+        ''' Drop all results if data changed
+        '''
+        if stamp != self.stamp:
+            self._items = self._newItems()
+            self.stamp = stamp
+
+    def get(self, key):
+        ''' Result or None; hit moves key to the end of LRU order
+        '''
+        res = self._items.pop(key, None)
+        if res is None:
+            self.misses += 1
+            return None
+        self._items[key] = res
+        self.hits += 1
+        return res
+
+    def put(self, key, result):
+        self._items.pop(key, None)
+        self._items[key] = result
+        self._trim()
+
+    def _trim(self):
+        while len(self._items) > self.maxItems:
+            if OrderedDict is None: # no order, drop any
+                self._items.popitem()
+            else:
+                self._items.popitem(last=False)
+
+    def _readFile(self, fileName):
+        fh = open(fileName, 'rb')
+        try:
+            return pickle.load(fh)
+        finally:
+            fh.close()
+
+    def save(self, fileName=''):
+        ''' Write cache into pickle file.
+        File entries saved by other processes (same stamp) merged first, as least recently used,
+        so one process doesn't drop others results; pickle written into unique temp file
+        in the same folder (tempfile.mkstemp) and renamed, readers never see half written file.
+        Not guaranteed: entries other process saved between our read and rename are lost (no lock, it's a cache);
+        on Windows rename can't replace file, it is removed first and reader may find no file (empty cache)
+        for a moment, and concurrent rename may fail (error raised, saveCache logs it).
+        '''
+        fileName = fileName or self.fileName
+        if os.path.exists(fileName):
+            try:
+                stamp, items = self._readFile(fileName)
+            except Exception:
+                stamp, items = None, [] # broken or being replaced, overwritten
+            if stamp == self.stamp:
+                merged = self._newItems()
+                for key, res in items:
+                    if key not in self._items:
+                        merged[key] = res
+                for key, res in self._items.items():
+                    merged[key] = res
+                self._items = merged
+                self._trim()
+        fd, tmpName = tempfile.mkstemp('.tmp', os.path.basename(fileName) + '.', os.path.dirname(fileName) or '.')
+        try:
+            fh = os.fdopen(fd, 'wb')
+            try:
+                pickle.dump((self.stamp, list(self._items.items())), fh, 2)
+            finally:
+                fh.close()
+            os.chmod(tmpName, 0644) # mkstemp file is private, cache is read by other accounts too
+            if os.path.exists(fileName):
+                os.remove(fileName)
+            os.rename(tmpName, fileName)
+        except Exception:
+            if os.path.exists(tmpName):
+                os.remove(tmpName)
+            raise
+
+    def load(self, fileName=''):
+        ''' Read cache from pickle file, keep current stamp if set
+        '''
+        fileName = fileName or self.fileName
+        stamp, items = self._readFile(fileName)
+        if self.stamp and stamp != self.stamp:
+            return # stale file
+        self.stamp = stamp
+        self._items = self._newItems()
+        for key, res in items[-self.maxItems:]:
+            self._items[key] = res
+#class ResultCache(object):
+
+
+_caches = {} # cache file name or name => ResultCache
+
+
+def getCache(name, stamp, fileName='', log=None):
+    ''' Process wide ResultCache by name, checked against data stamp.
+    Broken cache file is not an error, empty cache used.
+    '''
+    cache = _caches.get(name)
+    if cache is None:
+        try:
+            cache = ResultCache(stamp=stamp, fileName=fileName)
+        except Exception, e:
+            if log: log.warning("seismocache.getCache, can't read cache file '%s': %s" % (fileName, e))
+            cache = ResultCache(stamp=stamp)
+            cache.fileName = fileName
+        _caches[name] = cache
+    cache.checkStamp(stamp)
+    return cache
+#def getCache(name, stamp, fileName='', log=None):
+
+
+def saveCache(cache, log=None):
+    ''' Save cache if it has file, errors logged only
+    '''
+    if not cache.fileName:
+        return
+    try:
+        cache.save()
+    except Exception, e:
+        if log: log.warning("seismocache.saveCache, can't write cache file '%s': %s" % (cache.fileName, e))
+#def saveCache(cache, log=None):
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(verbose=True)
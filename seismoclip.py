@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# (c) Valik mailto:vasnake@gmail.com
+
+'''
+Seismoprofiles clip-and-measure engine for Seismodensity project
+
+Replacement for arcpy.Clip_analysis + CopyFeatures_management + python loop over geometry.length.
+Seismoprofiles vertices loaded into NumPy arrays once, clipped length of all profile segments
+computed against input polygon in vectorized batches, no scratch FeatureClass.
+Works without arcpy (arcpy needed only for loading profiles from GDB).
+
+Profiles
+    ProfileSet: x, y float64 vertex arrays; offsets int64 parts offsets (partCount + 1 items);
+    oids int64 OBJECTID for each part.
+Polygon
+    rings list, ring is a list of [x, y] pairs, Esri JSON layout.
+    Even-odd rule used for inside test, so inner rings (holes) are holes.
+    Area computed like arcpy does: clockwise ring gives positive area.
+
+All coordinates must be in one metric SR (seismoprofiles FeatureClass SR).
+
+Doctests
+>>> prof = ProfileSet.fromParts([[(0, 5), (20, 5)], [(2, -5), (2, 15)], [(30, 30), (40, 40)]])
+>>> square = [[[0, 0], [0, 10], [10, 10], [10, 0], [0, 0]]]
+>>> '%.3f' % clippedLength(prof, square)
+'20.000'
+>>> polygonArea(square)
+100.0
+>>> ['%.6f' % x for x in calcDensity(prof, square)]
+['200.000000', '0.020000', '0.000100']
+'''
+
+import os
+import math
+import numpy as np
+
+# max items in segments x edges matrix, memory vs speed tradeoff
+chunkSize = 1 << 20
+oidFieldName = 'OBJECTID'
+wkidAliases = {102100: 3857, 102113: 3857, 900913: 3857} # If wkid is 102100 we should try 3857 instead
+
+_profilesCache = {} # (fc path, sr) => (data stamp, ProfileSet), loaded profiles survive between jobs in one process
+
+
+class ProfileSet(object):
+    ''' Seismoprofiles polylines as flat arrays.
+
+    x, y: vertices coords, all parts one after another;
+    offsets: part i vertices is x[offsets[i]:offsets[i+1]];
+    oids: OBJECTID for each part (multipart feature gives several parts with one oid).
+    '''
+
+    def __init__(self, x, y, offsets, oids=None):
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        if oids is None:
+            oids = np.arange(len(self.offsets) - 1, dtype=np.int64)
+        self.oids = np.asarray(oids, dtype=np.int64)
+        self._segments = None
+
+    @classmethod
+    def fromParts(cls, parts, oids=None):
+        ''' Make ProfileSet from parts list, part is a list of (x, y)
+        '''
+        xs, ys, offsets = [], [], [0]
+        for part in parts:
+            for pnt in part:
+                xs.append(pnt[0])
+                ys.append(pnt[1])
+            offsets.append(len(xs))
+        return cls(xs, ys, offsets, oids)
+
+    @property
+    def partCount(self):
+        return len(self.offsets) - 1
+
+    @property
+    def vertexCount(self):
+        return len(self.x)
+
+    def segments(self):
+        ''' Return (x0, y0, x1, y1, segPart) arrays for all segments of all parts.
+
+        Segment i goes from vertex segVertex[i] to the next vertex in the same part;
+        segPart[i] is a part number for segment i.
+        Arrays computed once and cached.
+        '''
+        if self._segments is None:
+            nv = self.vertexCount
+            valid = np.ones(max(nv - 1, 0), dtype=bool)
+            if nv > 1:
+                starts = self.offsets[1:-1]
+                starts = starts[(starts > 0) & (starts < nv)]
+                valid[starts - 1] = False # last vertex of part to first vertex of next part
+            segVertex = np.nonzero(valid)[0]
+            segPart = np.searchsorted(self.offsets, segVertex, side='right') - 1
+            self._segments = (self.x[segVertex], self.y[segVertex],
+                self.x[segVertex + 1], self.y[segVertex + 1], segPart)
+        return self._segments
+
+    def segmentCount(self):
+        return len(self.segments()[0])
+#class ProfileSet(object):
+
+
+def ringsEdges(rings):
+    ''' Return (ex0, ey0, ex1, ey1) arrays for all edges of all rings.
+    Rings closed if needed.
+    '''
+    ex0, ey0, ex1, ey1 = [], [], [], []
+    for ring in rings:
+        ring = np.asarray(ring, dtype=np.float64).reshape(-1, 2)
+        if len(ring) < 3:
+            continue
+        if ring[0][0] != ring[-1][0] or ring[0][1] != ring[-1][1]:
+            ring = np.vstack([ring, ring[:1]])
+        ex0.append(ring[:-1, 0])
+        ey0.append(ring[:-1, 1])
+        ex1.append(ring[1:, 0])
+        ey1.append(ring[1:, 1])
+    if not ex0:
+        empty = np.zeros(0)
+        return (empty, empty, empty, empty)
+    return (np.concatenate(ex0), np.concatenate(ey0), np.concatenate(ex1), np.concatenate(ey1))
+#def ringsEdges(rings):
+
+
+def edgesExtent(edges):
+    ''' (xmin, ymin, xmax, ymax) for polygon edges
+    '''
+    ex0, ey0, ex1, ey1 = edges
+    return (min(ex0.min(), ex1.min()), min(ey0.min(), ey1.min()),
+        max(ex0.max(), ex1.max()), max(ey0.max(), ey1.max()))
+#def edgesExtent(edges):
+
+
+def pointsInPolygon(px, py, edges):
+    ''' Even-odd inside test for points arrays, ray casting to +X, vectorized by chunks
+    '''
+    px = np.asarray(px, dtype=np.float64)
+    py = np.asarray(py, dtype=np.float64)
+    ex0, ey0, ex1, ey1 = edges
+    res = np.zeros(len(px), dtype=bool)
+    ne = len(ex0)
+    if ne == 0 or len(px) == 0:
+        return res
+    step = max(1, chunkSize // ne)
+    dx = ex1 - ex0
+    dy = ey1 - ey0
+    for start in range(0, len(px), step):
+        cx = px[start:start + step, None]
+        cy = py[start:start + step, None]
+        straddle = (ey0 > cy) != (ey1 > cy)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xcross = ex0 + (cy - ey0) * dx / dy
+            crossings = (straddle & (cx < xcross)).sum(axis=1)
+        res[start:start + step] = (crossings % 2) == 1
+    return res
+#def pointsInPolygon(px, py, edges):
+
+
+def _chunkInsideLength(x0, y0, x1, y1, edges):
+    ''' Inside length for each segment of a chunk.
+
+    Segment split by its crossings with polygon edges,
+    each piece is inside or outside entirely, test piece midpoint.
+    '''
+    ex0, ey0, ex1, ey1 = edges
+    rx = (x1 - x0)[:, None]
+    ry = (y1 - y0)[:, None]
+    sx = ex1 - ex0
+    sy = ey1 - ey0
+    qx = ex0 - x0[:, None]
+    qy = ey0 - y0[:, None]
+    denom = rx * sy - ry * sx
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (qx * sy - qy * sx) / denom
+        u = (qx * ry - qy * rx) / denom
+        hit = (denom != 0) & (t > 0) & (t < 1) & (u >= 0) & (u <= 1) # zero length segment: nan
+    seglen = np.hypot(rx[:, 0], ry[:, 0])
+    res = np.zeros(len(x0))
+
+    nhits = hit.sum(axis=1)
+    whole = nhits == 0
+    if whole.any(): # no crossings, test segment midpoint
+        inside = pointsInPolygon((x0[whole] + x1[whole]) / 2.0, (y0[whole] + y1[whole]) / 2.0, edges)
+        res[whole] = seglen[whole] * inside
+
+    cut = ~whole
+    if cut.any(): # split by sorted crossings
+        kmax = nhits[cut].max()
+        tc = np.where(hit[cut], t[cut], np.inf)
+        tc.sort(axis=1)
+        tc = np.minimum(tc[:, :kmax], 1.0)
+        nc = len(tc)
+        bounds = np.hstack([np.zeros((nc, 1)), tc, np.ones((nc, 1))])
+        widths = bounds[:, 1:] - bounds[:, :-1]
+        mids = (bounds[:, 1:] + bounds[:, :-1]) / 2.0
+        px = x0[cut][:, None] + mids * rx[cut]
+        py = y0[cut][:, None] + mids * ry[cut]
+        inside = pointsInPolygon(px.ravel(), py.ravel(), edges).reshape(mids.shape)
+        res[cut] = (widths * inside).sum(axis=1) * seglen[cut]
+    return res
+#def _chunkInsideLength(x0, y0, x1, y1, edges):
+
+
+def segmentsInsideLength(x0, y0, x1, y1, edges, prefilter=True):
+    ''' Clipped length for each segment (x0, y0)-(x1, y1) against polygon edges.
+    Return float64 array, one item per segment.
+    prefilter False: edges is a part of polygon edges (seismosession.rayEdges), its extent is not polygon extent.
+    '''
+    x0, y0, x1, y1 = [np.asarray(a, dtype=np.float64) for a in (x0, y0, x1, y1)]
+    res = np.zeros(len(x0))
+    ne = len(edges[0])
+    if ne == 0 or len(x0) == 0:
+        return res
+
+    idx = np.arange(len(x0))
+    if prefilter: # bbox prefilter, segment outside polygon extent have zero length
+        xmin, ymin, xmax, ymax = edgesExtent(edges)
+        near = ~((np.maximum(x0, x1) < xmin) | (np.minimum(x0, x1) > xmax) |
+            (np.maximum(y0, y1) < ymin) | (np.minimum(y0, y1) > ymax))
+        idx = np.nonzero(near)[0]
+
+    step = max(1, chunkSize // ne)
+    for start in range(0, len(idx), step):
+        sl = idx[start:start + step]
+        res[sl] = _chunkInsideLength(x0[sl], y0[sl], x1[sl], y1[sl], edges)
+    return res
+#def segmentsInsideLength(x0, y0, x1, y1, edges, prefilter=True):
+
+
+def clippedLength(profiles, rings, segIdx=None):
+    ''' Sum length of profiles parts inside polygon, meters.
+
+    segIdx: optional segments numbers to process (candidates from spatial index),
+    all segments otherwise.
+    Sum computed by math.fsum, so result doesn't depend on segments order or chunking.
+    '''
+    x0, y0, x1, y1, segPart = profiles.segments()
+    if segIdx is not None:
+        x0, y0, x1, y1 = x0[segIdx], y0[segIdx], x1[segIdx], y1[segIdx]
+    lengths = segmentsInsideLength(x0, y0, x1, y1, ringsEdges(rings))
+    return math.fsum(lengths)
+#def clippedLength(profiles, rings, segIdx=None):
+
+
+def polygonArea(rings):
+    ''' Polygon area, arcpy way: clockwise rings positive, counterclockwise (holes) negative
+    '''
+    area = 0.0
+    for ring in rings:
+        ring = np.asarray(ring, dtype=np.float64).reshape(-1, 2)
+        if len(ring) < 3:
+            continue
+        x, y = ring[:, 0], ring[:, 1]
+        xn, yn = np.roll(x, -1), np.roll(y, -1)
+        area -= math.fsum(x * yn - xn * y) / 2.0
+    return area
+#def polygonArea(rings):
+
+
+def calcDensity(profiles, rings, segIdx=None):
+    ''' Return (density km/km2, profiles length km, polygon area km2)
+    '''
+    area = polygonArea(rings) / 1000000.0 # kilometers from meters
+    if area <= 0:
+        raise NameError("Wrong input polygon, you should send no selfintersected clockwise drawed single ring")
+    length = clippedLength(profiles, rings, segIdx) / 1000.0 # kilometers from meters
+    return (length / area, length, area)
+#def calcDensity(profiles, rings, segIdx=None):
+
+
+def ringsExtent(rings):
+    ''' (xmin, ymin, xmax, ymax) for polygon rings
+    '''
+    return edgesExtent(ringsEdges(rings))
+#def ringsExtent(rings):
+
+
+def dataStamp(path):
+    ''' Data version string for file or folder (file GDB): latest modification time and total size.
+    Precomputed structures keep the stamp and compare it to find out they are stale.
+    '''
+    mtime, size = os.path.getmtime(path), 0
+    if os.path.isdir(path):
+        for name in os.listdir(path):
+            st = os.stat(os.path.join(path, name))
+            mtime = max(mtime, st.st_mtime)
+            size += st.st_size
+    else:
+        size = os.path.getsize(path)
+    return '%.6f-%d' % (mtime, size)
+#def dataStamp(path):
+
+
+def calcDensityBatch(profiles, polygons, index=None, log=None):
+    ''' Density for many polygons in one pass with shared profiles and index.
+
+    polygons: iterable of (id, rings);
+    index: spatial index with query(envelope) method (seismoindex.STRTree), optional.
+    Return list of (id, density km/km2, length km, area km2); invalid rings repaired (seismorepair),
+    wrong polygon gives -1.0 values (tool outputs default), batch goes on.
+    '''
+    import seismorepair
+    res = []
+    for pid, rings in polygons:
+        try:
+            rings, problems = seismorepair.repairRings(rings)
+            if problems and log: log.info("seismoclip.calcDensityBatch, polygon '%s' repaired: %s" % (pid, ', '.join(problems)))
+            segIdx = None
+            if index is not None and rings:
+                segIdx = index.query(ringsExtent(rings))
+            density, length, area = calcDensity(profiles, rings, segIdx)
+        except Exception, e:
+            if log: log.warning("seismoclip.calcDensityBatch, polygon '%s' failed: %s" % (pid, e))
+            density, length, area = -1.0, -1.0, -1.0
+        res.append((pid, density, length, area))
+    return res
+#def calcDensityBatch(profiles, polygons, index=None, log=None):
+
+
+def geometryRings(geom):
+    ''' Rings list from arcpy polygon geometry.
+    Inner rings in arcpy part separated by None point.
+    '''
+    rings = []
+    for part in geom:
+        ring = []
+        for pnt in part:
+            if pnt is None:
+                if ring:
+                    rings.append(ring)
+                ring = []
+            else:
+                ring.append([pnt.X, pnt.Y])
+        if ring:
+            rings.append(ring)
+    return rings
+#def geometryRings(geom):
+
+
+def normalizeWkid(wkid):
+    ''' WKID with Esri aliases replaced by EPSG codes, 102100 is 3857
+    '''
+    wkid = int(wkid or 0)
+    return wkidAliases.get(wkid, wkid)
+#def normalizeWkid(wkid):
+
+
+def esriJsonPolygons(fset):
+    ''' Parse Esri JSON FeatureSet (dict, see tool scripts docstrings for examples).
+    Return (wkid, [(attributes, rings), ...]); wkid from FeatureSet or first geometry.
+    '''
+    wkid = (fset.get('spatialReference') or {}).get('wkid')
+    res = []
+    for feature in fset.get('features', []):
+        geom = feature.get('geometry') or {}
+        if wkid is None:
+            wkid = (geom.get('spatialReference') or {}).get('wkid')
+        res.append((feature.get('attributes') or {}, geom.get('rings') or []))
+    return wkid, res
+#def esriJsonPolygons(fset):
+
+
+def esriJsonFeatureSet(rings, wkid, attributes=None):
+    ''' Esri JSON FeatureSet (dict) with one polygon
+    '''
+    return {'geometryType': 'esriGeometryPolygon', 'spatialReference': {'wkid': wkid},
+        'features': [{'geometry': {'rings': rings, 'spatialReference': {'wkid': wkid}},
+            'attributes': attributes or {}}]}
+#def esriJsonFeatureSet(rings, wkid, attributes=None):
+
+
+def fcStamp(fcPath):
+    ''' dataStamp of FeatureClass workspace (file GDB folder): nearest existing folder of fcPath,
+    empty string if there is none (SDE connection etc.)
+    '''
+    path = os.path.dirname(fcPath)
+    while path and not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            return ''
+        path = parent
+    if not path:
+        return ''
+    return dataStamp(path)
+#def fcStamp(fcPath):
+
+
+def loadProfiles(fcPath, reload=False, sr=None):
+    ''' Read seismoprofiles FeatureClass into ProfileSet, using arcpy.SearchCursor.
+    sr: arcpy.SpatialReference to project profiles into, FeatureClass SR if None.
+    Loaded profiles cached by (fcPath, sr) for process lifetime, reloaded if gdb data stamp changed.
+    '''
+    key = (fcPath, sr is not None and sr.factoryCode or None)
+    stamp = fcStamp(fcPath) # before reading, gdb edited meanwhile gives reload next time
+    cached = _profilesCache.get(key)
+    if not reload and cached is not None and cached[0] == stamp:
+        return cached[1]
+    import arcpy
+    xs, ys, offsets, oids = [], [], [0], []
+    if sr is None:
+        rows = arcpy.SearchCursor(fcPath)
+    else:
+        rows = arcpy.SearchCursor(fcPath, '', sr)
+    for row in rows:
+        geom = row.shape
+        if geom is None:
+            continue
+        for part in geom:
+            for pnt in part:
+                if pnt is None:
+                    continue
+                xs.append(pnt.X)
+                ys.append(pnt.Y)
+            offsets.append(len(xs))
+            oids.append(row.getValue(oidFieldName))
+    del rows
+    profiles = ProfileSet(xs, ys, offsets, oids)
+    _profilesCache[key] = (stamp, profiles)
+    return profiles
+#def loadProfiles(fcPath, reload=False, sr=None):
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(verbose=True)
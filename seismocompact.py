@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# (c) Valik mailto:vasnake@gmail.com
+
+'''
+Compact profiles geometry for Seismodensity project
+
+Float64 vertices arrays (seismoclip.ProfileSet) take 16 bytes per vertex, segments arrays
+for clip another 40; merged archive doesn't fit in GP server memory that way.
+Here coordinates quantized to integer grid of 1 / scale meters (file GDB XY resolution
+for metric SR is 0.0001 m, so gdb coords decoded w/o loss), delta encoded per part
+(first vertex as is, others as difference from previous vertex) and stored as
+zigzag LEB128 varints, x and y interleaved: 2..4 bytes per coordinate for usual profiles.
+
+Each part has byte offset in data and bounding box. Clip selects parts whose bbox overlaps
+polygon extent and decodes them by blocks of about blockVertices vertices (part is never split)
+straight into NumPy arrays (vectorized varint decode, cumulative sums by parts) as ProfileSet
+for clip kernels; decoded block is dropped after clip, so resident memory is compact data
+plus one block.
+
+File (.compact.npz): data uint8; partBytes, offsets int64 (partCount + 1 items), part i bytes is
+data[partBytes[i]:partBytes[i+1]]; oids int64; bbox float64 (partCount rows); meta (version, scale), stamp.
+
+Doctests
+>>> import tempfile, shutil
+>>> prof = seismoclip.ProfileSet.fromParts([[(x, 0), (x, 50.0001), (x + 0.5, 100)] for x in range(1, 100, 2)] +
+...     [[(500000.25, 6000000.5), (500100.75, 6000000.5)]])
+>>> cp = CompactProfiles.fromChunks([prof])
+>>> cp.partCount, cp.vertexCount, cp.data.nbytes, prof.x.nbytes + prof.y.nbytes
+(51, 152, 665, 2432)
+>>> back = cp.toProfiles()
+>>> (back.x == prof.x).all(), (back.y == prof.y).all(), (back.offsets == prof.offsets).all()
+(True, True, True)
+>>> ring = [[10, 10], [10, 90], [90, 90], [90, 10], [10, 10]]
+>>> cp.clippedLength([ring]) == seismoclip.clippedLength(prof, [ring]), len(cp.candidates((10, 10, 90, 90)))
+(True, 40)
+>>> [c.partCount for c in cp.chunks((10, 10, 90, 90), blockVertices=40)]
+[14, 13, 13]
+>>> tmp = tempfile.mkdtemp()
+>>> exportCompact(os.path.join(tmp, 'prof' + compactFileExt), [prof], stamp='v1')
+(51, 152)
+>>> cp = loadCompact(os.path.join(tmp, 'prof' + compactFileExt))
+>>> part = cp.decodeParts([50])
+>>> cp.stamp, part.x.tolist(), part.y.tolist(), part.oids.tolist()
+('v1', [500000.25, 500100.75], [6000000.5, 6000000.5], [50])
+>>> [int(v) for v in decodeVarints(encodeVarints(zigzag(np.array([0, -1, 1, 63, -64, 64, 1 << 40, -(1 << 62)]))))]
+[0, 1, 2, 126, 127, 128, 2199023255552, 9223372036854775807]
+>>> unzigzag(decodeVarints(encodeVarints(zigzag(np.array([-3, 300, -(1 << 62)]))))).tolist()
+[-3, 300, -4611686018427387904]
+>>> shutil.rmtree(tmp)
+'''
+
+import os
+import tempfile
+import numpy as np
+
+import seismoclip
+from seismoindex import expandRanges
+
+compactFileExt = '.compact.npz'
+formatVersion = 1
+scale = 10000.0 # grid units per meter, file GDB default XY resolution 0.0001 m for metric SR
+blockVertices = 1 << 16 # vertices per block, about 1 MB of decoded arrays and segments
+
+_compactCache = {} # file name => CompactProfiles
+
+
+def zigzag(values):
+    ''' Signed int64 => uint64, small magnitude gives small number: 0, -1, 1, -2 => 0, 1, 2, 3
+    '''
+    values = np.asarray(values, dtype=np.int64)
+    return ((values << 1) ^ (values >> 63)).view(np.uint64)
+#def zigzag(values):
+
+
+def unzigzag(codes):
+    ''' uint64 => signed int64, inverse of zigzag
+    '''
+    codes = np.asarray(codes, dtype=np.uint64)
+    return ((codes >> np.uint64(1)).view(np.int64) ^ -(codes & np.uint64(1)).view(np.int64))
+#def unzigzag(codes):
+
+
+def varintSizes(codes):
+    ''' Bytes count of LEB128 varint for each of uint64 codes
+    '''
+    sizes = np.ones(len(codes), dtype=np.int64)
+    for k in range(1, 10):
+        sizes += codes >= np.uint64(1 << (7 * k))
+    return sizes
+#def varintSizes(codes):
+
+
+def encodeVarints(codes):
+    ''' uint64 array => uint8 array of LEB128 varints: 7 bits per byte, low bits first,
+    high bit set in all bytes but the last one of a value
+    '''
+    codes = np.asarray(codes, dtype=np.uint64)
+    nbytes = varintSizes(codes)
+    starts = np.cumsum(nbytes) - nbytes
+    res = np.zeros(int(nbytes.sum()), dtype=np.uint8)
+    for k in range(int(nbytes.max()) if len(codes) else 0):
+        sel = np.nonzero(nbytes > k)[0]
+        byte = (codes[sel] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        byte |= np.where(nbytes[sel] > k + 1, np.uint64(0x80), np.uint64(0))
+        res[starts[sel] + k] = byte
+    return res
+#def encodeVarints(codes):
+
+
+def decodeVarints(data):
+    ''' uint8 array of LEB128 varints => uint64 array, vectorized
+    '''
+    data = np.asarray(data, dtype=np.uint8)
+    ends = np.nonzero(data < 0x80)[0]
+    if len(ends) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    shift = (np.arange(len(data), dtype=np.int64) - np.repeat(starts, ends - starts + 1)) * 7
+    payload = (data & 0x7f).astype(np.uint64) << shift.astype(np.uint64)
+    return np.bitwise_or.reduceat(payload, starts)
+#def decodeVarints(data):
+
+
+def partsExtents(x, y, offsets):
+    ''' (xmin, ymin, xmax, ymax) arrays, one item per part; empty part gives inf, -inf
+    '''
+    offsets = np.asarray(offsets, dtype=np.int64)
+    res = [np.full(len(offsets) - 1, np.inf), np.full(len(offsets) - 1, np.inf),
+        np.full(len(offsets) - 1, -np.inf), np.full(len(offsets) - 1, -np.inf)]
+    full = np.nonzero(offsets[:-1] < offsets[1:])[0]
+    if len(full):
+        for i, (arr, func) in enumerate(((x, np.minimum), (y, np.minimum), (x, np.maximum), (y, np.maximum))):
+            res[i][full] = func.reduceat(np.asarray(arr, dtype=np.float64), offsets[full])
+    return res
+#def partsExtents(x, y, offsets):
+
+
+class CompactProfiles(object):
+    ''' Profiles polylines as quantized delta varints, see module docstring
+    '''
+
+    def __init__(self, data, partBytes, offsets, oids, bbox, scale=scale, stamp=''):
+        self.data = data
+        self.partBytes = partBytes
+        self.offsets = offsets
+        self.oids = oids
+        self.bbox = bbox
+        self.scale = scale
+        self.stamp = stamp
+        self.mtime = None
+
+    @classmethod
+    def fromChunks(cls, chunks, scale=scale, stamp=''):
+        ''' Encode ProfileSet chunks (seismostream chunks or one ProfileSet list),
+        memory is compact data plus one chunk
+        '''
+        data, partBytes, offsets, oids, bbox = [], [np.zeros(1, dtype=np.int64)], [np.zeros(1, dtype=np.int64)], [], []
+        nbytes = nverts = 0
+        for profiles in chunks:
+            qx = np.round(profiles.x * scale).astype(np.int64)
+            qy = np.round(profiles.y * scale).astype(np.int64)
+            off = profiles.offsets
+            dx, dy = np.zeros(len(qx), dtype=np.int64), np.zeros(len(qy), dtype=np.int64)
+            dx[1:], dy[1:] = np.diff(qx), np.diff(qy)
+            first = off[:-1][off[:-1] < off[1:]] # first vertex of not empty parts
+            dx[first], dy[first] = qx[first], qy[first]
+            codes = zigzag(np.column_stack((dx, dy)).ravel())
+            buf = encodeVarints(codes)
+            ends = np.concatenate([[0], np.cumsum(varintSizes(codes))])[off[1:] * 2]
+            data.append(buf)
+            partBytes.append(ends + nbytes)
+            offsets.append(off[1:] + nverts)
+            oids.append(profiles.oids)
+            bbox.append(np.column_stack(partsExtents(qx, qy, off)) / scale)
+            nbytes += len(buf)
+            nverts += profiles.vertexCount
+        return cls(np.concatenate(data) if data else np.zeros(0, dtype=np.uint8),
+            np.concatenate(partBytes).astype(np.int64), np.concatenate(offsets).astype(np.int64),
+            np.concatenate(oids).astype(np.int64) if oids else np.zeros(0, dtype=np.int64),
+            np.concatenate(bbox) if bbox else np.zeros((0, 4)), scale, stamp)
+
+    @property
+    def partCount(self):
+        return len(self.offsets) - 1
+
+    @property
+    def vertexCount(self):
+        return int(self.offsets[-1])
+
+    @property
+    def nbytes(self):
+        ''' Resident size, bytes
+        '''
+        return sum(a.nbytes for a in (self.data, self.partBytes, self.offsets, self.oids, self.bbox))
+
+    def decodeParts(self, parts):
+        ''' ProfileSet of given parts (ascending numbers), decoded from their bytes only
+        '''
+        parts = np.asarray(parts, dtype=np.int64)
+        counts = self.offsets[parts + 1] - self.offsets[parts]
+        off = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        buf = self.data[expandRanges(self.partBytes[parts], self.partBytes[parts + 1])]
+        d = unzigzag(decodeVarints(buf)).reshape(-1, 2)
+        full = counts > 0
+        coords = []
+        for col in (0, 1):
+            q = np.cumsum(d[:, col])
+            before = q[off[:-1][full]] - d[off[:-1][full], col] # deltas sum of previous parts
+            q -= np.repeat(before, counts[full])
+            coords.append(q / self.scale)
+        return seismoclip.ProfileSet(coords[0], coords[1], off, self.oids[parts])
+
+    def candidates(self, extent=None):
+        ''' Numbers of parts whose bbox overlaps extent (xmin, ymin, xmax, ymax), all parts if extent is None
+        '''
+        if extent is None:
+            return np.arange(self.partCount)
+        xmin, ymin, xmax, ymax = extent
+        bx0, by0, bx1, by1 = self.bbox.T
+        return np.nonzero((bx0 <= xmax) & (bx1 >= xmin) & (by0 <= ymax) & (by1 >= ymin))[0]
+
+    def chunks(self, extent=None, blockVertices=blockVertices):
+        ''' Decoded ProfileSet blocks of about blockVertices vertices, parts overlapping extent
+        '''
+        parts = self.candidates(extent)
+        if len(parts) == 0:
+            return
+        counts = self.offsets[parts + 1] - self.offsets[parts]
+        block = (np.cumsum(counts) - counts) // blockVertices # by part first vertex
+        bounds = np.concatenate([[0], np.nonzero(np.diff(block))[0] + 1, [len(parts)]])
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            yield self.decodeParts(parts[a:b])
+
+    def clippedLength(self, rings):
+        ''' Profiles length inside polygon, meters; only parts near polygon decoded
+        '''
+        import seismostream
+        return seismostream.streamLength(seismostream.segmentChunks(self.chunks(seismoclip.ringsExtent(rings))), rings)
+
+    def toProfiles(self):
+        ''' All parts decoded into one ProfileSet
+        '''
+        return self.decodeParts(np.arange(self.partCount))
+
+    def save(self, fileName):
+        ''' Write compact profiles into .npz file, atomically: temp file in the same folder, unique per writer
+        '''
+        fd, tmpName = tempfile.mkstemp('.tmp', os.path.basename(fileName) + '.', os.path.dirname(fileName) or '.')
+        try:
+            fh = os.fdopen(fd, 'wb')
+            try:
+                np.savez(fh, data=self.data, partBytes=self.partBytes, offsets=self.offsets, oids=self.oids,
+                    bbox=self.bbox, meta=np.array([formatVersion, self.scale]), stamp=np.array([self.stamp]))
+            finally:
+                fh.close()
+            os.chmod(tmpName, 0644) # mkstemp file is private, profiles file is read by other accounts too
+            if os.path.exists(fileName):
+                os.remove(fileName)
+            os.rename(tmpName, fileName)
+        except Exception:
+            if os.path.exists(tmpName):
+                os.remove(tmpName)
+            raise
+
+    @classmethod
+    def load(cls, fileName):
+        ''' Read compact profiles from .npz file
+        '''
+        data = np.load(fileName)
+        try:
+            version, units = data['meta']
+            if int(version) != formatVersion:
+                raise NameError("Unknown compact profiles format version '%s' in '%s'" % (int(version), fileName))
+            return cls(data['data'], data['partBytes'], data['offsets'], data['oids'], data['bbox'],
+                float(units), str(data['stamp'][0]))
+        finally:
+            data.close()
+#class CompactProfiles(object):
+
+
+def exportCompact(fileName, chunks, stamp='', scale=scale):
+    ''' Encode ProfileSet chunks (e.g. seismostream.cursorChunks of FeatureClass) into compact file.
+    Return (parts count, vertices count).
+    '''
+    cp = CompactProfiles.fromChunks(chunks, scale, stamp=stamp)
+    cp.save(fileName)
+    return (cp.partCount, cp.vertexCount)
+#def exportCompact(fileName, chunks, stamp='', scale=scale):
+
+
+def loadCompact(fileName):
+    ''' Compact profiles from process cache or file; file changed - read again
+    '''
+    mtime = os.path.getmtime(fileName)
+    cached = _compactCache.get(fileName)
+    if cached is not None and cached.mtime == mtime:
+        return cached
+    cp = CompactProfiles.load(fileName)
+    cp.mtime = mtime
+    _compactCache[fileName] = cp
+    return cp
+#def loadCompact(fileName):
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(verbose=True)
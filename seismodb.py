@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# (c) Valik mailto:vasnake@gmail.com
+
+'''
+Oracle access layer for Seismodensity project
+
+calc_seismodensity called with polygon as bind variable (WKB BLOB or WKT CLOB),
+so statement text is the same for all polygons and Oracle parse it once;
+connections kept in pool between calls, not opened per job.
+
+Driver is any DB-API 2 module with named parameters (cx_Oracle for Oracle, optional);
+sqlite3 stand-in (standInDatabase) registers fake functions with the same SQL interface,
+that allows to check geometry encoding, statements and result parsing w/o Oracle.
+
+Batch (calcDensityBatch): polygons inserted into staging table by one executemany,
+results for all of them fetched from one set-based query as numbers;
+transaction rolled back after fetch, that clears staging table (global temporary in Oracle).
+
+Connect file (oraConnFName in seismodensity.py): one line 'user/password@dsn'.
+
+Doctests
+>>> ring = [(0, 0), (0, 100), (100, 100), (100, 0)]
+>>> ringsWkt([ring], '%g %g')
+'(0 0, 0 100, 100 100, 100 0, 0 0)'
+>>> wkbRings(ringsWkb([ring])) == wktRings(ringsWkt([ring])) == [[(0, 0), (0, 100), (100, 100), (100, 0), (0, 0)]]
+True
+>>> import seismoclip
+>>> prof = seismoclip.ProfileSet.fromParts([[(0, 50), (200, 50)]])
+>>> pool = standInPool(prof)
+>>> calcDensity(pool, [ring], 32640, standInFuncName)
+(10.0, 0.1, 0.01)
+>>> calcDensity(pool, [ring], 32640, standInFuncName, 'wkt')
+(10.0, 0.1, 0.01)
+>>> str(queryValue(pool, 'select %s() as stamp from DUAL' % standInStampName))
+'standin-1'
+>>> calcDensityBatch(pool, [[ring], [[(0, 0), (0, 40), (40, 40), (40, 0)]]], 32640, standInStaging, standInBatchSource)
+[(10.0, 0.1, 0.01), (0.0, 0.0, 0.0016)]
+>>> pool.opened, len(pool)
+(1, 1)
+'''
+
+import os
+import re
+import struct
+import threading
+
+bindFuncName = 'algis.calc_seismodensity_wkb'
+wktFuncName = 'algis.calc_seismodensity_wkt'
+wktFormat = '%.17g %.17g' # float64 round trip, profiles SR meters or degrees (defaultWkid)
+stagingTable = 'algis.seismodens_poly'
+batchSource = 'table(algis.seismodens_pkg.calc_batch)'
+poolSize = 4
+standInFuncName = 'calc_seismodensity'
+standInStampName = 'seismoprofiles_stamp'
+standInStaging = 'seismodens_poly'
+standInBatchSource = 'seismodens_batch'
+
+_pools = {} # connect file => ConnectionPool
+
+
+class ConnectionPool(object):
+    ''' Idle connections list, not more than maxSize kept open.
+    module: DB-API module of connections, for Binary/BLOB/CLOB types.
+    '''
+
+    def __init__(self, connect, module, maxSize=poolSize):
+        self.connect = connect
+        self.module = module
+        self.maxSize = maxSize
+        self.opened = 0
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._idle)
+
+    def acquire(self):
+        self._lock.acquire()
+        try:
+            if self._idle:
+                return self._idle.pop()
+        finally:
+            self._lock.release()
+        conn = self.connect()
+        self.opened += 1
+        return conn
+
+    def release(self, conn, broken=False):
+        ''' Return connection to pool; broken connection (failed call) closed
+        '''
+        self._lock.acquire()
+        try:
+            if not broken and len(self._idle) < self.maxSize:
+                self._idle.append(conn)
+                return
+        finally:
+            self._lock.release()
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, []
+        finally:
+            self._lock.release()
+        for conn in idle:
+            self.release(conn, True)
+#class ConnectionPool(object):
+
+
+def closedRing(ring):
+    ''' Ring as list of (x, y) with closing vertex
+    '''
+    pts = [(pnt[0], pnt[1]) for pnt in ring]
+    if pts and pts[0] != pts[-1]:
+        pts.append(pts[0])
+    return pts
+#def closedRing(ring):
+
+
+def ringsWkt(rings, fmt=wktFormat):
+    ''' Polygon rings text for 'polygon (...)' WKT: '(x y, x y, ...), (...)'.
+    Built by join, linear in vertex count.
+    '''
+    return ', '.join('(%s)' % ', '.join(fmt % pnt for pnt in closedRing(ring)) for ring in rings)
+#def ringsWkt(rings, fmt=wktFormat):
+
+
+def ringsWkb(rings):
+    ''' Polygon WKB, little endian
+    '''
+    rings = [closedRing(ring) for ring in rings]
+    parts = [struct.pack('<BII', 1, 3, len(rings))]
+    for ring in rings:
+        parts.append(struct.pack('<I', len(ring)))
+        parts.append(struct.pack('<%sd' % (2 * len(ring)), *[c for pnt in ring for c in pnt]))
+    return ''.encode('ascii').join(parts)
+#def ringsWkb(rings):
+
+
+def wktRings(text):
+    ''' Rings from polygon WKT or ringsWkt text
+    '''
+    rings = []
+    for ringText in re.findall(r'\(([^()]*)\)', text):
+        ring = []
+        for pnt in ringText.split(','):
+            x, y = pnt.split()[:2]
+            ring.append((float(x), float(y)))
+        rings.append(ring)
+    return rings
+#def wktRings(text):
+
+
+def wkbRings(wkb):
+    ''' Rings from polygon WKB
+    '''
+    wkb = bytes(wkb)
+    order = '<' if struct.unpack('B', wkb[:1])[0] == 1 else '>'
+    geomType, count = struct.unpack(order + 'II', wkb[1:9])
+    if geomType != 3:
+        raise NameError("WKB geometry type '%s' is not Polygon" % geomType)
+    pos = 9
+    rings = []
+    for i in range(count):
+        npts = struct.unpack(order + 'I', wkb[pos:pos + 4])[0]
+        coords = struct.unpack(order + '%sd' % (2 * npts), wkb[pos + 4:pos + 4 + 16 * npts])
+        rings.append(list(zip(coords[0::2], coords[1::2])))
+        pos += 4 + 16 * npts
+    return rings
+#def wkbRings(wkb):
+
+
+def parseResult(text):
+    ''' calc_seismodensity answer '    .068,       7154.117,     104761.243' as floats tuple
+    '''
+    return tuple(float(item) for item in ('%s' % text).split(','))
+#def parseResult(text):
+
+
+def queryValue(pool, sql, params=None, inputSizes=None):
+    ''' First column of first row for statement with bind variables.
+    inputSizes: name => driver type (e.g. cx_Oracle.BLOB), None items skipped.
+    '''
+    conn = pool.acquire()
+    broken = True
+    try:
+        cur = conn.cursor()
+        try:
+            sizes = dict((k, v) for k, v in (inputSizes or {}).items() if v is not None)
+            if sizes:
+                cur.setinputsizes(**sizes)
+            cur.execute(sql, params or {})
+            row = cur.fetchone()
+        finally:
+            cur.close()
+        broken = False
+    finally:
+        pool.release(conn, broken)
+    if row is None:
+        raise NameError("Query return no rows [%s]" % sql)
+    return row[0]
+#def queryValue(pool, sql, params=None, inputSizes=None):
+
+
+def calcDensity(pool, rings, wkid, funcName=bindFuncName, geomFormat='wkb'):
+    ''' (density km/km2, length km, area km2) from calc_seismodensity_wkb (geomFormat 'wkb')
+    or calc_seismodensity_wkt (geomFormat 'wkt') stored function
+    '''
+    if geomFormat == 'wkb':
+        poly = pool.module.Binary(ringsWkb(rings))
+        polyType = getattr(pool.module, 'BLOB', None)
+    else:
+        poly = ringsWkt(rings)
+        polyType = getattr(pool.module, 'CLOB', None)
+    sql = 'select %s(:poly, :wkid) as calcres from DUAL' % funcName
+    res = queryValue(pool, sql, {'poly': poly, 'wkid': int(wkid)}, {'poly': polyType})
+    return parseResult(res)
+#def calcDensity(pool, rings, wkid, funcName=bindFuncName, geomFormat='wkb'):
+
+
+def calcDensityBatch(pool, polygons, wkid, staging=stagingTable, source=batchSource):
+    ''' List of (density km/km2, length km, area km2) for polygons (list of rings lists),
+    by staging table and set-based query, one connection, two round trips.
+    Row with NULL values (function failed on that polygon) gives -1.0 values.
+    '''
+    if not polygons:
+        return []
+    rows = [{'id': i, 'poly': pool.module.Binary(ringsWkb(rings)), 'wkid': int(wkid)}
+        for i, rings in enumerate(polygons)]
+    polyType = getattr(pool.module, 'BLOB', None)
+    conn = pool.acquire()
+    broken = True
+    try:
+        cur = conn.cursor()
+        try:
+            if polyType is not None:
+                cur.setinputsizes(poly=polyType)
+            cur.executemany('insert into %s (poly_id, poly, poly_wkid) values (:id, :poly, :wkid)' % staging, rows)
+            cur.arraysize = len(rows)
+            cur.execute('select poly_id, dens, len_km, area_kmsq from %s order by poly_id' % source)
+            fetched = cur.fetchall()
+        finally:
+            cur.close()
+            conn.rollback() # staging rows are not needed anymore
+        broken = False
+    finally:
+        pool.release(conn, broken)
+    res = [None] * len(polygons)
+    for polyId, dens, length, area in fetched:
+        if dens is None or length is None or area is None:
+            res[int(polyId)] = (-1.0, -1.0, -1.0)
+        else:
+            res[int(polyId)] = (float(dens), float(length), float(area))
+    if None in res:
+        raise NameError("Batch query return %s rows for %s polygons" % (len(fetched), len(polygons)))
+    return res
+#def calcDensityBatch(pool, polygons, wkid, staging=stagingTable, source=batchSource):
+
+
+def readConnectString(fileName):
+    ''' (user, password, dsn) from 'user/password@dsn' line
+    '''
+    fh = open(fileName)
+    try:
+        line = fh.readline().strip()
+    finally:
+        fh.close()
+    userPassword, dsn = line.rsplit('@', 1)
+    user, password = userPassword.split('/', 1)
+    return user, password, dsn
+#def readConnectString(fileName):
+
+
+def getPool(connFile, log=None):
+    ''' Process wide Oracle ConnectionPool for connect file;
+    None if cx_Oracle or connect file is not available, caller should use ArcSDESQLExecute then.
+    '''
+    pool = _pools.get(connFile)
+    if pool is not None:
+        return pool
+    if not connFile or not os.path.exists(connFile):
+        return None
+    try:
+        import cx_Oracle
+    except ImportError, e:
+        if log: log.info("seismodb.getPool, cx_Oracle is not available: %s" % e)
+        return None
+    user, password, dsn = readConnectString(connFile)
+    connect = lambda: cx_Oracle.connect(user, password, dsn, threaded=True)
+    pool = _pools[connFile] = ConnectionPool(connect, cx_Oracle)
+    if log: log.info("seismodb.getPool, pool for '%s@%s'" % (user, dsn))
+    return pool
+#def getPool(connFile, log=None):
+
+
+def standInPool(profiles, fileName=':memory:'):
+    ''' ConnectionPool over sqlite3 database from standInDatabase
+    '''
+    import sqlite3
+    return ConnectionPool(lambda: standInDatabase(profiles, fileName), sqlite3)
+#def standInPool(profiles, fileName=':memory:'):
+
+
+def standInDatabase(profiles, fileName=':memory:'):
+    ''' sqlite3 connection with DUAL table and fake functions
+    calc_seismodensity(poly, wkid) - poly is WKB or rings WKT, in profiles SR, wkid ignored;
+    seismoprofiles_stamp() - 'standin-' and profiles part count;
+    seismodens_poly table and seismodens_batch view - calcDensityBatch staging and source.
+    Answers formatted like Oracle function.
+    '''
+    import sqlite3
+    import seismoclip
+
+    def density(poly):
+        if isinstance(poly, (type(u''), type(''))):
+            return seismoclip.calcDensity(profiles, wktRings(poly))
+        return seismoclip.calcDensity(profiles, wkbRings(poly))
+
+    def calc(poly, wkid):
+        return '%8.3f, %14.3f, %14.3f' % density(poly)
+
+    conn = sqlite3.connect(fileName, check_same_thread=False)
+    conn.create_function(standInFuncName, 2, calc)
+    conn.create_function(standInStampName, 0, lambda: 'standin-%s' % profiles.partCount)
+    conn.execute('create table if not exists DUAL (DUMMY varchar(1))')
+    if conn.execute('select count(*) from DUAL').fetchone()[0] == 0:
+        conn.execute("insert into DUAL values ('X')")
+    for i, name in enumerate(('sd_dens', 'sd_len', 'sd_area')):
+        conn.create_function(name, 1, lambda poly, i=i: density(poly)[i])
+    conn.execute('create table if not exists %s (poly_id integer primary key, poly blob, poly_wkid integer)' % standInStaging)
+    conn.execute('''create view if not exists %s as select poly_id,
+        sd_dens(poly) as dens, sd_len(poly) as len_km, sd_area(poly) as area_kmsq from %s''' % (
+        standInBatchSource, standInStaging))
+    conn.commit()
+    return conn
+#def standInDatabase(profiles, fileName=':memory:'):
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(verbose=True)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# (c) Valik mailto:vasnake@gmail.com
+
+'''
+Incremental maintenance of precomputed data for Seismodensity project
+
+APP_GP_SEISM2D_L is edited weekly, new surveys loaded, old ones fixed or removed;
+columnar store, spatial index and length pyramid were rebuilt from scratch after every gdb change.
+Here the edit is found and applied to them:
+    features compared by OBJECTID and geometry hash (store manifest, seismostore.featureHashes):
+        inserted, deleted and modified features;
+    parts of deleted and modified features marked deleted in copy of store build, inserted and modified
+    appended to it (seismostore.copyBuild, readers keep old build till they reopen; files only appended to
+    are hard linked, not copied, so insert-only edit doesn't copy store);
+    deleted segments removed from spatial index, appended inserted into its extra list (seismoindex);
+    pyramid totals corrected by deleted and appended segments pieces (seismopyramid);
+    store header build number incremented, index and pyramid saved with new data stamp,
+    so readers of previous build see them stale (seismostore.isStale, stamps).
+Cost: geometry work is about the edit size, store copy is about the files edit changes in place
+(none for insert-only edit, vertices and segments files if features deleted or modified);
+reading and hashing FeatureClass to find the edit and rewriting index and pyramid files are about archive size
+(editor tracking fields are not required from gdb, and modified feature keeps its OBJECTID,
+so OBJECTID range query would miss it).
+Edit is done under store lock (seismostore.storeLock), same as export, so two processes never edit one build.
+
+Full rebuild (store export by seismostore.loadStore, index and pyramid rebuilt at first use by loadOrBuild)
+if edit is large (maxEditShare of features), store has many deleted segments (maxDeadShare),
+index or pyramid extra list gets long (maxExtraShare) or inserted profiles go out of pyramid frame.
+
+Doctests
+>>> import tempfile, shutil, seismoclip, seismoindex, seismopyramid
+>>> tmp = tempfile.mkdtemp()
+>>> storeDir, indexFile, pyramidFile = [os.path.join(tmp, n) for n in ('s.store', 's.rtree.npz', 's.pyramid.npz')]
+>>> lines = [[(x, 0), (x, 100)] for x in range(1, 100, 2)]
+>>> prof = seismoclip.ProfileSet.fromParts(lines, oids=range(1, 51))
+>>> seismostore.exportStore(storeDir, prof, {'YEAR': [2000] * 50}, stamp='v1')
+>>> seismoindex.segmentsTree(prof, 'v1').save(indexFile)
+>>> pyr = seismopyramid.LengthPyramid(stamp='v1'); pyr.build(prof); pyr.save(pyramidFile)
+>>> lines[0] = [(1, 0), (1, 50)] # modified
+>>> old = seismostore.openStore(storeDir)
+>>> edited = seismoclip.ProfileSet.fromParts(lines[:-1] + [[(1, 50), (99, 50)]], oids=range(1, 50) + [77])
+>>> applyEdit(storeDir, edited, {'YEAR': [2000] * 49 + [2013]}, 'v2', indexFile, pyramidFile)
+(1, 1, 1)
+>>> st = seismostore.openStore(storeDir)
+>>> st.header['build'], st.header['stamp'], st.header['deadParts'], st.partCount
+(2, u'v2', 2, 52)
+>>> old.y[1], old.partCount # reader of previous build sees it unchanged
+(100.0, 50)
+>>> ring = [[10, 10], [10, 90], [90, 90], [90, 10], [10, 10]]
+>>> index = seismoindex.loadOrBuild(indexFile, st, 'v2')
+>>> pyr = seismopyramid.loadOrBuild(pyramidFile, st, 'v2')
+>>> '%.3f %.3f %.3f' % (seismoclip.clippedLength(edited, [ring]),
+...     seismoclip.clippedLength(st, [ring], index.query((10, 10, 90, 90))), pyr.query(st, [ring]))
+'3280.000 3280.000 3280.000'
+>>> shutil.rmtree(tmp)
+'''
+
+import os
+import numpy as np
+
+import seismoclip
+import seismostore
+import seismoindex
+import seismopyramid
+from seismoindex import expandRanges
+
+maxEditShare = 0.2 # of features, larger edit - full rebuild
+maxDeadShare = 0.2 # of store segments
+maxExtraShare = 0.1 # of index items or pyramid pieces
+
+
+def diffManifest(oldOids, oldHashes, newOids, newHashes):
+    ''' (inserted, deleted, modified) OBJECTID arrays; manifests oids ascending, unique
+
+    >>> diffManifest(np.array([1, 2, 3]), np.array([10, 20, 30]), np.array([2, 3, 4]), np.array([20, 31, 40]))
+    ([4], [1], [3])
+    '''
+    common = np.intersect1d(oldOids, newOids)
+    modified = common[oldHashes[np.searchsorted(oldOids, common)] != newHashes[np.searchsorted(newOids, common)]]
+    return (list(np.setdiff1d(newOids, oldOids)), list(np.setdiff1d(oldOids, newOids)), list(modified))
+#def diffManifest(oldOids, oldHashes, newOids, newHashes):
+
+
+def selectParts(profiles, parts):
+    ''' ProfileSet of given parts numbers
+    '''
+    parts = np.asarray(parts, dtype=np.int64)
+    starts, ends = profiles.offsets[parts], profiles.offsets[parts + 1]
+    vert = expandRanges(starts, ends)
+    offsets = np.concatenate([[0], np.cumsum(ends - starts)])
+    return seismoclip.ProfileSet(profiles.x[vert], profiles.y[vert], offsets, profiles.oids[parts])
+#def selectParts(profiles, parts):
+
+
+def _loadForEdit(fileName, load, stamp, log=None):
+    ''' Index or pyramid from file if it is built for stamp, None otherwise (it will be rebuilt)
+    '''
+    if not fileName or not os.path.exists(fileName):
+        return None
+    try:
+        res = load(fileName)
+    except Exception, e:
+        if log: log.warning("seismodelta, can't read '%s': %s" % (fileName, e))
+        return None
+    if res.stamp != stamp:
+        return None
+    return res
+#def _loadForEdit(fileName, load, stamp, log=None):
+
+
+def _save(obj, fileName, log=None):
+    try:
+        obj.save(fileName)
+    except Exception, e:
+        if log: log.warning("seismodelta, can't save '%s': %s" % (fileName, e))
+
+
+def applyEdit(storeDir, profiles, attrs, stamp, indexFile='', pyramidFile='', log=None):
+    ''' Apply difference between store and profiles (new FeatureClass content,
+    attrs: store columns name => list, one item per part) to store, index and pyramid files.
+    Store edited in new build (seismostore.copyBuild), caller holds store lock.
+    Return (inserted, deleted, modified) features counts,
+    None if full rebuild is better, store is not changed then.
+    Index or pyramid not built for store stamp or not editable left stale, loadOrBuild rebuilds them.
+    '''
+    header = seismostore.readHeader(storeDir)
+    if header is None:
+        return None
+    oldStamp = header['stamp']
+    oldOids, oldHashes = seismostore.readManifest(storeDir, header)
+    newOids, newHashes = seismostore.featureHashes(profiles)
+    inserted, deleted, modified = diffManifest(oldOids, oldHashes, newOids, newHashes)
+    edit = len(inserted) + len(deleted) + len(modified)
+    if edit > maxEditShare * max(len(oldOids), 1):
+        if log: log.info("seismodelta.applyEdit, edit of '%s' features is large, full rebuild" % edit)
+        return None
+    if header['deadSegments'] > maxDeadShare * max(header['segmentCount'], 1):
+        if log: log.info("seismodelta.applyEdit, '%s' deleted segments in store, full rebuild" % header['deadSegments'])
+        return None
+    columns = set(col['name'] for col in header['columns'])
+    if not columns.issubset(attrs or {}):
+        if log: log.info("seismodelta.applyEdit, store columns %s not in attributes, full rebuild" % sorted(columns))
+        return None
+
+    index = _loadForEdit(indexFile, seismoindex.STRTree.load, oldStamp, log)
+    pyr = _loadForEdit(pyramidFile, seismopyramid.LengthPyramid.load, oldStamp, log)
+
+    parts = np.nonzero(np.in1d(profiles.oids, inserted + modified))[0]
+    newParts = selectParts(profiles, parts)
+    newAttrs = dict((name, [attrs[name][i] for i in parts]) for name in columns)
+    oldData = header['dataDir']
+    seismostore.copyBuild(storeDir, header, appendOnly=not (deleted or modified))
+    dead = seismostore.deleteParts(storeDir, header, deleted + modified)
+    start, stop = seismostore.appendParts(storeDir, header, newParts, newAttrs)
+    seismostore.writeManifest(storeDir, header, newOids, newHashes)
+    header['stamp'] = stamp
+    header['build'] = header.get('build', 0) + 1
+    seismostore.writeHeader(storeDir, header)
+    seismostore.removeBuilds(storeDir, [oldData, header['dataDir']])
+
+    x0, y0, x1, y1, segPart = newParts.segments()
+    segNo = np.arange(start, stop, dtype=np.int64)
+    if index is not None:
+        index.remove(dead[0])
+        index.insert(segNo, np.minimum(x0, x1), np.minimum(y0, y1), np.maximum(x0, x1), np.maximum(y0, y1))
+        if len(index.extraIds) <= maxExtraShare * index.itemCount:
+            index.stamp = stamp
+            _save(index, indexFile, log)
+    if pyr is not None:
+        if pyr.applyDelta(dead[1:], (segNo, x0, y0, x1, y1)) and (
+                len(pyr.extraCell) <= maxExtraShare * max(len(pyr.pieceSeg), 1)):
+            pyr.stamp = stamp
+            _save(pyr, pyramidFile, log)
+
+    if log: log.info("seismodelta.applyEdit, store '%s' build '%s': inserted '%s', deleted '%s', modified '%s' features" % (
+        storeDir, header['build'], len(inserted), len(deleted), len(modified)))
+    return (len(inserted), len(deleted), len(modified))
+#def applyEdit(storeDir, profiles, attrs, stamp, indexFile='', pyramidFile='', log=None):
+
+
+def refreshStore(storeDir, fcPath, stamp, fields=(), indexFile='', pyramidFile='', log=None):
+    ''' If store is stale (other data stamp), read FeatureClass by arcpy and apply edit under store lock.
+    Return True if store is fresh now; False - seismostore.loadStore will export it.
+    Errors logged only.
+    '''
+    try:
+        header = seismostore.readHeader(storeDir)
+        if header is None:
+            return False
+        if header['stamp'] == stamp:
+            return True
+        profiles, values, wkid = seismostore.readFeatureClass(fcPath, fields)
+        if wkid != header['wkid']:
+            if log: log.info("seismodelta.refreshStore, SR changed '%s' => '%s', full rebuild" % (header['wkid'], wkid))
+            return False
+        with seismostore.storeLock(storeDir, log=log):
+            header = seismostore.readHeader(storeDir)
+            if header is not None and header['stamp'] == stamp:
+                return True # edited by other process meanwhile
+            return applyEdit(storeDir, profiles, values, stamp, indexFile, pyramidFile, log) is not None
+    except Exception, e:
+        if log: log.warning("seismodelta.refreshStore, can't edit store '%s': %s" % (storeDir, e))
+    return False
+#def refreshStore(storeDir, fcPath, stamp, fields=(), indexFile='', pyramidFile='', log=None):
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(verbose=True)
@@ -15,9 +15,16 @@ Output: double default -1.0
 
 Constants (line #97 and below)
     logFilename - file for log records
+    metricsFilename - file for jobs metrics, JSON line per job (seismometrics); empty string for log only
     toolDirPath - folder with gdb & other files
     oraSdeFName - oracle sde connection file
-    oraFuncName - oracle stored function for seismodensity calc
+    oraFuncName - oracle stored function for seismodensity calc, WKT literal, by ArcSDESQLExecute
+    oraConnFName - 'user/password@dsn' file for cx_Oracle connections pool (seismodb);
+        if file or cx_Oracle not found, ArcSDESQLExecute with oraSdeFName used
+    oraGeomFormat - polygon bind variable for pooled connections: 'wkb' (BLOB) or 'wkt' (CLOB)
+    stampSql - query for seismoprofiles table data version, results cache invalidation
+    stampTTL - seconds between data version queries
+    cacheFName - results cache file; empty string for memory only cache
 
 Before invoking tool you must prepare valid polygon without holes.
 That means no inner rings, no self intersections, clockwise draw direction.
@@ -94,11 +101,28 @@ import time, traceback
 import sys, string, os
 import logging
 
+import seismoclip
+import seismorepair
+import seismoproj
+import seismocache
+import seismodb
+import seismometrics
+import seismolog
+
 # global constants
 logFilename = r'''\\cache\MXD\seismo\seismodensity.geoproc.log'''
+logLevel = logging.INFO
+metricsFilename = r'''\\cache\MXD\seismo\seismodensity.metrics.jsonl'''
 toolDirPath = r'''\\cache\MXD\seismo'''
 oraSdeFName = r'''oratoarc10.algis.sde'''
 oraFuncName = r'''algis.calc_seismodensity'''
+oraConnFName = r'''oratoarc10.algis.ora'''
+oraGeomFormat = 'wkb'
+stampSql = r'''select algis.seismoprofiles_stamp as stamp from DUAL'''
+wkidSql = r'''select algis.seismodens_pkg.profiles_wkid as wkid from DUAL'''
+defaultWkid = 4326 # WGS84, if profiles SR is unknown to Oracle; st_transform'ed then
+stampTTL = 60
+cacheFName = r'''seismodensity.cache.pkl'''
 
 cp = 'utf-8'
 log = logging.getLogger('seismodens') # http://docs.python.org/library/logging.html
@@ -112,24 +136,88 @@ def setLogger(log):
     logrotate
     http://stackoverflow.com/questions/8467978/python-want-logging-with-log-rotation-and-compression
     http://docs.python.org/library/logging.handlers.html#rotatingfilehandler
+    Records written to rotating file (5 files up to 1 megabyte each) by background thread (seismolog),
+    job doesn't wait for network share; logLevel DEBUG - full input polygons and SQL in log.
     '''
-    log.setLevel(logging.DEBUG)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    if not hasattr(log, 'vFHandle'):
-        import logging.handlers as handlers
-        # 5 files up to 1 megabyte each
-        fh = handlers.RotatingFileHandler(logFilename, maxBytes=1000000, backupCount=5, encoding='utf-8')
-        #~ fh = handlers.TimedRotatingFileHandler(logFilename, backupCount=3, when='M', interval=3, encoding='utf-8',)
-        #~ fh = logging.FileHandler(logFilename)
-        #~ fh = logging.NullHandler()
-        fh.setLevel(logging.DEBUG)
-        fh.setFormatter(formatter)
-        log.addHandler(fh)
-        log.vFHandle = fh
+    seismolog.setupLogger(log, logFilename, logLevel)
     print 'Log configured. Look file [%s] for messages' % logFilename
 #def setLogger(log):
 
 
+_stamp = {'time': 0, 'value': ''}
+
+def profilesStamp(execute):
+    ''' Seismoprofiles table data version from Oracle.
+    execute: function sql => value, e.g. sdeConn.execute.
+    Asked not more often than once in stampTTL seconds.
+    '''
+    now = time.time()
+    if now - _stamp['time'] > stampTTL:
+        _stamp['value'] = ('%s' % execute(stampSql)).strip()
+        _stamp['time'] = now
+        log.info("profilesStamp, seismoprofiles data version '%s'" % (_stamp['value']))
+    return _stamp['value']
+#def profilesStamp(execute):
+
+
+_wkid = {}
+
+def profilesWkid(execute):
+    ''' Seismoprofiles SR WKID from Oracle, asked once per process;
+    defaultWkid if seismodens_pkg has no profiles_wkid or SR has no WKID.
+    '''
+    if 'value' not in _wkid:
+        try:
+            _wkid['value'] = int(('%s' % execute(wkidSql)).strip())
+        except Exception, e:
+            log.warning("profilesWkid, can't get seismoprofiles WKID: %s" % e)
+            _wkid['value'] = defaultWkid
+        log.info("profilesWkid, seismoprofiles WKID '%s'" % (_wkid['value']))
+    return _wkid['value']
+#def profilesWkid(execute):
+
+
+def oraDensityBatch(polygons, wkid):
+    ''' Density for many polygons by one set-based Oracle query (seismodens_pkg.calc_batch),
+    batch engine of seismodensitybatch.py. Needs pooled cx_Oracle connection, see oraConnFName.
+
+    polygons: list of (id, rings), rings in wkid SR, repaired (seismorepair) before query;
+    return list of (id, density km/km2, length km, area km2), as seismoclip.calcDensityBatch.
+    Wrong polygon gives -1.0 values and batch goes on: polygon failed repair is not sent,
+    batch query failed - polygon by polygon calls of stored function, failed call gives -1.0 row.
+    '''
+    pool = seismodb.getPool(os.path.join(toolDirPath, oraConnFName), log)
+    if pool is None:
+        raise NameError("Oracle batch needs cx_Oracle and connect file '%s'" % oraConnFName)
+    failed = (-1.0, -1.0, -1.0)
+    values = [failed] * len(polygons)
+    good = [] # (position, repaired rings)
+    for num, (pid, rings) in enumerate(polygons):
+        try:
+            good.append((num, seismorepair.repairRings(rings)[0]))
+        except Exception, e:
+            log.warning("oraDensityBatch, polygon '%s' failed: %s" % (pid, e))
+    try:
+        res = seismodb.calcDensityBatch(pool, [rings for num, rings in good], wkid)
+    except Exception, e:
+        log.warning("oraDensityBatch, batch query failed, polygon by polygon: %s" % e)
+        funcName = seismodb.bindFuncName
+        if oraGeomFormat == 'wkt':
+            funcName = seismodb.wktFuncName
+        res = []
+        for num, rings in good:
+            try:
+                res.append(seismodb.calcDensity(pool, rings, wkid, funcName, oraGeomFormat))
+            except Exception, e:
+                log.warning("oraDensityBatch, polygon '%s' failed: %s" % (polygons[num][0], e))
+                res.append(failed)
+    for (num, rings), value in zip(good, res):
+        values[num] = tuple(value)
+    log.info("oraDensityBatch, '%s' polygons processed, '%s' failed" % (len(polygons), values.count(failed)))
+    return [(pid, ) + value for (pid, rings), value in zip(polygons, values)]
+#def oraDensityBatch(polygons, wkid):
+
+
 def arcpyStuff():
     ''' Geoprocessor main program.
 
@@ -139,13 +227,17 @@ def arcpyStuff():
     arcpy.SetParameterAsText(2, y) # SeismorofilesLength double, km
     arcpy.SetParameterAsText(3, z) # ShapeArea double, km2
 
-    Input polygon will be transformed into WGS84, coords will be extracted into WKT string.
-    Oracle stored function will be invoked with WKT coords and WGS84 SR WKID as parameters.
+    Input polygon will be transformed into seismoprofiles SR (seismoproj, WKID asked from Oracle once),
+    coords will be extracted into WKB or WKT; no WGS84 round-trip, Oracle skips st_transform.
+    Oracle stored function will be invoked with polygon and SR WKID as bind variables,
+    over pooled cx_Oracle connection (seismodb); w/o cx_Oracle, by ArcSDESQLExecute with WKT literal.
     Function output will be parsed and returned from GP tool.
+    Results cached by polygon (seismocache), cache dropped when seismoprofiles data version changes.
 
     We have problems with invalid geometry - interior rings (counterclockwise draw direction).
     If you draw polygon counterclockwise and send that to script, you get zeropart polygon.
-    In that case you should use Geometry.Simplify geoservice http://tasks.arcgisonline.com/ArcGIS/rest/services/Geometry/GeometryServer/simplify.
+    Then polygon rings taken from FeatureSet JSON and repaired in the tool (seismorepair):
+    orientation, closing, duplicate vertices, self-intersections; no Geometry.Simplify call needed.
     Extra info:
     http://gis.stackexchange.com/questions/10201/arcpy-geometry-geo-interface-and-asshape-function-loss-of-precision-and-h/21627
     http://gis.stackexchange.com/questions/27255/how-to-identify-feature-vertices-that-are-part-of-a-donut-hole-in-arcgis-10
@@ -155,113 +247,110 @@ def arcpyStuff():
     from arcpy import env
     arcpy.AddMessage("%s seismodensitysql processing started" % ts())
 
-    # WGS84 spatialReference
-    WKID = 4326 # WGS-1984 http://anothergisblog.blogspot.com/2011/05/spatial-reference-class.html
-    sr = arcpy.SpatialReference()
-    sr.factoryCode = WKID
-    sr.create()
-    env.outputCoordinateSystem = sr
+    # Oracle connection: pooled cx_Oracle with bind variables or ArcSDESQLExecute
+    with seismometrics.phase('connect'):
+        pool = seismodb.getPool(os.path.join(toolDirPath, oraConnFName), log)
+        if pool is not None:
+            execute = lambda sql: seismodb.queryValue(pool, sql)
+        else:
+            # http://help.arcgis.com/en/arcgisdesktop/10.0/help/index.html#/ArcSDESQLExecute/000v00000057000000/
+            sdeConn = arcpy.ArcSDESQLExecute(os.path.join(toolDirPath, oraSdeFName)) # \\cache\MXD\seismo\oratoarc10.algis.sde
+            execute = sdeConn.execute
+
+    # seismoprofiles spatialReference, cached
+    with seismometrics.phase('sr'):
+        workWkid = profilesWkid(execute)
+        env.outputCoordinateSystem = seismoproj.spatialReference(workWkid)
 
     # input
     fsetTxt = arcpy.GetParameterAsText(0) # Feature Set
-    log.info("arcpyStuff, input polygons text '%s'" % fsetTxt)
+    seismolog.logPayload(log, "arcpyStuff, input polygons text '%s'", fsetTxt)
     fsetObj = arcpy.GetParameter(0)
     log.info("arcpyStuff, input polygons obj '%s'" % (fsetObj)) # geoprocessing record set object (FeatureSet)
 
     # parse input
     # don't work anyway, may be cutted off freely
-    fsetDesc = arcpy.Describe(fsetObj)
-    if hasattr(fsetDesc, 'ShapeFieldName'):
-        log.info("arcpyStuff, input fset ShapeFieldName '%s'" % fsetDesc.ShapeFieldName)  # haven't
-    else:
-        log.info("arcpyStuff, input fset ShapeFieldName are not accessible")
-    if hasattr(fsetDesc, 'spatialReference'):
-        log.info("arcpyStuff, input fset spatialReference '%s'" % fsetDesc.spatialReference) # haven't
-    else:
-        log.info("arcpyStuff, input fset spatialReference are not accessible")
-
-    # search cursor
-    geomWkt = '' # (70 70, 71 72, 85 65, 70 70), (...)
-    workSR = sr # decimal degree good for Oracle
-    rows = arcpy.SearchCursor(fsetObj, '', workSR)
-
-    for row in rows: # for each polygon
-        geom = row.shape
-        # debug output
-        arcpy.AddMessage("%s arcpyStuff, input geom '%s'" % (ts(), geom.__geo_interface__))
-        # geometry type 'polygon', area '-218254081896.0', parts '0'
-        log.info("arcpyStuff searchcursor, geometry type '%s', area '%s', parts '%s'" % (geom.type, geom.area, geom.partCount))
-        # {'type': 'Polygon', 'coordinates': []}
-        log.info("arcpyStuff searchcursor, geometry geojson '%s'" % (geom.__geo_interface__))
-        if hasattr(geom, 'spatialReference'):
-            log.info("arcpyStuff searchcursor, geometry spatialReference '%s'" % (geom.spatialReference)) # haven't
+    with seismometrics.phase('describe'):
+        fsetDesc = arcpy.Describe(fsetObj)
+        if hasattr(fsetDesc, 'ShapeFieldName'):
+            log.info("arcpyStuff, input fset ShapeFieldName '%s'" % fsetDesc.ShapeFieldName)  # haven't
         else:
-            log.info("arcpyStuff searchcursor, geometry spatialReference are not accessible")
-
-        # todo: gemetry.simplify on server
-        # http://help.arcgis.com/en/arcgisdesktop/10.0/help/index.html#/Repair_Geometry/00170000003v000000/
-        # http://help.arcgis.com/en/arcgisdesktop/10.0/help/index.html#//007000000011000000
-        if geom.partCount <= 0 or geom.area <=0:
-            raise NameError("Wrong input polygon, you should send no selfintersected clockwise drawed single ring")
-
-        for part in geom:
-            log.info("arcpyStuff searchcursor, geometry part, len '%s'" % (len(part)))
-            partWkt = ''
-            for pnt in part:
-                pntWkt = '%.15f %.15f' % (pnt.X, pnt.Y) # decimal degree precision
-                if partWkt == '':
-                    partWkt = pntWkt
-                else:
-                    partWkt = '%s, %s' % (partWkt, pntWkt)
-            partWkt = '(%s)' % partWkt
-
-            if geomWkt == '':
-                geomWkt = '%s' % partWkt
-            else:
-                geomWkt = '%s, %s' % (geomWkt, partWkt)
+            log.info("arcpyStuff, input fset ShapeFieldName are not accessible")
+        if hasattr(fsetDesc, 'spatialReference'):
+            log.info("arcpyStuff, input fset spatialReference '%s'" % fsetDesc.spatialReference) # haven't
+        else:
+            log.info("arcpyStuff, input fset spatialReference are not accessible")
 
-        break # only one polygon we need
-    # end for each polygon
+    # rings in seismoprofiles SR
+    with seismometrics.phase('cursor'):
+        # rings for cache key and Oracle; zero-part geometry (counterclockwise, self-intersected) repaired
+        rings = seismorepair.fsetRings(fsetObj, fsetTxt, workWkid, log)
+        log.info("arcpyStuff searchcursor, rings '%s', vertices '%s'" % (len(rings), sum(len(r) for r in rings)))
+    seismometrics.count('vertices', sum(len(r) for r in rings))
 
-    log.info("arcpyStuff, input SR WKID '%s', geom WKT '%s'" % (workSR.factoryCode, geomWkt))
+    log.info("arcpyStuff, work SR WKID '%s'" % (workWkid))
     arcpy.AddMessage("%s input parsed" % ts())
 
-    # send query to Oracle
-    # http://help.arcgis.com/en/arcgisdesktop/10.0/help/index.html#/ArcSDESQLExecute/000v00000057000000/
-    sql = r'''select %s('%s', %s) as calcres from DUAL''' % (oraFuncName, geomWkt, workSR.factoryCode)
-    #~ sql = r'''select sr_name, srid, cs_id from sde.st_spatial_references where cs_id in (3857, 102100, 4326)'''
-
-    sdeConn = arcpy.ArcSDESQLExecute(os.path.join(toolDirPath, oraSdeFName)) # \\cache\MXD\seismo\oratoarc10.algis.sde
-    log.info("arcpyStuff, sql [%s]" % (sql))
-    sdeReturn = sdeConn.execute(sql)
-    # ora result '    .068,       7154.117,     104761.243', resType 'unicode'
-    log.info("arcpyStuff, ora result '%s', resType '%s'" % (sdeReturn, type(sdeReturn).__name__))
-    arcpy.AddMessage("%s ora query executed" % ts())
-
-    # check the result, expecting string
-    if isinstance(sdeReturn, str) or type(sdeReturn) == unicode:
-        log.info("arcpyStuff, ora return string '%s'" % (sdeReturn.strip()))
-    elif isinstance(sdeReturn, list):
-        log.info("arcpyStuff, ora return %s rows" % (len(sdeReturn)))
-        for row in sdeReturn:
-            log.info("arcpyStuff, row '%s'" % (row))
-        raise NameError("Oracle return array instead of string")
+    # results cache, key from polygon in seismoprofiles SR
+    cacheFile = ''
+    if cacheFName:
+        cacheFile = os.path.join(toolDirPath, cacheFName)
+    with seismometrics.phase('stamp'):
+        stamp = profilesStamp(execute)
+    with seismometrics.phase('cache'):
+        cache = seismocache.getCache('sql', stamp, cacheFile, log)
+        cacheKey = seismocache.polygonKey(rings, workWkid)
+        resArr = cache.get(cacheKey)
+    seismometrics.setValue('cache', resArr is None and 'miss' or 'hit')
+    if resArr is not None:
+        log.info("arcpyStuff, cache hit '%s', result '%s'" % (cacheKey, resArr))
+    elif pool is not None:
+        funcName = seismodb.bindFuncName
+        if oraGeomFormat == 'wkt':
+            funcName = seismodb.wktFuncName
+        seismometrics.setValue('engine', 'oracle-' + oraGeomFormat)
+        with seismometrics.phase('oracle'):
+            resArr = seismodb.calcDensity(pool, rings, workWkid, funcName, oraGeomFormat)
+        log.info("arcpyStuff, ora result '%s'" % (resArr, ))
+        arcpy.AddMessage("%s ora query executed" % ts())
+        cache.put(cacheKey, resArr)
+        seismocache.saveCache(cache, log)
     else:
-        if sdeReturn == True: # DDL?
-            log.info("arcpyStuff, sql statement ran successfully")
+        with seismometrics.phase('wkt'):
+            geomWkt = seismodb.ringsWkt(rings) # (70 70, 71 72, 85 65, 70 70), (...)
+        sql = r'''select %s('%s', %s) as calcres from DUAL''' % (oraFuncName, geomWkt, workWkid)
+        #~ sql = r'''select sr_name, srid, cs_id from sde.st_spatial_references where cs_id in (3857, 102100, 4326)'''
+        seismolog.logPayload(log, "arcpyStuff, sql [%s]", sql)
+        seismometrics.setValue('engine', 'oracle-sde')
+        with seismometrics.phase('oracle'):
+            sdeReturn = sdeConn.execute(sql)
+        # ora result '    .068,       7154.117,     104761.243', resType 'unicode'
+        log.info("arcpyStuff, ora result '%s', resType '%s'" % (sdeReturn, type(sdeReturn).__name__))
+        arcpy.AddMessage("%s ora query executed" % ts())
+
+        # check the result, expecting string
+        if isinstance(sdeReturn, str) or type(sdeReturn) == unicode:
+            log.info("arcpyStuff, ora return string '%s'" % (sdeReturn.strip()))
+        elif isinstance(sdeReturn, list):
+            log.info("arcpyStuff, ora return %s rows" % (len(sdeReturn)))
+            for row in sdeReturn:
+                log.info("arcpyStuff, row '%s'" % (row))
+            raise NameError("Oracle return array instead of string")
         else:
-            log.info("arcpyStuff, error, sql statement FAILED")
-        raise NameError("Oracle return nor array nor string")
+            if sdeReturn == True: # DDL?
+                log.info("arcpyStuff, sql statement ran successfully")
+            else:
+                log.info("arcpyStuff, error, sql statement FAILED")
+            raise NameError("Oracle return nor array nor string")
 
-    # output
-    resData = sdeReturn.split(',')
-    resArr = []
-    for item in resData:
-        resArr.append('%.3f' % float(item))
+        resArr = seismodb.parseResult(sdeReturn)
+        cache.put(cacheKey, resArr)
+        seismocache.saveCache(cache, log)
 
-    arcpy.SetParameterAsText(1, resArr[0]) # Seismodensity double
-    arcpy.SetParameterAsText(2, resArr[1]) # SeismorofilesLength double
-    arcpy.SetParameterAsText(3, resArr[2]) # ShapeArea double
+    # output
+    arcpy.SetParameterAsText(1, '%.3f' % resArr[0]) # Seismodensity double
+    arcpy.SetParameterAsText(2, '%.3f' % resArr[1]) # SeismorofilesLength double
+    arcpy.SetParameterAsText(3, '%.3f' % resArr[2]) # ShapeArea double
 
     arcpy.AddMessage("%s processing done" % ts())
     # http://help.arcgis.com/en/arcgisdesktop/10.0/help/index.html#/Writing_messages_in_script_tools/00150000000p000000/
@@ -278,10 +367,13 @@ def main(note=''):
     log.info('start, argv: %s, note "%s"' % (argv, note))
 
     import arcpy
+    job = seismometrics.startJob('sql')
+    error = None
     try:
         # geoprocessor tool script
         arcpyStuff()
     except Exception, e:
+        error = e
         arcpy.AddError('Toolbox had failed try')
         arcpy.AddError(e)
         if type(e).__name__ == 'COMError':
@@ -290,8 +382,8 @@ def main(note=''):
             log.exception('main, error, program failed')
             raise
     finally:
-        log.info('End Of Program, logging shutdown')
-        logging.shutdown()
+        job.finish(metricsFilename, log, error)
+        log.info('End Of Program') # queued records written by seismolog thread, rest at process exit
 #def main():
 
 
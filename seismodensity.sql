@@ -19,31 +19,26 @@ ALTER USER "ALGIS"
 commit;
 
 
--- create function. Use algis account
-drop function algis.calc_seismodensity;
+-- create functions. Use algis account
+-- density for polygon already transformed into profiles SR, shared by calc_seismodensity* functions
 create or replace
-function  algis.calc_seismodensity(poly varchar2, poly_wkid number)
+function  algis.calc_seismodensity_geom(poly_geom "SDE"."ST_GEOMETRY")
     return varchar2 -- плотность, суммарная длина профилей в участке, площадь участка
 as
--- Процедура расчета плотности сейсмопрофилей на заданном полигоне;
--- для работы необходимо наличие фичекласса с сейсмопрофилями ALGIS.APP_GP_SEISM2D_L в СК где единицы измерений в метрах
--- также необходимо наличие используемых poly_wkid, суть WKID и соответствующих им SRID в реестре SDE sde.st_spatial_references;
--- проверить работоспособность функции можно запросом
--- select algis.calc_seismodensity('(70 70, 71 72, 85 65, 70 70)', 4326) as calcres from dual;
     res varchar2(100);
     len_km number;
     area_kmsq number;
     dens number;
-    profiles_srid number;
-    poly_srid number;
-    poly_geom "SDE"."ST_GEOMETRY"; -- from WKT polygon, http://en.wikipedia.org/wiki/Well-known_text
+    poly_minx number; poly_miny number; poly_maxx number; poly_maxy number;
 begin
-    select srid into profiles_srid from sde.st_geometry_columns where table_name like 'APP_GP_SEISM2D_L';
-    select srid into poly_srid from sde.st_spatial_references where cs_id = poly_wkid and rownum < 2;
-    select sde.st_transform (sde.st_polygon('polygon (' || poly || ')', poly_srid), profiles_srid) into poly_geom from dual;
+    select sde.st_minx(poly_geom), sde.st_miny(poly_geom), sde.st_maxx(poly_geom), sde.st_maxy(poly_geom)
+        into poly_minx, poly_miny, poly_maxx, poly_maxy from dual;
 --~ найти длины отрезков профилей, попадающих внутрь полигона:
+--~ st_envintersects по экстенту полигона отбирает кандидатов через пространственный индекс, st_disjoint только для них
     select ( sum (sde.st_length (sde.st_intersection (poly_geom, sp.shape))) / 1000 ) into len_km
-        from ALGIS.APP_GP_SEISM2D_L sp	where sde.st_disjoint(poly_geom, sp.shape) = 0;
+        from ALGIS.APP_GP_SEISM2D_L sp
+        where sde.st_envintersects(sp.shape, poly_minx, poly_miny, poly_maxx, poly_maxy) = 1
+            and sde.st_disjoint(poly_geom, sp.shape) = 0;
     if len_km is null then
         len_km := 0;
     end if;
@@ -64,5 +59,186 @@ end;
 /
 commit;
 
+-- SRID lookups cached in package state, it lives as long as session (pooled connection);
+-- set-based batch: polygons staged into temporary table, density for all of them in one statement.
+-- seismodb.calcDensityBatch inserts polygons by one executemany, then
+-- select poly_id, dens, len_km, area_kmsq from table(algis.seismodens_pkg.calc_batch) order by poly_id;
+create global temporary table algis.seismodens_poly (
+    poly_id number primary key,
+    poly blob, -- WKB polygon
+    poly_wkid number
+) on commit delete rows;
+
+create or replace type algis.seismodens_row as object (
+    poly_id number, dens number, len_km number, area_kmsq number); -- km/km^2, km, km^2
+/
+create or replace type algis.seismodens_tab as table of algis.seismodens_row;
+/
+
+create or replace package algis.seismodens_pkg as
+    function profiles_srid return number;
+    function profiles_wkid return number;
+    function poly_srid(wkid number) return number;
+    function poly_geom(poly blob, wkid number) return "SDE"."ST_GEOMETRY";
+    function calc_batch return algis.seismodens_tab pipelined;
+end seismodens_pkg;
+/
+create or replace package body algis.seismodens_pkg as
+    type srid_map is table of number index by pls_integer;
+    g_profiles_srid number;
+    g_profiles_wkid number;
+    g_srids srid_map;
+
+    function profiles_srid return number is
+    begin
+        if g_profiles_srid is null then
+            select srid into g_profiles_srid from sde.st_geometry_columns where table_name like 'APP_GP_SEISM2D_L';
+        end if;
+        return g_profiles_srid;
+    end;
+
+--~ WKID профилей: seismodensity.py переводит полигон сразу в СК профилей, st_transform не нужен
+    function profiles_wkid return number is
+    begin
+        if g_profiles_wkid is null then
+            select cs_id into g_profiles_wkid from sde.st_spatial_references where srid = profiles_srid and rownum < 2;
+        end if;
+        return g_profiles_wkid;
+    end;
+
+    function poly_srid(wkid number) return number is
+    begin
+        if not g_srids.exists(wkid) then
+            select srid into g_srids(wkid) from sde.st_spatial_references where cs_id = wkid and rownum < 2;
+        end if;
+        return g_srids(wkid);
+    end;
+
+--~ WKB полигон в СК профилей, st_transform только если полигон в другой СК
+    function poly_geom(poly blob, wkid number) return "SDE"."ST_GEOMETRY" is
+        p_srid number := poly_srid(wkid);
+        geom "SDE"."ST_GEOMETRY";
+    begin
+        geom := sde.st_polyfromwkb(poly, p_srid);
+        if p_srid <> profiles_srid then
+            geom := sde.st_transform(geom, profiles_srid);
+        end if;
+        return geom;
+    end;
+
+    function calc_batch return algis.seismodens_tab pipelined is
+        area_kmsq number;
+    begin
+--~ все полигоны из seismodens_poly одним запросом: отбор кандидатов по экстенту, пересечение, сумма по полигону
+        for r in (
+            select pg.poly_id, pg.area_m2,
+                nvl(sum(sde.st_length(sde.st_intersection(pg.geom, sp.shape))), 0) / 1000 as len_km
+            from (
+                select /*+ no_merge */ t.poly_id, t.geom, sde.st_area(t.geom) as area_m2,
+                    sde.st_minx(t.geom) as minx, sde.st_miny(t.geom) as miny,
+                    sde.st_maxx(t.geom) as maxx, sde.st_maxy(t.geom) as maxy
+                from (
+                    select /*+ no_merge */ p.poly_id,
+                        algis.seismodens_pkg.poly_geom(p.poly, p.poly_wkid) as geom
+                    from algis.seismodens_poly p
+                ) t
+            ) pg
+            left join ALGIS.APP_GP_SEISM2D_L sp
+                on sde.st_envintersects(sp.shape, pg.minx, pg.miny, pg.maxx, pg.maxy) = 1
+                and sde.st_disjoint(pg.geom, sp.shape) = 0
+            group by pg.poly_id, pg.area_m2
+        ) loop
+            area_kmsq := r.area_m2 / 1000000;
+            if area_kmsq is null or area_kmsq = 0 then
+                area_kmsq := 0.0000001;
+            end if;
+            pipe row (algis.seismodens_row(r.poly_id, r.len_km / area_kmsq, r.len_km, area_kmsq));
+        end loop;
+        return;
+    end;
+end seismodens_pkg;
+/
+commit;
+
+drop function algis.calc_seismodensity;
+create or replace
+function  algis.calc_seismodensity(poly varchar2, poly_wkid number)
+    return varchar2 -- плотность, суммарная длина профилей в участке, площадь участка
+as
+-- Процедура расчета плотности сейсмопрофилей на заданном полигоне;
+-- для работы необходимо наличие фичекласса с сейсмопрофилями ALGIS.APP_GP_SEISM2D_L в СК где единицы измерений в метрах
+-- также необходимо наличие используемых poly_wkid, суть WKID и соответствующих им SRID в реестре SDE sde.st_spatial_references;
+-- проверить работоспособность функции можно запросом
+-- select algis.calc_seismodensity('(70 70, 71 72, 85 65, 70 70)', 4326) as calcres from dual;
+    profiles_srid number;
+    poly_srid number;
+    poly_geom "SDE"."ST_GEOMETRY"; -- from WKT polygon, http://en.wikipedia.org/wiki/Well-known_text
+begin
+    select srid into profiles_srid from sde.st_geometry_columns where table_name like 'APP_GP_SEISM2D_L';
+    select srid into poly_srid from sde.st_spatial_references where cs_id = poly_wkid and rownum < 2;
+    select sde.st_polygon('polygon (' || poly || ')', poly_srid) into poly_geom from dual;
+    if poly_srid <> profiles_srid then
+        select sde.st_transform (poly_geom, profiles_srid) into poly_geom from dual;
+    end if;
+    return algis.calc_seismodensity_geom(poly_geom);
+end;
+/
+commit;
+
+-- same as calc_seismodensity, polygon rings as CLOB, for bind variable calls (seismodb.py):
+-- one statement text for all polygons, no hard parse per call, no 4000 chars limit
+-- select algis.calc_seismodensity_wkt(:poly, :wkid) as calcres from dual;
+create or replace
+function  algis.calc_seismodensity_wkt(poly clob, poly_wkid number)
+    return varchar2
+as
+    profiles_srid number := algis.seismodens_pkg.profiles_srid;
+    poly_srid number := algis.seismodens_pkg.poly_srid(poly_wkid);
+    poly_geom "SDE"."ST_GEOMETRY";
+begin
+    select sde.st_polygon('polygon (' || poly || ')', poly_srid) into poly_geom from dual;
+    if poly_srid <> profiles_srid then
+        select sde.st_transform (poly_geom, profiles_srid) into poly_geom from dual;
+    end if;
+    return algis.calc_seismodensity_geom(poly_geom);
+end;
+/
+commit;
+
+-- same as calc_seismodensity, polygon as WKB BLOB (little endian Polygon), for bind variable calls (seismodb.py)
+-- select algis.calc_seismodensity_wkb(:poly, :wkid) as calcres from dual;
+create or replace
+function  algis.calc_seismodensity_wkb(poly blob, poly_wkid number)
+    return varchar2
+as
+begin
+    return algis.calc_seismodensity_geom(algis.seismodens_pkg.poly_geom(poly, poly_wkid));
+end;
+/
+commit;
+
 grant EXECUTE on "ALGIS"."CALC_SEISMODENSITY" to "ALGIS" ;
+grant EXECUTE on "ALGIS"."CALC_SEISMODENSITY_GEOM" to "ALGIS" ;
+grant EXECUTE on "ALGIS"."CALC_SEISMODENSITY_WKT" to "ALGIS" ;
+grant EXECUTE on "ALGIS"."CALC_SEISMODENSITY_WKB" to "ALGIS" ;
+grant EXECUTE on "ALGIS"."SEISMODENS_PKG" to "ALGIS" ;
+grant EXECUTE on "ALGIS"."SEISMODENS_TAB" to "ALGIS" ;
+grant SELECT, INSERT, DELETE on "ALGIS"."SEISMODENS_POLY" to "ALGIS" ;
+
+
+-- seismoprofiles data version, for results cache invalidation in seismodensity.py
+-- select algis.seismoprofiles_stamp as stamp from dual;
+create or replace
+function  algis.seismoprofiles_stamp
+    return varchar2
+as
+    res varchar2(100);
+begin
+    select to_char(max(ora_rowscn)) || '-' || to_char(count(*)) into res from ALGIS.APP_GP_SEISM2D_L;
+    return res;
+end;
+/
+commit;
+
+grant EXECUTE on "ALGIS"."SEISMOPROFILES_STAMP" to "ALGIS" ;
 -- grant EXECUTE on "ALGIS"."CALC_SEISMODENSITY" to "SDE" ;
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# (c) Valik mailto:vasnake@gmail.com
+
+'''
+ArcGIS Toolbox tool script for Seismodensity project, batch mode
+
+Input: GPFeatureRecordSetLayer or GPFeatureLayer
+    inputPolygons - many polygons, FeatureSet or FeatureClass
+
+Output: DETable
+    outputTable - one row per input polygon:
+        IN_FID long - input feature OBJECTID
+        SEISMODENS double - km/km2
+        PROFLEN double - km
+        SHAPEAREA double - km2
+    Wrong polygon gives -1.0 values in its row.
+
+All polygons processed in one run with one loaded seismoprofiles set and one spatial index,
+see seismodensitynosql.py for constants and input polygon requirements.
+Layer of joinMinPolygons polygons or more scored by partitioned join (seismojoin.py):
+profiles split by one grid for all polygons, no clip per polygon of all its candidates.
+
+Constants
+    batchEngine - 'nosql': in-process clip or join over gdb profiles (seismodensitynosql.py constants);
+        'oracle': one set-based query seismodens_pkg.calc_batch (seismodensity.oraDensityBatch,
+        seismodensity.py constants for Oracle connection, pooled cx_Oracle only)
+'''
+
+
+import time, traceback
+import sys, string, os
+import logging
+
+import seismoclip
+import seismojoin
+import seismoproj
+import seismodb
+import seismodensity as sqltool
+import seismodensitynosql as nosql
+from seismodensitynosql import log, ts, setLogger, cp
+
+outFields = ('IN_FID', 'SEISMODENS', 'PROFLEN', 'SHAPEAREA')
+joinMinPolygons = 16 # polygons count for seismojoin instead of clip by index for each polygon
+batchEngine = 'nosql'
+
+
+def readPolygons(inObj, workSR):
+    ''' Yield (oid, rings) for each input polygon, coords in workSR
+    '''
+    rows = arcpy.SearchCursor(inObj, '', workSR)
+    num = 0
+    for row in rows:
+        num += 1
+        try:
+            oid = row.getValue(seismoclip.oidFieldName)
+        except Exception:
+            oid = num # FeatureSet may have no OBJECTID
+        geom = row.shape
+        if geom is None:
+            yield (oid, [])
+        else:
+            yield (oid, seismoclip.geometryRings(geom))
+    del rows
+#def readPolygons(inObj, workSR):
+
+
+def writeTable(tablePath, results):
+    ''' Create output table and insert (oid, density, length, area) rows
+    '''
+    outDir, outName = os.path.split(tablePath)
+    if arcpy.Exists(tablePath):
+        arcpy.Delete_management(tablePath)
+    arcpy.CreateTable_management(outDir, outName)
+    arcpy.AddField_management(tablePath, outFields[0], 'LONG')
+    for fn in outFields[1:]:
+        arcpy.AddField_management(tablePath, fn, 'DOUBLE')
+    rows = arcpy.InsertCursor(tablePath)
+    for res in results:
+        row = rows.newRow()
+        for fn, val in zip(outFields, res):
+            row.setValue(fn, val)
+        rows.insertRow(row)
+    del rows
+#def writeTable(tablePath, results):
+
+
+def arcpyStuff():
+    ''' Geoprocessor main program, batch mode.
+
+    In/out parameters
+    inObj = arcpy.GetParameter(0) # featureset or featureclass
+    tablePath = arcpy.GetParameterAsText(1) # output table
+
+    Load seismoprofiles and spatial index once (Oracle engine: connection pool and profiles WKID);
+    read all input polygons in seismoprofiles SR;
+    calc density for each polygon (seismoclip.calcDensityBatch, seismojoin.joinDensity for large layer,
+    seismodensity.oraDensityBatch for Oracle engine);
+    write results table.
+    '''
+
+    from arcpy import env
+    arcpy.AddMessage("%s seismodensitybatch processing started" % ts())
+
+    if batchEngine == 'oracle':
+        pool = seismodb.getPool(os.path.join(sqltool.toolDirPath, sqltool.oraConnFName), log)
+        if pool is None:
+            raise NameError("Oracle batch needs cx_Oracle and connect file '%s'" % sqltool.oraConnFName)
+        workWkid = sqltool.profilesWkid(lambda sql: seismodb.queryValue(pool, sql))
+    else:
+        profiles, index = nosql.loadEngine()
+        header = getattr(profiles, 'header', None) # no store header if loadStore fell back to seismoclip.loadProfiles
+        if header and header.get('wkid'):
+            workWkid = header['wkid'] # store is fresh after loadEngine, no Describe
+        else:
+            workWkid = nosql.profilesWkid()
+    workSR = seismoproj.spatialReference(workWkid)
+    env.outputCoordinateSystem = workSR
+
+    inObj = arcpy.GetParameter(0)
+    tablePath = arcpy.GetParameterAsText(1)
+    log.info("arcpyStuff batch, input '%s', output table '%s'" % (arcpy.GetParameterAsText(0), tablePath))
+
+    polygons = list(readPolygons(inObj, workSR))
+    log.info("arcpyStuff batch, engine '%s', polygons '%s'" % (batchEngine, len(polygons)))
+    if batchEngine == 'oracle':
+        results = sqltool.oraDensityBatch(polygons, workWkid)
+    elif len(polygons) >= joinMinPolygons:
+        results = seismojoin.joinDensity(profiles, polygons, log)
+    else:
+        results = seismoclip.calcDensityBatch(profiles, polygons, index, log)
+    log.info("arcpyStuff batch, '%s' polygons processed" % (len(results)))
+    arcpy.AddMessage("%s %s polygons processed" % (ts(), len(results)))
+
+    writeTable(tablePath, results)
+    arcpy.SetParameterAsText(1, tablePath)
+    arcpy.AddMessage("%s processing done" % ts())
+#def arcpyStuff():
+
+
+def main(note=''):
+    argc = len(sys.argv)
+    argv = sys.argv
+    print >> sys.stderr, 'argc: [%s], argv: [%s]' % (argc, argv)
+
+    # log setup
+    setLogger(log)
+    log.info('start batch, argv: %s, note "%s"' % (argv, note))
+
+    import arcpy
+    try:
+        # geoprocessor tool script
+        arcpyStuff()
+    except Exception, e:
+        arcpy.AddError('Toolbox had failed try')
+        arcpy.AddError(e)
+        if type(e).__name__ == 'COMError':
+            log.error('main, COM error, msg [%s]' % e)
+        else:
+            log.exception('main, error, program failed')
+            raise
+    finally:
+        log.info('End Of Program') # queued records written by seismolog thread, rest at process exit
+#def main():
+
+
+if __name__ == "__main__":
+    import time, traceback
+    print time.strftime('%Y-%m-%d %H:%M:%S')
+
+    try:
+        # run program
+        main()
+        print u'Если это видно, сбоев нет'.encode(cp)
+    except Exception, e:
+        if type(e).__name__ == 'COMError':
+            print 'COM error, msg [%s]' % e
+        else:
+            print 'Error, program failed:'
+            traceback.print_exc(file=sys.stderr)
+
+    print time.strftime('%Y-%m-%d %H:%M:%S')
+# end main
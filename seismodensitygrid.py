@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# (c) Valik mailto:vasnake@gmail.com
+
+'''
+ArcGIS Toolbox tool script for Seismodensity project, density grid
+
+Input:
+    gridExtent GPExtent - grid extent, in grid SR units
+    cellSize GPDouble - cell size, meters
+    gridSR GPSpatialReference - grid SR, projected with meters units; optional, seismoprofiles SR by default
+
+Output: DERasterDataset
+    outputRaster - seismodensity km/km2 per cell;
+    '.npy' (NumPy array) and '.asc' (ESRI ASCII grid) written w/o arcpy, other formats by NumPyArrayToRaster
+
+Grid computed in one pass over seismoprofiles segments (seismogrid.densityGrid),
+not one clip per cell. See seismodensitynosql.py for constants.
+'''
+
+
+import time, traceback
+import sys, string, os
+import logging
+
+import seismoclip
+import seismogrid
+import seismodensitynosql as nosql
+from seismodensitynosql import log, ts, setLogger, cp
+
+
+def arcpyStuff():
+    ''' Geoprocessor main program, density grid.
+
+    In/out parameters
+    extent = arcpy.GetParameterAsText(0) # 'xmin ymin xmax ymax'
+    cellSize = arcpy.GetParameter(1) # double
+    sr = arcpy.GetParameter(2) # SpatialReference or None
+    rasterPath = arcpy.GetParameterAsText(3) # output raster
+
+    Load seismoprofiles in grid SR;
+    walk all segments through grid cells, sum length per cell;
+    save km/km2 array as raster.
+    '''
+
+    arcpy.AddMessage("%s seismodensitygrid processing started" % ts())
+
+    extent = [float(x) for x in arcpy.GetParameterAsText(0).replace(',', '.').split()[:4]]
+    cellSize = float(arcpy.GetParameterAsText(1).replace(',', '.'))
+    sr = None
+    if arcpy.GetParameterAsText(2):
+        sr = arcpy.GetParameter(2)
+    rasterPath = arcpy.GetParameterAsText(3)
+    if cellSize <= 0:
+        raise NameError("Wrong cell size '%s', should be positive" % cellSize)
+    ncols, nrows = seismogrid.gridShape(extent, cellSize)
+    log.info("arcpyStuff grid, extent '%s', cell '%s', cols '%s', rows '%s', output '%s'" % (
+        extent, cellSize, ncols, nrows, rasterPath))
+
+    seisFCPath = os.path.join(nosql.toolDirPath, nosql.gdbFName, nosql.seisFCName)
+    profiles = seismoclip.loadProfiles(seisFCPath, sr=sr)
+    if sr is None:
+        sr = arcpy.Describe(seisFCPath).spatialReference
+    log.info("arcpyStuff grid, seismoprofiles loaded, segments '%s'" % (profiles.segmentCount()))
+    arcpy.AddMessage("%s seismoprofiles loaded" % ts())
+
+    grid = seismogrid.densityGrid(profiles, extent, cellSize)
+    log.info("arcpyStuff grid, density max '%s' km/km2, total length '%s' km" % (
+        grid.max(), grid.sum() * (cellSize / 1000.0) ** 2))
+
+    seismogrid.saveGrid(rasterPath, grid, extent, cellSize, sr)
+    arcpy.SetParameterAsText(3, rasterPath)
+    arcpy.AddMessage("%s processing done" % ts())
+#def arcpyStuff():
+
+
+def main(note=''):
+    argc = len(sys.argv)
+    argv = sys.argv
+    print >> sys.stderr, 'argc: [%s], argv: [%s]' % (argc, argv)
+
+    # log setup
+    setLogger(log)
+    log.info('start grid, argv: %s, note "%s"' % (argv, note))
+
+    import arcpy
+    try:
+        # geoprocessor tool script
+        arcpyStuff()
+    except Exception, e:
+        arcpy.AddError('Toolbox had failed try')
+        arcpy.AddError(e)
+        if type(e).__name__ == 'COMError':
+            log.error('main, COM error, msg [%s]' % e)
+        else:
+            log.exception('main, error, program failed')
+            raise
+    finally:
+        log.info('End Of Program') # queued records written by seismolog thread, rest at process exit
+#def main():
+
+
+if __name__ == "__main__":
+    import time, traceback
+    print time.strftime('%Y-%m-%d %H:%M:%S')
+
+    try:
+        # run program
+        main()
+        print u'Если это видно, сбоев нет'.encode(cp)
+    except Exception, e:
+        if type(e).__name__ == 'COMError':
+            print 'COM error, msg [%s]' % e
+        else:
+            print 'Error, program failed:'
+            traceback.print_exc(file=sys.stderr)
+
+    print time.strftime('%Y-%m-%d %H:%M:%S')
+# end main
@@ -7,17 +7,40 @@ ArcGIS Toolbox tool script for Seismodensity project
 
 Input: GPFeatureRecordSetLayer
     inputPolygon
+    tolerance (optional double, parameter #4) - relative profiles length error allowed,
+        approximate answer from length pyramid is good enough; empty - approxTolerance
+    filter (optional string, parameter #7) - only profiles passing attribute filter, e.g.
+        "YEAR >= 2005 and CREW in ('SMNG', 'MAGE')", syntax in seismofilter; fields must be in storeFields
+    breakdownField (optional string, parameter #8) - field for profiles length breakdown
 
 Output: double default -1.0
     seismoDens km/km2
     profilesLength km
     shapeArea km2
+    accuracy (optional string, parameter #5) - 'exact' or 'approximate'
+    profilesLengthError (optional double, parameter #6) - km, profilesLength error bound, 0 for exact answer
+    lengthBreakdown (optional string, parameter #9) - JSON {"breakdownField value": km, ...}
 
 Constants (line #97 and below)
     logFilename - file for log records
+    metricsFilename - file for jobs metrics, JSON line per job (seismometrics); empty string for log only
     toolDirPath - folder with gdb & other files
     gdbFName - gdb which contains seismoprofiles
     seisFCName - seismoprofiles FeatureClass
+    storeFName - seismoprofiles columnar store folder, next to gdb (seismostore)
+    storeFields - seismoprofiles attributes exported into store, for filter and breakdown
+    indexFName - seismoprofiles spatial index file, next to gdb
+    pyramidFName - seismoprofiles length pyramid file, next to gdb
+    pyramidMinCells - polygon envelope size (in pyramid leaf cells) to use pyramid instead of index
+    approxTolerance - tolerance if parameter is empty; 0 for exact answer
+    cacheFName - results cache file, next to gdb; empty string for memory only cache
+    serviceUrl - resident density service (seismoservice.py) URL; empty string to always compute in-process
+    serviceTimeout - seconds to wait for service answer before in-process computation
+    streamSource - dataset larger than memory (merged national archive): FeatureClass, .ndjson file
+        or store folder, store and NDJSON in seismoprofiles SR; density computed by one streaming pass
+        over it (seismostream), w/o service, index, pyramid, filter; empty string - gdb profiles as usual.
+        .compact.npz file (seismocompact.exportCompact) - compact profiles kept in memory between jobs,
+        7..13 bytes per vertex instead of 56, only parts near polygon decoded
 
 Before invoking tool you must prepare valid polygon without holes.
 That means no inner rings, no self intersections, clockwise draw direction.
@@ -92,13 +115,41 @@ testGlobal [two]...:
 
 import time, traceback
 import sys, string, os
+import json
 import logging
 
+import seismoclip
+import seismorepair
+import seismoproj
+import seismoindex
+import seismostore
+import seismodelta
+import seismopyramid
+import seismofilter
+import seismostream
+import seismocompact
+import seismocache
+import seismoservice
+import seismometrics
+import seismolog
+
 # global constants
 logFilename = r'''\\cache\MXD\seismo\seismodensity.geoproc.log'''
+logLevel = logging.INFO
+metricsFilename = r'''\\cache\MXD\seismo\seismodensity.metrics.jsonl'''
 toolDirPath = r'''\\cache\MXD\seismo'''
 gdbFName = r'''Seis_button.gdb'''
 seisFCName = r'''APP_GP_SEISM2D_L'''
+storeFName = seisFCName + seismostore.storeDirExt
+storeFields = ()
+indexFName = seisFCName + seismoindex.indexFileExt
+pyramidFName = seisFCName + seismopyramid.pyramidFileExt
+pyramidMinCells = 64
+approxTolerance = 0.0
+cacheFName = r'''seismodensitynosql.cache.pkl'''
+serviceUrl = seismoservice.serviceUrl
+serviceTimeout = 60
+streamSource = ''
 
 cp = 'utf-8'
 log = logging.getLogger('seismodens') # http://docs.python.org/library/logging.html
@@ -112,24 +163,104 @@ def setLogger(log):
     logrotate
     http://stackoverflow.com/questions/8467978/python-want-logging-with-log-rotation-and-compression
     http://docs.python.org/library/logging.handlers.html#rotatingfilehandler
+    Records written to rotating file (5 files up to 1 megabyte each) by background thread (seismolog),
+    job doesn't wait for network share; logLevel DEBUG - full input polygons and SQL in log.
     '''
-    log.setLevel(logging.DEBUG)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    if not hasattr(log, 'vFHandle'):
-        import logging.handlers as handlers
-        # 5 files up to 1 megabyte each
-        fh = handlers.RotatingFileHandler(logFilename, maxBytes=1000000, backupCount=5, encoding='utf-8')
-        #~ fh = handlers.TimedRotatingFileHandler(logFilename, backupCount=3, when='M', interval=3, encoding='utf-8',)
-        #~ fh = logging.FileHandler(logFilename)
-        #~ fh = logging.NullHandler()
-        fh.setLevel(logging.DEBUG)
-        fh.setFormatter(formatter)
-        log.addHandler(fh)
-        log.vFHandle = fh
+    seismolog.setupLogger(log, logFilename, logLevel)
     print 'Log configured. Look file [%s] for messages' % logFilename
 #def setLogger(log):
 
 
+def loadEngine():
+    ''' Return (profiles, index): seismoprofiles ProfileSet and segments spatial index.
+    Profiles memory mapped from columnar store; gdb changed: store, index and pyramid files
+    edited by seismodelta, store exported and index rebuilt if edit is not possible;
+    both cached for process lifetime.
+    '''
+    seisFCPath = os.path.join(toolDirPath, gdbFName, seisFCName)
+    storeDir = os.path.join(toolDirPath, storeFName)
+    indexFile = os.path.join(toolDirPath, indexFName)
+    stamp = seismoclip.dataStamp(os.path.join(toolDirPath, gdbFName))
+    log.info("loadEngine, load seismoprofiles from '%s'..." % (seisFCPath))
+    with seismometrics.phase('load'):
+        seismodelta.refreshStore(storeDir, seisFCPath, stamp, storeFields, indexFile,
+            os.path.join(toolDirPath, pyramidFName), log)
+        profiles = seismostore.loadStore(storeDir, seisFCPath, stamp, storeFields, log)
+        log.info("loadEngine, seismoprofiles loaded, parts '%s', vertices '%s'" % (profiles.partCount, profiles.vertexCount))
+        index = seismoindex.loadOrBuild(indexFile, profiles, stamp, log)
+    return profiles, index
+#def loadEngine():
+
+
+def profilesWkid():
+    ''' Seismoprofiles SR WKID: from store header if store is built for current gdb,
+    FeatureClass Describe otherwise
+    '''
+    header = seismostore.readHeader(os.path.join(toolDirPath, storeFName))
+    if header and header.get('wkid') and header['stamp'] == seismoclip.dataStamp(os.path.join(toolDirPath, gdbFName)):
+        return header['wkid']
+    import arcpy
+    return arcpy.Describe(os.path.join(toolDirPath, gdbFName, seisFCName)).spatialReference.factoryCode
+#def profilesWkid():
+
+
+@seismometrics.timed('clip')
+def profilesLength(profiles, index, rings):
+    ''' Profiles length inside polygon, meters.
+    Small polygon: clip index candidates; large polygon: length pyramid,
+    exact clip only in boundary cells. Pyramid loaded (or built) at first large polygon.
+    '''
+    return seismopyramid.profilesLength(profiles, index, rings, os.path.join(toolDirPath, pyramidFName),
+        seismoclip.dataStamp(os.path.join(toolDirPath, gdbFName)), pyramidMinCells, log)
+#def profilesLength(profiles, index, rings):
+
+
+@seismometrics.timed('estimate')
+def approxLength(profiles, index, rings, tolerance):
+    ''' (length, error) meters, profiles length inside polygon with error <= tolerance * length.
+    Large polygon: length pyramid estimate, no clip; small polygon - exact, error 0.
+    '''
+    return seismopyramid.approxLength(profiles, index, rings, tolerance, os.path.join(toolDirPath, pyramidFName),
+        seismoclip.dataStamp(os.path.join(toolDirPath, gdbFName)), pyramidMinCells, log)
+#def approxLength(profiles, index, rings, tolerance):
+
+
+@seismometrics.timed('clip')
+def filteredLength(profiles, index, rings, filterText, breakdown):
+    ''' (length, parts) meters, length inside polygon of profiles passing attribute filter
+    and breakdown field value => length (seismofilter)
+    '''
+    mask = seismofilter.partsMask(profiles, filterText)
+    return seismofilter.filteredLength(profiles, index, rings, mask, breakdown, log=log)
+#def filteredLength(profiles, index, rings, filterText, breakdown):
+
+
+@seismometrics.timed('clip')
+def streamLength(rings, wkid):
+    ''' Profiles length inside polygon, meters, streaming pass over streamSource chunks,
+    FeatureClass read in wkid SR; compact profiles file - parts near polygon decoded from memory
+    '''
+    if streamSource.lower().endswith(seismocompact.compactFileExt):
+        seismometrics.setValue('engine', 'compact')
+        return seismocompact.loadCompact(streamSource).clippedLength(rings)
+    seismometrics.setValue('engine', 'stream')
+    sr = None
+    if not os.path.isdir(streamSource) and os.path.splitext(streamSource)[1].lower() not in seismostream.ndjsonExts:
+        sr = seismoproj.spatialReference(wkid)
+    return seismostream.streamLength(seismostream.openSource(streamSource, sr=sr), rings)
+#def streamLength(rings, wkid):
+
+
+def streamStamp():
+    ''' Data stamp of streamSource: file, folder or gdb of FeatureClass
+    '''
+    path = streamSource
+    while path and not os.path.exists(path):
+        path = os.path.dirname(path)
+    return seismoclip.dataStamp(path)
+#def streamStamp():
+
+
 def arcpyStuff():
     ''' Geoprocessor main program.
 
@@ -138,16 +269,31 @@ def arcpyStuff():
     arcpy.SetParameterAsText(1, x) # Seismodensity double, km/km2
     arcpy.SetParameterAsText(2, y) # SeismorofilesLength double, km
     arcpy.SetParameterAsText(3, z) # ShapeArea double, km2
-
-    Get spatialReference from seismoprofiles GDB FeatureClass;
-    GP.Clip seismoprofiles by input polygon into temp FeatureClass;
-    Sum length of clipped seismoprofiles;
-    Get input polygon area;
+    tolerance = arcpy.GetParameter(4) # optional double, relative length error
+    arcpy.SetParameterAsText(5, a) # optional accuracy string, 'exact' or 'approximate'
+    arcpy.SetParameterAsText(6, e) # optional profilesLengthError double, km
+    filterText = arcpy.GetParameterAsText(7) # optional attribute filter string
+    breakdown = arcpy.GetParameterAsText(8) # optional breakdown field name
+    arcpy.SetParameterAsText(9, b) # optional lengthBreakdown JSON string
+
+    Get seismoprofiles SR WKID from service, store header or GDB FeatureClass;
+    Load seismoprofiles vertices into NumPy arrays (seismostore.loadStore, memory mapped, cached per process);
+    Load seismoprofiles segments spatial index (seismoindex.loadOrBuild);
+    Large polygon: load length pyramid (seismopyramid.loadOrBuild), clip only boundary cells;
+    Get input polygon rings in seismoprofiles SR (seismoproj, cached transformer) and area;
+    Return cached result if the same polygon was processed already for current gdb (seismocache),
+    service answer cached only if service store stamp is current gdb stamp;
+    Sum length of seismoprofiles clipped by input polygon (seismoclip engine, no scratch FeatureClass),
+    or estimate it from length pyramid if tolerance allows (seismopyramid.approxLength, not cached);
+    Attribute filter or breakdown: exact length of filtered profiles only, spatial index candidates
+    intersected with attribute bitmaps (seismofilter), w/o pyramid;
+    streamSource set: length summed by one pass over it by chunks (seismostream), memory bounded by chunk size;
     Calc seismodensity.
 
     We have problems with invalid geometry - interior rings (counterclockwise draw direction).
     If you draw polygon counterclockwise and send that to script, you get zeropart polygon.
-    In that case you should use Geometry.Simplify geoservice http://tasks.arcgisonline.com/ArcGIS/rest/services/Geometry/GeometryServer/simplify.
+    Then polygon rings taken from FeatureSet JSON and repaired in the tool (seismorepair):
+    orientation, closing, duplicate vertices, self-intersections; no Geometry.Simplify call needed.
     Extra info:
     http://gis.stackexchange.com/questions/10201/arcpy-geometry-geo-interface-and-asshape-function-loss-of-precision-and-h/21627
     http://gis.stackexchange.com/questions/27255/how-to-identify-feature-vertices-that-are-part-of-a-donut-hole-in-arcgis-10
@@ -157,65 +303,128 @@ def arcpyStuff():
     from arcpy import env
     arcpy.AddMessage("%s seismodensitynosql processing started" % ts())
 
+    # resident service, if it's up: profiles SR known w/o store or Describe
+    info = None
+    if serviceUrl and not streamSource:
+        with seismometrics.phase('serviceInfo'):
+            info = seismoservice.serviceInfo(serviceUrl)
+
     # spatialReference
-    seisDesc = arcpy.Describe(os.path.join(toolDirPath, gdbFName, seisFCName))
-    log.info("arcpyStuff, seismoprofiles WKID '%s'" % (seisDesc.spatialReference.factoryCode))
-    workSR = seisDesc.spatialReference # seismoprofiles meters good for clip
-    env.outputCoordinateSystem = workSR
+    with seismometrics.phase('describe'):
+        if info and info.get('wkid'):
+            workWkid = int(info['wkid'])
+        else:
+            info = None
+            workWkid = profilesWkid() # seismoprofiles meters good for clip
+        env.outputCoordinateSystem = seismoproj.spatialReference(workWkid)
+    log.info("arcpyStuff, seismoprofiles WKID '%s'" % (workWkid))
 
     # input
     fsetTxt = arcpy.GetParameterAsText(0) # Feature Set
-    log.info("arcpyStuff, input polygons text '%s'" % fsetTxt)
+    seismolog.logPayload(log, "arcpyStuff, input polygons text '%s'", fsetTxt)
     fsetObj = arcpy.GetParameter(0)
     log.info("arcpyStuff, input polygons obj '%s'" % (fsetObj)) # geoprocessing record set object (FeatureSet)
-
-    # unique FC name
-    # FAQ: What characters should not be used in ArcGIS for field names and table names?
-    # http://support.esri.com/index.cfm?fa=knowledgebase.techarticles.articleShow&d=23087
-    # "Eliminate anything that is not an alphanumeric character or an underscore. Do not start field or table names with an underscore or a number. Also, it is necessary to edit the field names in delimited text files to remove unsupported characters before using them."
-    #~ import uuid
-    #~ gid = ('%r' % uuid.uuid4().hex)[1:-1]
-    #~ tabname = arcpy.ValidateTableName(gid, "in_memory")
-    #~ clippedFCN = "in_memory/a%s" % tabname
-    # KISS principle
-    clippedFCN = arcpy.CreateScratchName ('seismo', 'profiles', 'FeatureClass', 'in_memory')
-
-    # seismoprofiles length
-    log.info("Clip_analysis into FC '%s'..." % (clippedFCN))
-    arcpy.Clip_analysis(os.path.join(toolDirPath, gdbFName, seisFCName), fsetObj, clippedFCN)
-    log.info("Clip_analysis done, create geometryList...")
-    g = arcpy.Geometry()
-    geometryList = arcpy.CopyFeatures_management(clippedFCN, g)
-    log.info("create geometryList done, calc length...")
-
-    length = 0
-    for geometry in geometryList:
-        length += geometry.length
-    length = length / 1000.0 # kilometers from meters
-    log.info("clipped seismoprofiles length '%s' km." % (length))
-    #~ arcpy.Delete_management(clippedFCN) # no need for in_memory
-
-    # polygon area
-    area = 0
-    rows = arcpy.SearchCursor(fsetObj, '', workSR)
-    for row in rows: # for each polygon
-        geom = row.shape
-        # geometry type 'polygon', area '-218254081896.0', parts '0'
-        log.info("arcpyStuff searchcursor, geometry type '%s', area '%s', parts '%s'" % (geom.type, geom.area, geom.partCount))
-        # {'type': 'Polygon', 'coordinates': []}
-        log.info("arcpyStuff searchcursor, geometry geojson '%s'" % (geom.__geo_interface__))
-        area = geom.area
-        break # only one polygon
-    area = area / 1000000.0 # kilometers from meters
+    argCount = arcpy.GetArgumentCount() # toolbox w/o accuracy parameters: 4
+    tolerance = approxTolerance
+    if argCount > 4 and arcpy.GetParameterAsText(4):
+        tolerance = float(arcpy.GetParameterAsText(4).replace(',', '.'))
+    filterText, breakdown = '', ''
+    if argCount > 8:
+        filterText, breakdown = arcpy.GetParameterAsText(7).strip(), arcpy.GetParameterAsText(8).strip()
+    if streamSource:
+        filterText, breakdown, tolerance = '', '', 0 # one pass over source, no attributes
+    if filterText or breakdown:
+        tolerance = 0 # pyramid totals are for all profiles
+    log.info("arcpyStuff, tolerance '%s', filter '%s', breakdown '%s'" % (tolerance, filterText, breakdown))
+
+    # polygon rings, zero-part geometry (counterclockwise, self-intersected) repaired; area
+    with seismometrics.phase('cursor'):
+        rings = seismorepair.fsetRings(fsetObj, fsetTxt, workWkid, log)
+    seismometrics.count('vertices', sum(len(r) for r in rings))
+    area = seismoclip.polygonArea(rings) / 1000000.0 # kilometers from meters
     log.info("polygon area '%s' km2" % (area))
 
-    # density
-    density = length / area
-    log.info("seismodens '%s' km/km2" % (density))
+    # results cache, key from polygon in seismoprofiles SR
+    cacheFile = ''
+    if cacheFName:
+        cacheFile = os.path.join(toolDirPath, cacheFName)
+    with seismometrics.phase('cache'):
+        if streamSource:
+            stamp = streamStamp()
+        else:
+            stamp = seismoclip.dataStamp(os.path.join(toolDirPath, gdbFName))
+        cache = seismocache.getCache('nosql', stamp, cacheFile, log)
+        cacheKey = seismocache.polygonKey(rings, workWkid)
+        if filterText or breakdown:
+            cacheKey = '%s:%s:%s' % (cacheKey, filterText, breakdown)
+        res = cache.get(cacheKey)
+    lengthError = 0.0 # km
+    parts = {} # breakdown value => km
+    cacheable = True # answer computed on gdb data of cache stamp
+    if res is not None:
+        seismometrics.setValue('cache', 'hit')
+        density, length, area = res[:3]
+        if len(res) > 3:
+            parts = res[3]
+        log.info("arcpyStuff, cache hit '%s', seismodens '%s' km/km2" % (cacheKey, density))
+    else:
+        seismometrics.setValue('cache', 'miss')
+        if info is not None:
+            try:
+                with seismometrics.phase('service'):
+                    if filterText or breakdown:
+                        density, length, area, parts = seismoservice.requestFiltered(rings, workWkid,
+                            filterText, breakdown, serviceUrl, serviceTimeout)
+                        res = (density, length, area)
+                    elif tolerance > 0:
+                        density, length, area, lengthError = seismoservice.requestEstimate(rings, workWkid,
+                            tolerance, serviceUrl, serviceTimeout)
+                        res = (density, length, area)
+                    else:
+                        res = seismoservice.requestDensity(rings, workWkid, serviceUrl, serviceTimeout)
+                density, length, area = res
+                seismometrics.setValue('engine', 'service')
+                log.info("arcpyStuff, service answer, seismodens '%s' km/km2, length '%s' km" % (density, length))
+                if info.get('stamp') != stamp: # service store is built from other gdb data
+                    cacheable = False
+                    log.info("arcpyStuff, service store stamp '%s' is not gdb stamp '%s', answer not cached" % (
+                        info.get('stamp'), stamp))
+            except Exception, e:
+                log.warning("arcpyStuff, service '%s' failed, compute in-process: %s" % (serviceUrl, e))
+                res = None
+        if res is None:
+            # seismoprofiles length
+            if streamSource:
+                log.info("arcpyStuff, stream profiles from '%s'" % (streamSource))
+                length = streamLength(rings, workWkid)
+            else:
+                profiles, index = loadEngine()
+                if filterText or breakdown:
+                    length, parts = filteredLength(profiles, index, rings, filterText, breakdown)
+                    parts = dict((k, v / 1000.0) for k, v in parts.items())
+                elif tolerance > 0:
+                    length, lengthError = approxLength(profiles, index, rings, tolerance)
+                    lengthError = lengthError / 1000.0
+                else:
+                    length = profilesLength(profiles, index, rings)
+            length = length / 1000.0 # kilometers from meters
+            log.info("clipped seismoprofiles length '%s' km, error '%s' km" % (length, lengthError))
+
+            # density
+            density = length / area
+            log.info("seismodens '%s' km/km2" % (density))
+        if lengthError == 0 and cacheable: # estimates not cached
+            cache.put(cacheKey, (filterText or breakdown) and (density, length, area, parts) or (density, length, area))
+            seismocache.saveCache(cache, log)
 
     arcpy.SetParameterAsText(1, '%.3f' % density) # Seismodensity double
     arcpy.SetParameterAsText(2, '%.3f' % length) # SeismorofilesLength double
     arcpy.SetParameterAsText(3, '%.3f' % area) # ShapeArea double
+    if argCount > 6:
+        arcpy.SetParameterAsText(5, lengthError and 'approximate' or 'exact')
+        arcpy.SetParameterAsText(6, '%.3f' % lengthError) # SeismorofilesLength error bound, km
+    if argCount > 9:
+        arcpy.SetParameterAsText(9, json.dumps(dict((u'%s' % k, round(v, 3)) for k, v in parts.items()), sort_keys=True))
 
     # todo
     # gemetry.simplify on server
@@ -237,10 +446,13 @@ def main(note=''):
     log.info('start, argv: %s, note "%s"' % (argv, note))
 
     import arcpy
+    job = seismometrics.startJob('nosql')
+    error = None
     try:
         # geoprocessor tool script
         arcpyStuff()
     except Exception, e:
+        error = e
         arcpy.AddError('Toolbox had failed try')
         arcpy.AddError(e)
         if type(e).__name__ == 'COMError':
@@ -249,8 +461,8 @@ def main(note=''):
             log.exception('main, error, program failed')
             raise
     finally:
-        log.info('End Of Program, logging shutdown')
-        logging.shutdown()
+        job.finish(metricsFilename, log, error)
+        log.info('End Of Program') # queued records written by seismolog thread, rest at process exit
 #def main():
 
 
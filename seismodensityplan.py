@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# (c) Valik mailto:vasnake@gmail.com
+
+'''
+ArcGIS Toolbox tool script for Seismodensity project, one entry point for all engines
+
+Input: GPFeatureRecordSetLayer
+    inputPolygon
+
+Output: double default -1.0
+    seismoDens km/km2
+    profilesLength km
+    shapeArea km2
+
+Parameters are the same as seismodensity.py and seismodensitynosql.py have, so the tool
+replaces both of them in toolbox. Engine for a polygon chosen by cost-based planner (seismoplan):
+cached result first (in-process engines answers only); then cheapest of resident service, in-process clip, length pyramid
+and Oracle calc_seismodensity by estimates from polygon envelope, index candidates, vertices
+and engines load state; actual run time tunes planner factors, saved in planFName.
+Engine failure: in-process clip, engine factor doubled.
+
+Constants
+    planFName - planner state file, next to gdb; empty string for memory only planner
+    planEngines - engines planner may choose from, see seismoplan.engines
+seismodensitynosql.py constants used for gdb, store, index, pyramid, cache and service;
+seismodensity.py constants for Oracle connection (oraConnFName, pooled cx_Oracle only).
+'''
+
+
+import time, traceback
+import sys, string, os
+import logging
+
+import seismoclip
+import seismorepair
+import seismoproj
+import seismoindex
+import seismostore
+import seismopyramid
+import seismocache
+import seismoservice
+import seismometrics
+import seismodb
+import seismoplan
+import seismodensity as sqltool
+import seismodensitynosql as nosql
+from seismodensitynosql import log, ts, setLogger, cp
+
+planFName = r'''seismodensityplan.costs.json'''
+planEngines = seismoplan.engines
+
+
+def engineState(info):
+    ''' (available, loaded) engines: list of names and dict name => warm
+    '''
+    storeDir = os.path.join(nosql.toolDirPath, nosql.storeFName)
+    indexFile = os.path.join(nosql.toolDirPath, nosql.indexFName)
+    memory = storeDir in seismostore._storeCache and indexFile in seismoindex._indexCache
+    connFile = os.path.join(nosql.toolDirPath, sqltool.oraConnFName)
+    loaded = {'service': True, 'memory': memory, 'oracle': connFile in seismodb._pools,
+        'pyramid': memory and os.path.join(nosql.toolDirPath, nosql.pyramidFName) in seismopyramid._pyramidCache}
+    available = ['memory']
+    if nosql.pyramidFName:
+        available.append('pyramid')
+    if info is not None:
+        available.append('service')
+    if os.path.exists(connFile):
+        available.append('oracle')
+    return ([e for e in available if e in planEngines] or ['memory'], loaded)
+#def engineState(info):
+
+
+def planStats(planner, rings):
+    ''' seismoplan.polygonStats with loaded index, or with data extent remembered by planner and store header
+    '''
+    index = seismoindex._indexCache.get(os.path.join(nosql.toolDirPath, nosql.indexFName))
+    if index is not None:
+        planner.extent, planner.segmentCount = list(index.extent()), index.itemCount
+        return seismoplan.polygonStats(rings, index)
+    header = seismostore.readHeader(os.path.join(nosql.toolDirPath, nosql.storeFName)) or {}
+    return seismoplan.polygonStats(rings, None, planner.extent, header.get('segmentCount', planner.segmentCount))
+#def planStats(planner, rings):
+
+
+def engineLength(engine, rings, workWkid):
+    ''' Profiles length inside polygon, km, by engine
+    '''
+    seismometrics.setValue('engine', engine)
+    if engine == 'service':
+        with seismometrics.phase('service'):
+            return seismoservice.requestDensity(rings, workWkid, nosql.serviceUrl, nosql.serviceTimeout)[1]
+    if engine == 'oracle':
+        pool = seismodb.getPool(os.path.join(nosql.toolDirPath, sqltool.oraConnFName), log)
+        if pool is None:
+            raise NameError("Oracle engine needs cx_Oracle and connect file '%s'" % sqltool.oraConnFName)
+        funcName = seismodb.bindFuncName
+        if sqltool.oraGeomFormat == 'wkt':
+            funcName = seismodb.wktFuncName
+        with seismometrics.phase('oracle'):
+            oraWkid = sqltool.profilesWkid(lambda sql: seismodb.queryValue(pool, sql)) # Oracle seismoprofiles SR
+            if seismoclip.normalizeWkid(oraWkid) != seismoclip.normalizeWkid(workWkid):
+                rings = seismoproj.transformRings(rings, workWkid, oraWkid)
+            return seismodb.calcDensity(pool, rings, oraWkid, funcName, sqltool.oraGeomFormat)[1]
+    profiles, index = nosql.loadEngine()
+    stamp = seismoclip.dataStamp(os.path.join(nosql.toolDirPath, nosql.gdbFName))
+    with seismometrics.phase('clip'):
+        if engine == 'pyramid':
+            length = seismopyramid.profilesLength(profiles, index, rings,
+                os.path.join(nosql.toolDirPath, nosql.pyramidFName), stamp, 0, log)
+        else:
+            length = seismopyramid.profilesLength(profiles, index, rings, '', stamp, 0, log)
+    return length / 1000.0 # kilometers from meters
+#def engineLength(engine, rings, workWkid):
+
+
+def arcpyStuff():
+    ''' Geoprocessor main program.
+
+    In/out parameters
+    fsetObj = arcpy.GetParameter(0) # featureset
+    arcpy.SetParameterAsText(1, x) # Seismodensity double, km/km2
+    arcpy.SetParameterAsText(2, y) # SeismorofilesLength double, km
+    arcpy.SetParameterAsText(3, z) # ShapeArea double, km2
+
+    Seismoprofiles SR WKID from service, store header or GDB FeatureClass;
+    input polygon rings in seismoprofiles SR, repaired (seismorepair), area;
+    cached result for the same polygon and gdb returned (seismocache, nosql tool cache);
+    planner estimates engines costs and picks the cheapest (seismoplan), length from it;
+    Oracle answer is not cached: cache is dropped by gdb data stamp, not by Oracle seismoprofiles_stamp;
+    service answer cached only if service store stamp is gdb stamp;
+    run time recorded into planner and job metrics ('plan' value: engine, estimate, actual).
+    '''
+
+    from arcpy import env
+    arcpy.AddMessage("%s seismodensityplan processing started" % ts())
+
+    info = None
+    if nosql.serviceUrl:
+        with seismometrics.phase('serviceInfo'):
+            info = seismoservice.serviceInfo(nosql.serviceUrl)
+    with seismometrics.phase('describe'):
+        if info and info.get('wkid'):
+            workWkid = int(info['wkid'])
+        else:
+            info = None
+            workWkid = nosql.profilesWkid()
+        env.outputCoordinateSystem = seismoproj.spatialReference(workWkid)
+    log.info("arcpyStuff plan, seismoprofiles WKID '%s'" % (workWkid))
+
+    fsetTxt = arcpy.GetParameterAsText(0)
+    fsetObj = arcpy.GetParameter(0)
+    with seismometrics.phase('cursor'):
+        rings = seismorepair.fsetRings(fsetObj, fsetTxt, workWkid, log)
+    seismometrics.count('vertices', sum(len(r) for r in rings))
+    area = seismoclip.polygonArea(rings) / 1000000.0 # kilometers from meters
+    if area <= 0:
+        raise NameError("Wrong input polygon, you should send no selfintersected clockwise drawed single ring")
+
+    # precomputed: results cache
+    cacheFile = ''
+    if nosql.cacheFName:
+        cacheFile = os.path.join(nosql.toolDirPath, nosql.cacheFName)
+    with seismometrics.phase('cache'):
+        stamp = seismoclip.dataStamp(os.path.join(nosql.toolDirPath, nosql.gdbFName))
+        cache = seismocache.getCache('nosql', stamp, cacheFile, log)
+        cacheKey = seismocache.polygonKey(rings, workWkid)
+        res = cache.get(cacheKey)
+    if res is not None:
+        seismometrics.setValue('cache', 'hit')
+        seismometrics.setValue('engine', 'cache')
+        density, length, area = res[:3]
+        log.info("arcpyStuff plan, cache hit '%s', seismodens '%s' km/km2" % (cacheKey, density))
+    else:
+        seismometrics.setValue('cache', 'miss')
+        planFile = ''
+        if planFName:
+            planFile = os.path.join(nosql.toolDirPath, planFName)
+        planner = seismoplan.getPlanner(planFile, log)
+        with seismometrics.phase('plan'):
+            available, loaded = engineState(info)
+            stats = planStats(planner, rings)
+            engine, estimates = planner.plan(stats, available, loaded)
+        log.info("arcpyStuff plan, engine '%s', estimates %s, stats %s" % (engine, estimates, stats))
+        start = seismometrics.clock()
+        try:
+            length = engineLength(engine, rings, workWkid)
+            actual = seismometrics.clock() - start
+            ratio = planner.record(engine, stats, loaded, actual)
+            log.info("arcpyStuff plan, engine '%s' done in '%.3f' s, actual / estimated '%.2f'" % (engine, actual, ratio))
+        except Exception, e:
+            if engine == 'memory':
+                raise
+            log.warning("arcpyStuff plan, engine '%s' failed, in-process clip: %s" % (engine, e))
+            planner.fail(engine)
+            actual = None
+            length = engineLength('memory', rings, workWkid)
+        seismometrics.setValue('plan', {'engine': engine, 'estimate': estimates[engine], 'actual': actual})
+        seismoplan.savePlanner(planner, planFile, log)
+        density = length / area
+        if actual is None or engine in ('memory', 'pyramid') or ( # gdb data answer
+                engine == 'service' and info.get('stamp') == stamp):
+            cache.put(cacheKey, (density, length, area))
+            seismocache.saveCache(cache, log)
+    log.info("arcpyStuff plan, seismodens '%s' km/km2, length '%s' km, area '%s' km2" % (density, length, area))
+
+    arcpy.SetParameterAsText(1, '%.3f' % density) # Seismodensity double
+    arcpy.SetParameterAsText(2, '%.3f' % length) # SeismorofilesLength double
+    arcpy.SetParameterAsText(3, '%.3f' % area) # ShapeArea double
+    arcpy.AddMessage("%s processing done" % ts())
+#def arcpyStuff():
+
+
+def main(note=''):
+    argc = len(sys.argv)
+    argv = sys.argv
+    print >> sys.stderr, 'argc: [%s], argv: [%s]' % (argc, argv)
+
+    # log setup
+    setLogger(log)
+    log.info('start plan, argv: %s, note "%s"' % (argv, note))
+
+    import arcpy
+    job = seismometrics.startJob('plan')
+    error = None
+    try:
+        # geoprocessor tool script
+        arcpyStuff()
+    except Exception, e:
+        error = e
+        arcpy.AddError('Toolbox had failed try')
+        arcpy.AddError(e)
+        if type(e).__name__ == 'COMError':
+            log.error('main, COM error, msg [%s]' % e)
+        else:
+            log.exception('main, error, program failed')
+            raise
+    finally:
+        job.finish(nosql.metricsFilename, log, error)
+        log.info('End Of Program') # queued records written by seismolog thread, rest at process exit
+#def main():
+
+
+if __name__ == "__main__":
+    import time, traceback
+    print time.strftime('%Y-%m-%d %H:%M:%S')
+
+    try:
+        # run program
+        main()
+        print u'Если это видно, сбоев нет'.encode(cp)
+    except Exception, e:
+        if type(e).__name__ == 'COMError':
+            print 'COM error, msg [%s]' % e
+        else:
+            print 'Error, program failed:'
+            traceback.print_exc(file=sys.stderr)
+
+    print time.strftime('%Y-%m-%d %H:%M:%S')
+# end main
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# (c) Valik mailto:vasnake@gmail.com
+
+'''
+Density jobs dispatcher for Seismodensity project
+
+Front of density computation in resident service (seismoservice):
+    bounded queue - not more than maxQueue jobs waiting;
+    workers - fixed number of threads compute jobs, burst of requests doesn't start burst of computations;
+    single-flight - requests with the same key (normalized polygon, seismocache.polygonKey)
+        coming while job is queued or running get the same Future, polygon computed once;
+    timeouts - each request waits for result not longer than its timeout (Timeout raised),
+        job which all waiters gave up before it started is skipped;
+    backpressure - full queue: policy 'reject' raises Saturated at once (HTTP 503),
+        policy 'wait' blocks request up to queueTimeout seconds, then Saturated.
+
+Threads and Queue, not asyncio: tool scripts and service run on ArcGIS Python 2.
+
+Doctests
+>>> gate = threading.Event()
+>>> def work(x):
+...     gate.wait()
+...     return x * 2
+>>> disp = Dispatcher(workers=1, maxQueue=1)
+>>> fa = disp.submit('a', work, (1, ))
+>>> while disp.queued(): time.sleep(0.001) # worker took 'a' and waits for gate
+>>> fa is disp.submit('a', work, (1, )) # single-flight
+True
+>>> fb = disp.submit('b', work, (2, )) # queued
+>>> disp.submit('c', work, (3, ))
+Traceback (most recent call last):
+...
+Saturated: Dispatcher queue is full, 1 jobs waiting
+>>> disp.call('b', work, (2, ), timeout=0.01)
+Traceback (most recent call last):
+...
+Timeout: Job 'b' not done in 0.01 sec
+>>> gate.set()
+>>> fa.wait(5), fb.wait(5)
+(2, 4)
+>>> sorted(disp.stats().items())
+[('coalesced', 2), ('completed', 2), ('failed', 0), ('inflight', 0), ('queued', 0), ('rejected', 1), ('skipped', 0), ('submitted', 2), ('timedOut', 1)]
+>>> disp.stop()
+'''
+
+import time
+import threading
+try:
+    import Queue as queue
+except ImportError: # python 3
+    import queue
+
+workers = 4
+maxQueue = 32
+requestTimeout = 60 # seconds
+queueTimeout = 5 # seconds, policy 'wait'
+
+
+class Saturated(Exception):
+    ''' Queue is full, request rejected
+    '''
+
+
+class Timeout(Exception):
+    ''' Result not ready in request timeout
+    '''
+
+
+class Future(object):
+    ''' Result of one job, shared by all requests with job key
+    '''
+
+    def __init__(self, key):
+        self.key = key
+        self.deadline = 0 # latest waiter deadline, time.time() seconds
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def done(self):
+        return self._done.isSet()
+
+    def setResult(self, result=None, error=None):
+        self._result = result
+        self._error = error
+        self._done.set()
+
+    def wait(self, timeout=None):
+        ''' Result, or raise job error, or raise Timeout
+        '''
+        self._done.wait(timeout)
+        if not self._done.isSet():
+            raise Timeout("Job '%s' not done in %s sec" % (self.key, timeout))
+        if self._error is not None:
+            raise self._error
+        return self._result
+#class Future(object):
+
+
+class Dispatcher(object):
+    ''' Bounded queue and worker threads with single-flight by key
+    '''
+
+    def __init__(self, workers=workers, maxQueue=maxQueue, policy='reject', queueTimeout=queueTimeout):
+        if policy not in ('reject', 'wait'):
+            raise NameError("Unknown dispatcher policy '%s', expected 'reject' or 'wait'" % policy)
+        self.policy = policy
+        self.queueTimeout = queueTimeout
+        self._queue = queue.Queue(maxQueue)
+        self._inflight = {} # key => Future
+        self._lock = threading.Lock()
+        self._counts = dict.fromkeys(('submitted', 'coalesced', 'rejected', 'timedOut',
+            'completed', 'failed', 'skipped'), 0)
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name='seismodispatch-%s' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _count(self, name):
+        self._lock.acquire()
+        try:
+            self._counts[name] += 1
+        finally:
+            self._lock.release()
+
+    def queued(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            res = dict(self._counts)
+            res['inflight'] = len(self._inflight)
+        finally:
+            self._lock.release()
+        res['queued'] = self.queued()
+        return res
+
+    def submit(self, key, func, args=(), timeout=None):
+        ''' Future for func(*args): running or queued job with the same key, or new job.
+        timeout: seconds caller will wait for result, None - no limit.
+        Raise Saturated if queue is full.
+        '''
+        deadline = float('inf')
+        if timeout is not None:
+            deadline = time.time() + timeout
+        self._lock.acquire()
+        try:
+            fut = self._inflight.get(key)
+            if fut is not None:
+                fut.deadline = max(fut.deadline, deadline)
+                self._counts['coalesced'] += 1
+                return fut
+            fut = self._inflight[key] = Future(key)
+            fut.deadline = deadline
+        finally:
+            self._lock.release()
+        try:
+            if self.policy == 'wait':
+                self._queue.put((fut, func, args), True, self.queueTimeout)
+            else:
+                self._queue.put((fut, func, args), False)
+        except queue.Full:
+            self._lock.acquire()
+            try:
+                del self._inflight[key]
+                self._counts['rejected'] += 1
+            finally:
+                self._lock.release()
+            fut.setResult(error=Saturated("Dispatcher queue is full, %s jobs waiting" % self.queued()))
+            fut.wait()
+        self._count('submitted')
+        return fut
+
+    def call(self, key, func, args=(), timeout=requestTimeout):
+        ''' Submit job and wait for its result not longer than timeout seconds
+        '''
+        fut = self.submit(key, func, args, timeout)
+        try:
+            return fut.wait(timeout)
+        except Timeout:
+            self._count('timedOut')
+            raise
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            fut, func, args = item
+            result = error = None
+            if fut.deadline < time.time():
+                error = Timeout("Job '%s' skipped, all requests timed out" % (fut.key, ))
+                name = 'skipped'
+            else:
+                try:
+                    result = func(*args)
+                    name = 'completed'
+                except Exception, e:
+                    error = e
+                    name = 'failed'
+            self._lock.acquire()
+            try:
+                self._inflight.pop(fut.key, None)
+                self._counts[name] += 1
+            finally:
+                self._lock.release()
+            fut.setResult(result, error)
+
+    def stop(self):
+        ''' Stop workers after queued jobs
+        '''
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+#class Dispatcher(object):
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(verbose=True)
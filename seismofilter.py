@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# (c) Valik mailto:vasnake@gmail.com
+
+'''
+Attribute filter for Seismodensity project
+
+Density of profiles subset: surveys after given year, one contractor, reprocessed lines only.
+Definition query on APP_GP_SEISM2D_L meant full scan and new clip; here filter is applied
+to store attribute columns (seismostore, fields from storeFields) and intersected
+with spatial index candidates before clip.
+
+Low-cardinality columns (text or integer columns up to maxCardinality distinct values)
+get bitmap index: one packed bitmap (bit per part) for each column value, built at first filter
+on that column and kept with opened profiles (one store build). Filter clause is OR of values bitmaps,
+clauses are AND-ed bytewise; other columns compared directly (text column by its codes).
+
+Filter syntax: clauses joined by 'and' or ';', clause is
+    NAME op value, op is one of = != <> < <= > >=
+    NAME in (value, value, ...) or NAME not in (...)
+values are numbers or text, text may be quoted: YEAR >= 2005 and CREW in ('SMNG', 'MAGE')
+
+Breakdown: profiles length inside polygon per value of one column, computed in the same pass.
+
+Doctests
+>>> import seismoclip, seismoindex
+>>> prof = seismoclip.ProfileSet.fromParts([[(x, 0), (x, 100)] for x in range(10, 100, 10)])
+>>> prof.attrs = {'YEAR': np.array([1990, 1995, 2000, 2005, 2010] * 2)[:9],
+...     'CREW': seismostore.CategoryColumn.fromList(['A', 'B', 'C'] * 3)}
+>>> mask = partsMask(prof, "YEAR >= 2000 and CREW in ('A', B)")
+>>> [i for i in range(9) if mask[i]]
+[3, 4, 7]
+>>> sorted(prof.bitmaps.keys())
+['CREW', 'YEAR']
+>>> [i for i in range(9) if partsMask(prof, "CREW != 'B'")[i]]
+[0, 2, 3, 5, 6, 8]
+>>> many = seismoclip.ProfileSet.fromParts([[(x, 0), (x, 1)] for x in range(1100)])
+>>> many.attrs = {'LINE': seismostore.CategoryColumn.fromList([u'L%s' % x for x in range(1100)]), 'YEAR': prof.attrs['YEAR']}
+>>> partsMask(many, "LINE in (L5, L7)").nonzero()[0], getBitmap(many, 'LINE') # codes compared, no bitmap
+(array([5, 7]), None)
+>>> sorted(many.bitmaps.keys()) # only filtered columns
+['LINE']
+>>> index = seismoindex.segmentsTree(prof)
+>>> ring = [[0, 10], [0, 90], [55, 90], [55, 10], [0, 10]]
+>>> filteredLength(prof, index, [ring], mask)
+(160.0, {})
+>>> length, parts = filteredLength(prof, index, [ring], partsMask(prof, 'YEAR != 1990'), 'CREW')
+>>> length, sorted(parts.items())
+(320.0, [('A', 80.0), ('B', 160.0), ('C', 80.0)])
+>>> partsMask(prof, '')
+>>> partsMask(prof, 'DEPTH > 5')
+Traceback (most recent call last):
+...
+NameError: Attribute 'DEPTH' is not in store, add it to storeFields
+'''
+
+import re
+import math
+import operator
+import numpy as np
+
+import seismoclip
+import seismostore
+
+maxCardinality = 1024 # distinct values of text or integer column for bitmap index
+
+_clauseRe = re.compile(r'^\s*(\w+)\s*(<=|>=|!=|<>|=|<|>|not\s+in\b|in\b)\s*(.*?)\s*$', re.IGNORECASE)
+_splitRe = re.compile(r';|\s+and\s+', re.IGNORECASE)
+_ops = {'=': operator.eq, '!=': operator.ne, '<>': operator.ne, # array operators, numpy ufuncs lack text loops
+    '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+
+
+class BitmapIndex(object):
+    ''' Packed bitmap of parts for each value of a column.
+    values: sorted distinct values; bits: (len(values), ceil(count / 8)) uint8, row i is np.packbits(column == values[i])
+    '''
+
+    def __init__(self, values, bits, count):
+        self.values = values
+        self.bits = bits
+        self.count = count
+
+    @classmethod
+    def fromColumn(cls, column):
+        ''' Bitmap index for CategoryColumn or integer array, None if column has too many values
+        '''
+        if isinstance(column, seismostore.CategoryColumn):
+            if len(column.values) > maxCardinality:
+                return None
+            values, codes = list(column.values), np.asarray(column.codes)
+        else:
+            values, codes = np.unique(np.asarray(column), return_inverse=True)
+            if len(values) > maxCardinality:
+                return None
+            values = values.tolist()
+        order = np.argsort(codes, kind='mergesort')
+        bounds = np.searchsorted(codes[order], np.arange(len(values) + 1))
+        bits = np.zeros((len(values), (len(codes) + 7) // 8), dtype=np.uint8)
+        row = np.zeros(len(codes), dtype=bool)
+        for i in range(len(values)):
+            row[:] = False
+            row[order[bounds[i]:bounds[i + 1]]] = True
+            bits[i] = np.packbits(row)
+        return cls(values, bits, len(codes))
+
+    def select(self, test):
+        ''' Packed bitmap of parts whose value passes test(values array) => bool array
+        '''
+        hit = np.nonzero(test(np.array(self.values)))[0]
+        if len(hit) == 0:
+            return np.zeros(self.bits.shape[1], dtype=np.uint8)
+        return np.bitwise_or.reduce(self.bits[hit], axis=0)
+#class BitmapIndex(object):
+
+
+def getBitmap(profiles, name):
+    ''' BitmapIndex of profiles store column, None if column is not low-cardinality text or integer one.
+    Built at first call for that column and kept with profiles (one store build), column name => index or None
+    '''
+    bitmaps = getattr(profiles, 'bitmaps', None)
+    if bitmaps is None:
+        bitmaps = profiles.bitmaps = {}
+    if name not in bitmaps:
+        column = getattr(profiles, 'attrs', {}).get(name)
+        bmp = None
+        if column is not None and (isinstance(column, seismostore.CategoryColumn) or
+                np.asarray(column).dtype.kind in 'iub'):
+            bmp = BitmapIndex.fromColumn(column)
+        bitmaps[name] = bmp
+    return bitmaps[name]
+#def getBitmap(profiles, name):
+
+
+def _value(text):
+    text = text.strip()
+    if len(text) > 1 and text[0] == text[-1] and text[0] in '\'"':
+        return text[1:-1]
+    return text
+#def _value(text):
+
+
+def parseFilter(filterText):
+    ''' List of (name, op, values) clauses; op is lower case, values list of text
+
+    >>> parseFilter("YEAR >= 2005; CREW not in ('A, B', C)")
+    [('YEAR', '>=', ['2005']), ('CREW', 'not in', ['A, B', 'C'])]
+    '''
+    clauses = []
+    for text in _splitRe.split(filterText or ''):
+        if not text.strip():
+            continue
+        match = _clauseRe.match(text)
+        if match is None:
+            raise NameError("Wrong filter clause '%s'" % text.strip())
+        name, op, rest = match.groups()
+        op = ' '.join(op.lower().split())
+        if op.endswith('in'):
+            rest = rest.strip()
+            if not (rest.startswith('(') and rest.endswith(')')):
+                raise NameError("Wrong filter clause '%s', values list expected" % text.strip())
+            values = [_value(v) for v in re.findall(r'''\s*('[^']*'|"[^"]*"|[^,]+)\s*(?:,|$)''', rest[1:-1])]
+        else:
+            values = [_value(rest)]
+        clauses.append((name, op, values))
+    return clauses
+#def parseFilter(filterText):
+
+
+def _typed(values, column):
+    ''' Filter values as column values type
+    '''
+    if isinstance(column, seismostore.CategoryColumn):
+        return [u'%s' % v for v in values]
+    try:
+        return [float(v.replace(',', '.')) for v in values]
+    except ValueError:
+        raise NameError("Numeric value expected in filter, got %s" % values)
+#def _typed(values, column):
+
+
+def _test(op, values):
+    ''' values array => bool array function for clause
+    '''
+    if op == 'in':
+        return lambda arr: np.in1d(arr, values)
+    if op == 'not in':
+        return lambda arr: ~np.in1d(arr, values)
+    return lambda arr: _ops[op](arr, values[0])
+#def _test(op, values):
+
+
+def partsMask(profiles, filterText):
+    ''' Bool array, one item per part: part passes filter. None for empty filter (all parts).
+    '''
+    clauses = parseFilter(filterText)
+    if not clauses:
+        return None
+    attrs = getattr(profiles, 'attrs', {})
+    bits = None
+    mask = np.ones(profiles.partCount, dtype=bool)
+    for name, op, values in clauses:
+        column = attrs.get(name)
+        if column is None:
+            raise NameError("Attribute '%s' is not in store, add it to storeFields" % name)
+        test = _test(op, _typed(values, column))
+        bmp = getBitmap(profiles, name)
+        if bmp is not None:
+            sel = bmp.select(test)
+            bits = sel if bits is None else bits & sel
+        elif isinstance(column, seismostore.CategoryColumn):
+            mask &= test(np.array(column.values))[np.asarray(column.codes)]
+        else:
+            mask &= test(np.asarray(column))
+    if bits is not None:
+        mask &= np.unpackbits(bits)[:profiles.partCount].astype(bool)
+    return mask
+#def partsMask(profiles, filterText):
+
+
+def breakdownKeys(profiles, name, parts):
+    ''' (keys, values): index in values list for each of parts, by column name
+    '''
+    column = getattr(profiles, 'attrs', {}).get(name)
+    if column is None:
+        raise NameError("Attribute '%s' is not in store, add it to storeFields" % name)
+    if isinstance(column, seismostore.CategoryColumn):
+        return np.asarray(column.codes)[parts], list(column.values)
+    values, keys = np.unique(np.asarray(column)[parts], return_inverse=True)
+    return keys, values.tolist()
+#def breakdownKeys(profiles, name, parts):
+
+
+def filteredLength(profiles, index, rings, mask=None, breakdown='', clipPool=None, log=None):
+    ''' (length, parts): profiles length inside polygon, meters, only parts where mask is True
+    (all if mask is None); parts - dict value => length of breakdown column, empty if no breakdown.
+    Spatial index candidates filtered by parts mask before clip.
+    '''
+    segIdx = index.query(seismoclip.ringsExtent(rings))
+    x0, y0, x1, y1, segPart = profiles.segments()
+    if mask is not None:
+        segIdx = segIdx[mask[segPart[segIdx]]]
+    if log: log.info("filteredLength, candidates '%s' of '%s' segments" % (len(segIdx), index.itemCount))
+    if not breakdown:
+        if clipPool is not None and len(segIdx) >= clipPool.minSegments:
+            try:
+                return (clipPool.clippedLength(rings, segIdx), {})
+            except Exception, e:
+                if log: log.warning("filteredLength, parallel clip failed, clip serially: %s" % e)
+        return (seismoclip.clippedLength(profiles, rings, segIdx), {})
+    lengths = seismoclip.segmentsInsideLength(x0[segIdx], y0[segIdx], x1[segIdx], y1[segIdx],
+        seismoclip.ringsEdges(rings))
+    keys, values = breakdownKeys(profiles, breakdown, segPart[segIdx])
+    parts = {}
+    for k in np.unique(keys):
+        parts[values[k]] = math.fsum(lengths[keys == k])
+    return (math.fsum(lengths), parts)
+#def filteredLength(profiles, index, rings, mask=None, breakdown='', clipPool=None, log=None):
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(verbose=True)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# (c) Valik mailto:vasnake@gmail.com
+
+'''
+Seismoprofiles density grid for Seismodensity project
+
+Density coverage map on a regular grid, computed in one sweep over profiles segments
+instead of one clip per fishnet cell.
+Every segment is walked through grid cells it crosses (Amanatides, Woo, 1987
+http://www.cse.yorku.ca/~amana/research/grid.pdf), vectorized: crossings with
+vertical and horizontal grid lines found for all segments at once, segment pieces
+between crossings lie each in one cell, pieces length summed per cell by np.bincount.
+
+Grid
+    extent (xmin, ymin, xmax, ymax), cellSize; columns from west to east,
+    rows from north to south (raster order), row 0 is a top row.
+Output
+    2D float64 array, km/km2 (or meters of profiles per cell, lengthGrid);
+    written as .npy, ESRI ASCII grid (.asc + .prj) or any arcpy raster.
+
+Doctests
+>>> x0, y0, x1, y1 = [0.5], [0.5], [3.5], [0.5]
+>>> lengthGrid(x0, y0, x1, y1, (0, 0, 4, 2), 1.0).round(6).tolist()
+[[0.0, 0.0, 0.0, 0.0], [0.5, 1.0, 1.0, 0.5]]
+>>> lengthGrid([0.0], [0.0], [2.0], [2.0], (0, 0, 2, 2), 1.0).round(6).tolist()
+[[0.0, 1.414214], [1.414214, 0.0]]
+'''
+
+import os
+import numpy as np
+
+# max grid pieces in one pass, memory vs speed tradeoff
+chunkPieces = 1 << 22
+noData = -9999
+
+
+def gridShape(extent, cellSize):
+    ''' Return (ncols, nrows) for extent covered by cellSize cells
+    '''
+    xmin, ymin, xmax, ymax = extent
+    ncols = max(1, int(np.ceil((xmax - xmin) / float(cellSize) - 1e-9)))
+    nrows = max(1, int(np.ceil((ymax - ymin) / float(cellSize) - 1e-9)))
+    return ncols, nrows
+#def gridShape(extent, cellSize):
+
+
+def clipToRect(x0, y0, x1, y1, rect):
+    ''' Liang-Barsky clip of segments by rectangle, vectorized.
+    Return (t0, t1, inside): inside segments part is [t0, t1] of segment parameter.
+    '''
+    xmin, ymin, xmax, ymax = rect
+    dx = x1 - x0
+    dy = y1 - y0
+    t0 = np.zeros(len(x0))
+    t1 = np.ones(len(x0))
+    inside = np.ones(len(x0), dtype=bool)
+    for p, q in ((-dx, x0 - xmin), (dx, xmax - x0), (-dy, y0 - ymin), (dy, ymax - y0)):
+        parallel = p == 0
+        inside &= ~(parallel & (q < 0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = q / p
+        enter = (p < 0) & ~parallel
+        leave = (p > 0) & ~parallel
+        t0 = np.where(enter, np.maximum(t0, r), t0)
+        t1 = np.where(leave, np.minimum(t1, r), t1)
+    inside &= t0 < t1
+    return t0, t1, inside
+#def clipToRect(x0, y0, x1, y1, rect):
+
+
+def _gridCrossings(g0, g1, seg):
+    ''' Parameters t of segments crossing integer grid lines along one axis.
+    g0, g1: segments ends in cells units. Return (segNo, t) arrays.
+    '''
+    i0 = np.floor(g0)
+    i1 = np.floor(g1)
+    lo = np.minimum(i0, i1)
+    counts = np.abs(i1 - i0).astype(np.int64)
+    total = counts.sum()
+    if total == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    firsts = np.cumsum(counts) - counts
+    k = np.arange(total, dtype=np.int64) - np.repeat(firsts, counts) + 1
+    lines = np.repeat(lo, counts) + k
+    segNo = np.repeat(seg, counts)
+    t = (lines - g0[segNo]) / (g1[segNo] - g0[segNo])
+    return segNo, t
+#def _gridCrossings(g0, g1, seg):
+
+
+def splitByGrid(x0, y0, x1, y1, extent, cellSize):
+    ''' Split segments by grid cells.
+
+    Return (segNo, ta, tb, col, row) arrays, one item per piece:
+    piece is a segment segNo part from parameter ta to tb, lying in cell (col, row).
+    Segments parts outside extent dropped.
+    '''
+    x0, y0, x1, y1 = [np.asarray(a, dtype=np.float64) for a in (x0, y0, x1, y1)]
+    ncols, nrows = gridShape(extent, cellSize)
+    xmin, ymin = extent[0], extent[1]
+    rect = (xmin, ymin, xmin + ncols * cellSize, ymin + nrows * cellSize)
+    t0, t1, inside = clipToRect(x0, y0, x1, y1, rect)
+    seg = np.nonzero(inside)[0]
+    t0, t1 = t0[seg], t1[seg]
+    sx0, sy0 = x0[seg], y0[seg]
+    dx, dy = x1[seg] - sx0, y1[seg] - sy0
+    # clipped segments ends in cells units
+    gx0 = (sx0 + t0 * dx - xmin) / cellSize
+    gx1 = (sx0 + t1 * dx - xmin) / cellSize
+    gy0 = (sy0 + t0 * dy - ymin) / cellSize
+    gy1 = (sy0 + t1 * dy - ymin) / cellSize
+
+    local = np.arange(len(seg), dtype=np.int64)
+    xs, xt = _gridCrossings(gx0, gx1, local)
+    ys, yt = _gridCrossings(gy0, gy1, local)
+    # all split points: clipped ends and grid lines crossings, u in [0, 1] along clipped part
+    segNo = np.concatenate([local, local, xs, ys])
+    u = np.concatenate([np.zeros(len(seg)), np.ones(len(seg)), xt, yt])
+    order = np.lexsort((u, segNo))
+    segNo, u = segNo[order], u[order]
+    same = segNo[1:] == segNo[:-1]
+    pseg = segNo[:-1][same]
+    ua, ub = u[:-1][same], u[1:][same]
+    keep = ub > ua
+    pseg, ua, ub = pseg[keep], ua[keep], ub[keep]
+    um = (ua + ub) / 2.0
+    col = np.clip(np.floor(gx0[pseg] + um * (gx1[pseg] - gx0[pseg])), 0, ncols - 1).astype(np.int64)
+    row = np.clip(np.floor(gy0[pseg] + um * (gy1[pseg] - gy0[pseg])), 0, nrows - 1).astype(np.int64)
+    row = nrows - 1 - row # north up
+    # back to original segment parameters
+    span = t1[pseg] - t0[pseg]
+    return seg[pseg], t0[pseg] + ua * span, t0[pseg] + ub * span, col, row
+#def splitByGrid(x0, y0, x1, y1, extent, cellSize):
+
+
+def lengthGrid(x0, y0, x1, y1, extent, cellSize):
+    ''' Profiles length (SR units) per grid cell, array (nrows, ncols).
+    One pass over segments, chunked to keep memory bounded.
+    '''
+    x0, y0, x1, y1 = [np.asarray(a, dtype=np.float64) for a in (x0, y0, x1, y1)]
+    ncols, nrows = gridShape(extent, cellSize)
+    res = np.zeros(ncols * nrows)
+    if len(x0) == 0:
+        return res.reshape(nrows, ncols)
+    seglen = np.hypot(x1 - x0, y1 - y0)
+    # pieces count per segment is about its length in cells
+    perSeg = max(1.0, float(np.mean(seglen)) / cellSize + 3)
+    step = max(1, int(chunkPieces / perSeg))
+    for start in range(0, len(x0), step):
+        sl = slice(start, start + step)
+        segNo, ta, tb, col, row = splitByGrid(x0[sl], y0[sl], x1[sl], y1[sl], extent, cellSize)
+        weights = (tb - ta) * seglen[sl][segNo]
+        res += np.bincount(row * ncols + col, weights=weights, minlength=ncols * nrows)
+    return res.reshape(nrows, ncols)
+#def lengthGrid(x0, y0, x1, y1, extent, cellSize):
+
+
+def densityGrid(profiles, extent, cellSize):
+    ''' Seismodensity km/km2 per grid cell for seismoclip.ProfileSet, metric SR
+    '''
+    x0, y0, x1, y1, segPart = profiles.segments()
+    cellAreaKm2 = (cellSize / 1000.0) ** 2
+    return lengthGrid(x0, y0, x1, y1, extent, cellSize) / 1000.0 / cellAreaKm2
+#def densityGrid(profiles, extent, cellSize):
+
+
+def writeAsciiGrid(fileName, grid, extent, cellSize, prjWkt=''):
+    ''' Write ESRI ASCII raster, and .prj file if SR WKT given
+    http://help.arcgis.com/en/arcgisdesktop/10.0/help/index.html#//009t0000000z000000
+    '''
+    nrows, ncols = grid.shape
+    fh = open(fileName, 'w')
+    try:
+        fh.write('ncols %d\nnrows %d\nxllcorner %r\nyllcorner %r\ncellsize %r\nNODATA_value %d\n' % (
+            ncols, nrows, float(extent[0]), float(extent[1]), float(cellSize), noData))
+        np.savetxt(fh, np.where(np.isfinite(grid), grid, noData), fmt='%.6f')
+    finally:
+        fh.close()
+    if prjWkt:
+        fh = open(os.path.splitext(fileName)[0] + '.prj', 'w')
+        try:
+            fh.write(prjWkt)
+        finally:
+            fh.close()
+#def writeAsciiGrid(fileName, grid, extent, cellSize, prjWkt=''):
+
+
+def saveGrid(fileName, grid, extent, cellSize, sr=None):
+    ''' Save density grid: .npy and .asc written directly, other formats through arcpy raster.
+    sr: arcpy.SpatialReference, optional.
+    '''
+    ext = os.path.splitext(fileName)[1].lower()
+    if ext == '.npy':
+        np.save(fileName, grid)
+    elif ext == '.asc':
+        prjWkt = ''
+        if sr is not None:
+            prjWkt = sr.exportToString()
+        writeAsciiGrid(fileName, grid, extent, cellSize, prjWkt)
+    else:
+        import arcpy
+        raster = arcpy.NumPyArrayToRaster(grid, arcpy.Point(extent[0], extent[1]), cellSize, cellSize, noData)
+        raster.save(fileName)
+        if sr is not None:
+            arcpy.DefineProjection_management(fileName, sr)
+#def saveGrid(fileName, grid, extent, cellSize, sr=None):
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(verbose=True)
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# (c) Valik mailto:vasnake@gmail.com
+
+'''
+Spatial index for Seismodensity project
+
+Static R-tree over seismoprofiles segments bounding boxes, bulk loaded by
+Sort-Tile-Recursive packing (Leutenegger, Edgington, Lopez, 1997
+http://www.dtic.mil/dtic/tr/fulltext/u2/a324493.pdf).
+Query by polygon envelope gives candidate segments, only candidates go to clip,
+so query cost depends on the area size, not on the whole profiles archive size.
+
+Index saved into .npz file next to Seis_button.gdb and loaded at startup;
+file keeps data stamp, index rebuilt if seismoprofiles data changed.
+Small edits (seismodelta) don't repack the tree: removed items get empty boxes,
+inserted items kept in unpacked extra list scanned by every query, until next full build.
+
+Doctests
+>>> import numpy as np
+>>> xmin = np.arange(100, dtype=np.float64)
+>>> tree = STRTree(xmin, xmin, xmin + 0.5, xmin + 0.5, nodeCapacity=4)
+>>> tree.levelCount
+4
+>>> list(tree.query((10.2, 10.2, 12.1, 12.1)))
+[10, 11, 12]
+>>> len(tree.query((-10, -10, -1, -1)))
+0
+>>> tree.remove([11]); tree.insert([100], [10.5], [10.5], [11], [11])
+>>> list(tree.query((10.2, 10.2, 12.1, 12.1))), tree.itemCount
+([10, 12, 100], 101)
+>>> tree.remove([100]); list(tree.query((10.2, 10.2, 12.1, 12.1))), tree.itemCount
+([10, 12], 101)
+'''
+
+import os
+import tempfile
+import numpy as np
+
+nodeCapacity = 16
+indexFileExt = '.rtree.npz'
+formatVersion = 1
+
+_indexCache = {} # index file path => STRTree
+
+
+def expandRanges(starts, ends):
+    ''' Concatenation of ranges [starts[i], ends[i]) as one int64 array, vectorized
+    '''
+    starts = np.asarray(starts, dtype=np.int64)
+    counts = np.asarray(ends, dtype=np.int64) - starts
+    total = counts.sum()
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    firsts = np.cumsum(counts) - counts
+    return np.arange(total, dtype=np.int64) - np.repeat(firsts - starts, counts)
+#def expandRanges(starts, ends):
+
+
+def _strOrder(xmin, ymin, xmax, ymax, capacity):
+    ''' STR packing order: sort by center X, cut into vertical slices,
+    sort every slice by center Y.
+    '''
+    n = len(xmin)
+    nodes = int(np.ceil(float(n) / capacity))
+    slices = int(np.ceil(np.sqrt(nodes)))
+    sliceSize = slices * capacity
+    cx = (xmin + xmax) / 2.0
+    cy = (ymin + ymax) / 2.0
+    byX = np.argsort(cx, kind='mergesort')
+    order = np.empty(n, dtype=np.int64)
+    for start in range(0, n, sliceSize):
+        part = byX[start:start + sliceSize]
+        order[start:start + sliceSize] = part[np.argsort(cy[part], kind='mergesort')]
+    return order
+#def _strOrder(xmin, ymin, xmax, ymax, capacity):
+
+
+def _packLevel(xmin, ymin, xmax, ymax, capacity):
+    ''' Group consecutive capacity items into nodes.
+    Return nodes (xmin, ymin, xmax, ymax, start, end) arrays.
+    '''
+    n = len(xmin)
+    starts = np.arange(0, n, capacity, dtype=np.int64)
+    ends = np.minimum(starts + capacity, n)
+    return (np.minimum.reduceat(xmin, starts), np.minimum.reduceat(ymin, starts),
+        np.maximum.reduceat(xmax, starts), np.maximum.reduceat(ymax, starts), starts, ends)
+#def _packLevel(xmin, ymin, xmax, ymax, capacity):
+
+
+class STRTree(object):
+    ''' Static packed R-tree.
+
+    order: items permutation, leaf node children are order[start:end];
+    items: items (xmin, ymin, xmax, ymax) arrays in packing order;
+    levels: list of (xmin, ymin, xmax, ymax, start, end) arrays, levels[0] is leaves,
+    node children at level k are nodes start..end of level k-1.
+    extraIds, extraItems: inserted after build items numbers and (xmin, ymin, xmax, ymax) arrays.
+    stamp: data version string index was built from.
+    '''
+
+    def __init__(self, xmin=None, ymin=None, xmax=None, ymax=None, nodeCapacity=nodeCapacity, stamp=''):
+        self.nodeCapacity = nodeCapacity
+        self.stamp = stamp
+        self.order = np.zeros(0, dtype=np.int64)
+        self.items = tuple(np.zeros(0) for i in range(4))
+        self.levels = []
+        self.extraIds = np.zeros(0, dtype=np.int64)
+        self.extraItems = tuple(np.zeros(0) for i in range(4))
+        self._position = None # item number => position in packing order
+        if xmin is not None:
+            self.build(xmin, ymin, xmax, ymax)
+
+    @property
+    def levelCount(self):
+        return len(self.levels)
+
+    @property
+    def itemCount(self):
+        return len(self.order) + len(self.extraIds)
+
+    def build(self, xmin, ymin, xmax, ymax):
+        ''' Bulk load items bounding boxes, STR packing level by level
+        '''
+        boxes = [np.asarray(a, dtype=np.float64) for a in (xmin, ymin, xmax, ymax)]
+        cap = self.nodeCapacity
+        self.levels = []
+        self.order = np.zeros(0, dtype=np.int64)
+        self.extraIds = np.zeros(0, dtype=np.int64)
+        self.extraItems = tuple(np.zeros(0) for i in range(4))
+        self._position = None
+        if len(boxes[0]) == 0:
+            return
+
+        self.order = _strOrder(boxes[0], boxes[1], boxes[2], boxes[3], cap)
+        self.items = tuple(a[self.order] for a in boxes)
+        level = _packLevel(*(self.items + (cap,)))
+        self.levels.append(level)
+        while len(level[0]) > 1:
+            perm = _strOrder(level[0], level[1], level[2], level[3], cap)
+            below = tuple(a[perm] for a in level)
+            self.levels[-1] = below # same nodes, packing order
+            level = _packLevel(below[0], below[1], below[2], below[3], cap)
+            self.levels.append(level)
+
+    def extent(self):
+        ''' (xmin, ymin, xmax, ymax) of all items
+        '''
+        boxes = [self.extraItems]
+        if self.levels:
+            boxes.append(self.levels[-1][:4])
+        xmin, ymin, xmax, ymax = [np.concatenate(a) for a in zip(*boxes)]
+        live = xmin <= xmax # removed extra items have empty boxes
+        if not live.any():
+            return (0.0, 0.0, 0.0, 0.0)
+        return (xmin[live].min(), ymin[live].min(), xmax[live].max(), ymax[live].max())
+
+    def insert(self, ids, xmin, ymin, xmax, ymax):
+        ''' Add items to extra list, tree not repacked
+        '''
+        self.extraIds = np.concatenate([self.extraIds, np.asarray(ids, dtype=np.int64)])
+        self.extraItems = tuple(np.concatenate([a, np.asarray(b, dtype=np.float64)])
+            for a, b in zip(self.extraItems, (xmin, ymin, xmax, ymax)))
+
+    def remove(self, ids):
+        ''' Items will not be found anymore: empty boxes, nodes boxes not shrunk.
+        Items stay in tree, itemCount not changed (store keeps deleted segments numbers too).
+        '''
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(self.extraIds):
+            gone = np.in1d(self.extraIds, ids)
+            self._clearBoxes(self.extraItems, np.nonzero(gone)[0])
+        ids = ids[(ids >= 0) & (ids < len(self.order))]
+        if len(ids) == 0:
+            return
+        if self._position is None:
+            self._position = np.empty(len(self.order), dtype=np.int64)
+            self._position[self.order] = np.arange(len(self.order), dtype=np.int64)
+        self._clearBoxes(self.items, self._position[ids])
+
+    def _clearBoxes(self, items, pos):
+        xmin, ymin, xmax, ymax = items
+        xmin[pos] = ymin[pos] = np.inf
+        xmax[pos] = ymax[pos] = -np.inf
+
+    def query(self, envelope):
+        ''' Items (segments numbers) with bbox intersecting envelope (xmin, ymin, xmax, ymax).
+        Return sorted int64 array.
+        '''
+        qxmin, qymin, qxmax, qymax = envelope
+        res = np.zeros(0, dtype=np.int64)
+        if self.levels:
+            nodes = np.arange(len(self.levels[-1][0]), dtype=np.int64)
+            for k in range(len(self.levels) - 1, -1, -1):
+                xmin, ymin, xmax, ymax, start, end = self.levels[k]
+                hit = ~((xmin[nodes] > qxmax) | (xmax[nodes] < qxmin) | (ymin[nodes] > qymax) | (ymax[nodes] < qymin))
+                nodes = nodes[hit]
+                if len(nodes) == 0:
+                    break
+                nodes = expandRanges(start[nodes], end[nodes])
+            if len(nodes):
+                xmin, ymin, xmax, ymax = self.items
+                hit = ~((xmin[nodes] > qxmax) | (xmax[nodes] < qxmin) | (ymin[nodes] > qymax) | (ymax[nodes] < qymin))
+                res = self.order[nodes[hit]]
+        if len(self.extraIds):
+            xmin, ymin, xmax, ymax = self.extraItems
+            hit = ~((xmin > qxmax) | (xmax < qxmin) | (ymin > qymax) | (ymax < qymin))
+            res = np.concatenate([res, self.extraIds[hit]])
+        res.sort()
+        return res
+
+    def save(self, fileName):
+        ''' Write index into .npz file, atomically: temp file in the same folder, unique per writer
+        '''
+        arrays = {'order': self.order, 'items': np.vstack(self.items),
+            'meta': np.array([formatVersion, self.nodeCapacity, len(self.levels)], dtype=np.int64),
+            'stamp': np.array([self.stamp]),
+            'extraIds': self.extraIds, 'extraItems': np.vstack(self.extraItems)}
+        for k, level in enumerate(self.levels):
+            arrays['level%d' % k] = np.vstack([a.astype(np.float64) for a in level])
+        fd, tmpName = tempfile.mkstemp('.tmp', os.path.basename(fileName) + '.', os.path.dirname(fileName) or '.')
+        try:
+            fh = os.fdopen(fd, 'wb')
+            try:
+                np.savez(fh, **arrays) # file object: no .npz appended
+            finally:
+                fh.close()
+            os.chmod(tmpName, 0644) # mkstemp file is private, index is read by other accounts too
+            if os.path.exists(fileName):
+                os.remove(fileName)
+            os.rename(tmpName, fileName)
+        except Exception:
+            if os.path.exists(tmpName):
+                os.remove(tmpName)
+            raise
+
+    @classmethod
+    def load(cls, fileName):
+        ''' Read index from .npz file
+        '''
+        data = np.load(fileName)
+        try:
+            version, capacity, nlevels = [int(x) for x in data['meta']]
+            if version != formatVersion:
+                raise NameError("Unknown spatial index format version '%s' in '%s'" % (version, fileName))
+            tree = cls(nodeCapacity=capacity, stamp=str(data['stamp'][0]))
+            tree.order = data['order'].astype(np.int64)
+            tree.items = tuple(data['items'])
+            for k in range(nlevels):
+                a = data['level%d' % k]
+                tree.levels.append((a[0], a[1], a[2], a[3], a[4].astype(np.int64), a[5].astype(np.int64)))
+            if 'extraIds' in data.files: # files saved before edits support have no extra list
+                tree.extraIds = data['extraIds'].astype(np.int64)
+                tree.extraItems = tuple(data['extraItems'])
+        finally:
+            data.close()
+        return tree
+#class STRTree(object):
+
+
+def segmentsTree(profiles, stamp=''):
+    ''' Build STRTree over seismoclip.ProfileSet segments bounding boxes
+    '''
+    x0, y0, x1, y1, segPart = profiles.segments()
+    return STRTree(np.minimum(x0, x1), np.minimum(y0, y1), np.maximum(x0, x1), np.maximum(y0, y1), stamp=stamp)
+#def segmentsTree(profiles, stamp=''):
+
+
+def loadOrBuild(fileName, profiles, stamp='', log=None):
+    ''' Segments index for profiles: from process cache, from file or build and save new one.
+    Index from file with other data stamp is stale and will be rebuilt.
+    Failure to save index (read-only share) is not an error.
+    '''
+    tree = _indexCache.get(fileName)
+    if tree is not None and tree.stamp == stamp and tree.itemCount == profiles.segmentCount():
+        return tree
+    tree = None
+    if os.path.exists(fileName):
+        try:
+            tree = STRTree.load(fileName)
+        except Exception, e:
+            if log: log.warning("seismoindex.loadOrBuild, can't read index '%s': %s" % (fileName, e))
+        if tree is not None and (tree.stamp != stamp or tree.itemCount != profiles.segmentCount()):
+            if log: log.info("seismoindex.loadOrBuild, index '%s' is stale, stamp '%s'" % (fileName, tree.stamp))
+            tree = None
+    if tree is None:
+        tree = segmentsTree(profiles, stamp)
+        try:
+            tree.save(fileName)
+        except Exception, e:
+            if log: log.warning("seismoindex.loadOrBuild, can't save index '%s': %s" % (fileName, e))
+    _indexCache[fileName] = tree
+    return tree
+#def loadOrBuild(fileName, profiles, stamp='', log=None):
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(verbose=True)
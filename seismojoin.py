@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# (c) Valik mailto:vasnake@gmail.com
+
+'''
+Partitioned join of polygon layer and seismoprofiles for Seismodensity project
+
+Licensing round (thousands of overlapping polygons) scored by N density calls costs N x M:
+every polygon clips all its candidates against all its edges.
+Here both layers go through one uniform grid over polygons extent:
+    profiles segments split by grid cells once (seismogrid.splitByGrid), pieces sorted by cell,
+    cell total length summed;
+    polygon edges split by the same grid: cells touched by edges are boundary cells of polygon;
+    other cells of polygon envelope are entirely inside or outside, inside test for cell center
+    by scanline (edges crossings of cell rows centers line, counted to the right of center),
+    inside cells give their totals w/o clip;
+    boundary cells pieces clipped, by grid rows, against edges near the row only (seismosession.clipNear).
+Cost is segments and edges split, sort of pieces and for each polygon its boundary pieces
+times edges near them - about (N + M) log(N + M) + K, K is pieces near polygons boundaries.
+Grid cell holds about perCell segments.
+
+Doctests
+>>> prof = seismoclip.ProfileSet.fromParts([[(x, 0), (x, 100)] for x in range(1, 100, 2)] + [[(0, 50), (100, 50)]])
+>>> polygons = [[[[10, 10], [10, 90], [90, 90], [90, 10], [10, 10]]],
+...     [[[0, 0], [0, 100], [100, 100], [100, 0], [0, 0]]],
+...     [[[20, 20], [20, 80], [80, 20], [20, 20]]],
+...     [[[200, 200], [200, 300], [300, 300], [200, 200]]]]
+>>> lengths = joinLengths(prof, polygons, cellSize=7.0)
+>>> lengths == [seismoclip.clippedLength(prof, rings) for rings in polygons]
+True
+>>> lengths
+[3280.0, 5100.0, 930.0, 0.0]
+>>> joinDensity(prof, [(1, polygons[0]), (2, []), (3, polygons[2])])[1:]
+[(2, -1.0, -1.0, -1.0), (3, 516.6666666666666, 0.9299999999999999, 0.0018)]
+'''
+
+import math
+import numpy as np
+
+import seismoclip
+import seismogrid
+import seismosession
+from seismoindex import expandRanges
+
+perCell = 32 # profiles segments per grid cell
+maxCells = 1 << 24 # grid cells limit
+localEdges = 256 # polygon with more edges: boundary pieces clipped by rows, against near edges only
+smallEnvelope = 16 # polygon envelope cells: all pieces clipped, no inside test of cells
+
+
+def gridCellSize(extent, segmentCount, count=perCell):
+    ''' Cell size for about count segments per cell over extent, not more than maxCells cells
+    '''
+    xmin, ymin, xmax, ymax = extent
+    w, h = max(xmax - xmin, 1e-9), max(ymax - ymin, 1e-9)
+    size = math.sqrt(w * h * count / float(max(segmentCount, 1)))
+    return max(size, math.sqrt(w * h / float(maxCells)), 1e-9)
+#def gridCellSize(extent, segmentCount, count=perCell):
+
+
+class LayerGrid(object):
+    ''' Profiles segments pieces by uniform grid cells (CSR, row 0 north) and cells totals
+    '''
+
+    def __init__(self, profiles, extent, cellSize=None):
+        x0, y0, x1, y1, segPart = profiles.segments()
+        xmin, ymin, xmax, ymax = extent
+        near = np.nonzero((np.maximum(x0, x1) >= xmin) & (np.minimum(x0, x1) <= xmax) &
+            (np.maximum(y0, y1) >= ymin) & (np.minimum(y0, y1) <= ymax))[0]
+        self.cellSize = cellSize or gridCellSize(extent, len(near))
+        self.ncols, self.nrows = seismogrid.gridShape(extent, self.cellSize)
+        self.xmin, self.ymax = xmin, ymin + self.nrows * self.cellSize
+        self.extent = (xmin, ymin, xmin + self.ncols * self.cellSize, self.ymax)
+
+        segNo, ta, tb, col, row = seismogrid.splitByGrid(x0[near], y0[near], x1[near], y1[near], self.extent, self.cellSize)
+        seg = near[segNo]
+        dx, dy = x1[seg] - x0[seg], y1[seg] - y0[seg]
+        cell = row * self.ncols + col
+        order = np.argsort(cell, kind='mergesort')
+        seg, ta, tb, cell = seg[order], ta[order], tb[order], cell[order]
+        self.px0, self.py0 = x0[seg] + ta * dx[order], y0[seg] + ta * dy[order]
+        self.px1, self.py1 = x0[seg] + tb * dx[order], y0[seg] + tb * dy[order]
+        ncells = self.ncols * self.nrows
+        self.cellStart = np.concatenate([[0], np.cumsum(np.bincount(cell, minlength=ncells))]).astype(np.int64)
+        self.totals = np.bincount(cell, weights=np.hypot(self.px1 - self.px0, self.py1 - self.py0), minlength=ncells)
+
+    def boundaryCells(self, edges):
+        ''' Cells numbers touched by polygon edges, cell borders included
+        '''
+        ex0, ey0, ex1, ey1 = edges
+        no, ta, tb, col, row = seismogrid.splitByGrid(ex0, ey0, ex1, ey1, self.extent, self.cellSize)
+        cells = [row * self.ncols + col]
+        dx, dy = ex1[no] - ex0[no], ey1[no] - ey0[no]
+        for t in (ta, tb):
+            u = (ex0[no] + t * dx - self.xmin) / self.cellSize
+            v = (self.ymax - (ey0[no] + t * dy)) / self.cellSize
+            for c in (np.floor(u), np.ceil(u) - 1):
+                for r in (np.floor(v), np.ceil(v) - 1):
+                    ok = (c >= 0) & (c < self.ncols) & (r >= 0) & (r < self.nrows)
+                    cells.append(r[ok].astype(np.int64) * self.ncols + c[ok].astype(np.int64))
+        return np.unique(np.concatenate(cells))
+
+    def envelopeCells(self, extent):
+        ''' (rows, cols) of cells overlapping extent
+        '''
+        xmin, ymin, xmax, ymax = extent
+        c0 = int(max(0, math.floor((xmin - self.xmin) / self.cellSize)))
+        c1 = int(min(self.ncols - 1, math.floor((xmax - self.xmin) / self.cellSize)))
+        r0 = int(max(0, math.floor((self.ymax - ymax) / self.cellSize)))
+        r1 = int(min(self.nrows - 1, math.floor((self.ymax - ymin) / self.cellSize)))
+        if c1 < c0 or r1 < r0:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        rows, cols = np.mgrid[r0:r1 + 1, c0:c1 + 1]
+        return (rows.ravel().astype(np.int64), cols.ravel().astype(np.int64))
+
+    def centersInside(self, rows, cols, edges):
+        ''' Inside test for cells centers by scanline: +X ray crossings of cell row center line
+        '''
+        if len(rows) == 0:
+            return np.zeros(0, dtype=bool)
+        ex0, ey0, ex1, ey1 = edges
+        cs = self.cellSize
+        r0, r1 = rows.min(), rows.max()
+        lo, hi = np.minimum(ey0, ey1), np.maximum(ey0, ey1)
+        ra = np.clip(np.floor((self.ymax - hi) / cs - 0.5), r0, r1 + 1).astype(np.int64)
+        rb = np.clip(np.ceil((self.ymax - lo) / cs - 0.5) + 1, r0, r1 + 1).astype(np.int64)
+        eNo = np.repeat(np.arange(len(ex0)), rb - ra)
+        eRow = expandRanges(ra, rb)
+        yc = self.ymax - (eRow + 0.5) * cs
+        cross = (ey0[eNo] > yc) != (ey1[eNo] > yc) # the same rule as seismoclip.pointsInPolygon
+        eNo, eRow, yc = eNo[cross], eRow[cross], yc[cross]
+        xc = ex0[eNo] + (yc - ey0[eNo]) * (ex1[eNo] - ex0[eNo]) / (ey1[eNo] - ey0[eNo])
+        # row and x in one sorted key: row * 2 + x in [0, 1]
+        xmin, span = self.xmin, self.ncols * cs
+        keys = np.sort((eRow - r0) * 2.0 + np.clip((xc - xmin) / span, 0, 1))
+        cellKeys = (rows - r0) * 2.0 + ((cols + 0.5) * cs) / span
+        right = np.searchsorted(keys, (rows - r0) * 2.0 + 1.5) - np.searchsorted(keys, cellKeys, 'right')
+        return (right % 2) == 1
+
+    def polygonLength(self, rings):
+        ''' Profiles length inside polygon, meters
+        '''
+        edges = seismoclip.ringsEdges(rings)
+        if len(edges[0]) == 0:
+            return 0.0
+        rows, cols = self.envelopeCells(seismoclip.ringsExtent(rings))
+        cells = rows * self.ncols + cols
+        keep = self.totals[cells] > 0
+        rows, cols, cells = rows[keep], cols[keep], cells[keep]
+        parts = []
+        if len(cells) <= smallEnvelope:
+            boundary = np.ones(len(cells), dtype=bool)
+        else:
+            boundary = np.in1d(cells, self.boundaryCells(edges))
+            inner = ~boundary
+            inside = self.centersInside(rows[inner], cols[inner], edges)
+            parts.append(math.fsum(self.totals[cells[inner][inside]]))
+
+        rows, cells = rows[boundary], cells[boundary]
+        pieces = expandRanges(self.cellStart[cells], self.cellStart[cells + 1])
+        pieceRow = np.repeat(rows, self.cellStart[cells + 1] - self.cellStart[cells])
+        px0, py0, px1, py1 = self.px0[pieces], self.py0[pieces], self.px1[pieces], self.py1[pieces]
+        if len(edges[0]) <= localEdges:
+            parts.append(math.fsum(seismoclip.segmentsInsideLength(px0, py0, px1, py1, edges)))
+        else:
+            order = np.argsort(pieceRow, kind='mergesort')
+            pieceRow = pieceRow[order]
+            px0, py0, px1, py1 = px0[order], py0[order], px1[order], py1[order]
+            bounds = np.concatenate([[0], np.nonzero(np.diff(pieceRow))[0] + 1, [len(pieceRow)]])
+            for a, b in zip(bounds[:-1], bounds[1:]):
+                parts.append(math.fsum(seismosession.clipNear(px0[a:b], py0[a:b], px1[a:b], py1[a:b], edges)))
+        return math.fsum(parts)
+#class LayerGrid(object):
+
+
+def joinLengths(profiles, polygons, cellSize=None, log=None):
+    ''' Profiles length inside each polygon (list of rings), meters, one grid for all polygons
+    '''
+    extents = [seismoclip.ringsExtent(rings) for rings in polygons if len(seismoclip.ringsEdges(rings)[0])]
+    if not extents:
+        return [0.0] * len(polygons)
+    ext = np.array(extents)
+    grid = LayerGrid(profiles, (ext[:, 0].min(), ext[:, 1].min(), ext[:, 2].max(), ext[:, 3].max()), cellSize)
+    if log: log.info("seismojoin.joinLengths, '%s' polygons, grid '%s' x '%s', cell '%.1f', pieces '%s'" % (
+        len(polygons), grid.ncols, grid.nrows, grid.cellSize, len(grid.px0)))
+    return [grid.polygonLength(rings) for rings in polygons]
+#def joinLengths(profiles, polygons, cellSize=None, log=None):
+
+
+def joinDensity(profiles, polygons, log=None):
+    ''' Density for polygon layer by partitioned join, same answer as seismoclip.calcDensityBatch.
+
+    polygons: iterable of (id, rings).
+    Return list of (id, density km/km2, length km, area km2); invalid rings repaired (seismorepair),
+    wrong polygon gives -1.0 values.
+    '''
+    import seismorepair
+    ids, valid, areas = [], [], []
+    for pid, rings in polygons:
+        try:
+            rings, problems = seismorepair.repairRings(rings)
+            if problems and log: log.info("seismojoin.joinDensity, polygon '%s' repaired: %s" % (pid, ', '.join(problems)))
+            area = seismoclip.polygonArea(rings) / 1000000.0
+            if area <= 0:
+                raise NameError("Wrong input polygon, you should send no selfintersected clockwise drawed single ring")
+        except Exception, e:
+            if log: log.warning("seismojoin.joinDensity, polygon '%s' failed: %s" % (pid, e))
+            rings, area = None, -1.0
+        ids.append(pid)
+        areas.append(area)
+        if rings is not None:
+            valid.append(rings)
+    lengths = iter(joinLengths(profiles, valid, log=log))
+    res = []
+    for pid, area in zip(ids, areas):
+        if area <= 0:
+            res.append((pid, -1.0, -1.0, -1.0))
+        else:
+            length = next(lengths) / 1000.0
+            res.append((pid, length / area, length, area))
+    return res
+#def joinDensity(profiles, polygons, log=None):
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(verbose=True)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# (c) Valik mailto:vasnake@gmail.com
+
+'''
+Queued logging for Seismodensity project
+
+Tool scripts logged every job synchronously by RotatingFileHandler into log file on UNC share
+(tool folder), with full input FeatureSet text and SQL: many-vertex polygon gave
+megabytes of blocking network writes per request.
+Here log records go into bounded in-memory queue (QueueHandler), background thread (QueueListener)
+writes them into rotating file; full queue drops records (counted, see dropped), request never waits.
+Listener lives as long as process (GP server reuses it for many jobs), queue drained at process exit.
+Large payloads (input FeatureSet, SQL with polygon WKT) logged by logPayload:
+    DEBUG level - full text;
+    INFO level - abridged by payloadPolicy to payloadLimit chars,
+    every payloadFullEvery-th payload full anyway (sampling, 0 - never).
+Python 2 logging has no QueueHandler/QueueListener (3.2+), both are here.
+
+Doctests
+>>> import tempfile, shutil
+>>> tmp = tempfile.mkdtemp()
+>>> lg = logging.getLogger('seismolog.test')
+>>> listener = setupLogger(lg, os.path.join(tmp, 'test.log'), logging.INFO)
+>>> setupLogger(lg, os.path.join(tmp, 'test.log')) is listener
+True
+>>> logPayload(lg, "input '%s'", 'x' * 5000, limit=20)
+>>> lg.debug("geometry dump")
+>>> listener.stop()
+>>> [line.split(' - ')[-1] for line in open(os.path.join(tmp, 'test.log')).read().splitlines()]
+["input 'xxxxxxxxxx ... xxxxxxxxxx (5000 chars)'"]
+>>> abridge('0123456789', 4, 'head'), abridge('0123456789', 4), abridge('0123', 4)
+('0123 ... (10 chars)', '01 ... 89 (10 chars)', '0123')
+>>> shutil.rmtree(tmp)
+'''
+
+import os
+import atexit
+import logging
+import logging.handlers
+import threading
+try:
+    import Queue as queue
+except ImportError: # python 3
+    import queue
+
+queueSize = 10000 # records waiting for writer, more - dropped
+payloadPolicy = 'headtail' # 'head' - first payloadLimit chars, 'headtail' - first and last halves, 'full'
+payloadLimit = 1000 # chars of payload in INFO record
+payloadFullEvery = 0 # every N-th payload logged in full at INFO level, 0 - never
+logFormat = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+maxBytes = 1000000 # log file size, 5 files
+backupCount = 5
+
+_payloads = [0] # payloads counter for sampling
+
+
+class QueueHandler(logging.Handler):
+    ''' Put records into queue, record message formatted in caller thread (args may change later).
+    Queue is full: record dropped and counted.
+    '''
+
+    def __init__(self, q):
+        logging.Handler.__init__(self)
+        self.queue = q
+        self.dropped = 0
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+#class QueueHandler(logging.Handler):
+
+
+class QueueListener(object):
+    ''' Background thread: records from queue to handlers
+    '''
+    _stop = None # queue sentinel
+
+    def __init__(self, q, *handlers):
+        self.queue = q
+        self.handlers = handlers
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._monitor, name='seismolog')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _monitor(self):
+        while True:
+            record = self.queue.get()
+            if record is self._stop:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        ''' Write all queued records and stop thread; waits for writes
+        '''
+        if self._thread is None:
+            return
+        self.queue.put(self._stop)
+        self._thread.join()
+        self._thread = None
+        for handler in self.handlers:
+            handler.flush()
+#class QueueListener(object):
+
+
+def setupLogger(log, fileName, level=logging.DEBUG, size=queueSize):
+    ''' Queued rotating file log: QueueHandler added to log, QueueListener thread started.
+    Called for each job in the same process: returns listener created at first call.
+    '''
+    if hasattr(log, 'vFHandle'):
+        return log.vFHandle.listener
+    log.setLevel(level)
+    fh = logging.handlers.RotatingFileHandler(fileName, maxBytes=maxBytes, backupCount=backupCount, encoding='utf-8')
+    fh.setFormatter(logging.Formatter(logFormat))
+    q = queue.Queue(size)
+    qh = QueueHandler(q)
+    qh.listener = QueueListener(q, fh)
+    qh.listener.start()
+    log.addHandler(qh)
+    log.vFHandle = qh
+    atexit.register(qh.listener.stop)
+    return qh.listener
+#def setupLogger(log, fileName, level=logging.DEBUG, size=queueSize):
+
+
+def dropped(log):
+    ''' Records dropped by full queue since logger setup
+    '''
+    handler = getattr(log, 'vFHandle', None)
+    return getattr(handler, 'dropped', 0)
+
+
+def abridge(text, limit=None, policy=None):
+    ''' Payload text shortened to limit chars by policy, with original size
+    '''
+    limit = limit or payloadLimit
+    policy = policy or payloadPolicy
+    if policy == 'full' or len(text) <= limit:
+        return text
+    if policy == 'head':
+        return "%s ... (%s chars)" % (text[:limit], len(text))
+    half = limit // 2
+    return "%s ... %s (%s chars)" % (text[:half], text[-half:], len(text))
+#def abridge(text, limit=None, policy=None):
+
+
+def logPayload(log, msg, text, limit=None, policy=None):
+    ''' Log msg % text: full text at DEBUG level, abridged at INFO (sampled full every payloadFullEvery).
+    Nothing formatted if log level is higher.
+    '''
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(msg % (text, ))
+        return
+    if not log.isEnabledFor(logging.INFO):
+        return
+    text = '%s' % (text, )
+    _payloads[0] += 1
+    if payloadFullEvery and _payloads[0] % payloadFullEvery == 0:
+        log.info(msg % (text, ))
+        return
+    log.info(msg % (abridge(text, limit, policy), ))
+#def logPayload(log, msg, text, limit=None, policy=None):
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(verbose=True)
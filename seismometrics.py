@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# (c) Valik mailto:vasnake@gmail.com
+
+'''
+Timing and metrics for Seismodensity project
+
+One JobMetrics per GP job (or service request), current for its thread:
+phases durations by monotonic clock, counts (vertices, candidates)
+and values (cache hit or miss, engine).
+Job record written as one JSON line (metricsFName in tool scripts),
+phases durations added to in-process histograms (stats), stats.summary() gives p50/p95/p99.
+
+Usage
+    job = seismometrics.startJob('nosql')
+    with seismometrics.phase('describe'):
+        desc = arcpy.Describe(fc)
+    seismometrics.count('candidates', len(segIdx)) # anywhere in job thread, no-op w/o job
+    @seismometrics.timed('clip')
+    def clip(...)
+    job.finish(metricsFile, log)
+
+Doctests
+>>> job = startJob('test', PhaseStats())
+>>> with phase('cursor'):
+...     count('vertices', 5)
+>>> setValue('cache', 'miss')
+>>> rec = job.finish()
+>>> sorted(rec['phases']), rec['counts'], rec['values'], rec['job']
+(['cursor'], {'vertices': 5}, {'cache': 'miss'}, 'test')
+>>> currentJob() is None
+True
+>>> sorted(job.stats.summary())
+['cursor', 'total']
+>>> [round(x, 2) for x in percentiles(range(1, 11), (50, 95, 99))]
+[5.5, 9.55, 9.91]
+'''
+
+import sys, time
+import json
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+try:
+    clock = time.monotonic # python 3.3+
+except AttributeError:
+    if sys.platform == 'win32':
+        clock = time.clock # QueryPerformanceCounter, wall clock changes don't affect it
+    else:
+        clock = time.time
+
+maxSamples = 1000 # per phase, latest durations for percentiles
+quantiles = (50, 95, 99)
+
+_local = threading.local()
+_writeLock = threading.Lock()
+
+
+def percentiles(values, pcts=quantiles):
+    ''' Percentiles with linear interpolation between closest ranks
+    '''
+    vals = sorted(values)
+    if not vals:
+        return [0.0 for p in pcts]
+    res = []
+    for p in pcts:
+        pos = (len(vals) - 1) * p / 100.0
+        lo = int(pos)
+        hi = min(lo + 1, len(vals) - 1)
+        res.append(vals[lo] + (vals[hi] - vals[lo]) * (pos - lo))
+    return res
+#def percentiles(values, pcts=quantiles):
+
+
+class PhaseStats(object):
+    ''' In-process histograms: latest maxSamples durations per phase
+    '''
+
+    def __init__(self, maxSamples=maxSamples):
+        self.maxSamples = maxSamples
+        self._samples = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        self._lock.acquire()
+        try:
+            if name not in self._samples:
+                self._samples[name] = deque(maxlen=self.maxSamples)
+                self._counts[name] = 0
+            self._samples[name].append(seconds)
+            self._counts[name] += 1
+        finally:
+            self._lock.release()
+
+    def summary(self):
+        ''' phase => {'count': n, 'p50': sec, 'p95': sec, 'p99': sec}
+        '''
+        self._lock.acquire()
+        try:
+            samples = dict((k, list(v)) for k, v in self._samples.items())
+            counts = dict(self._counts)
+        finally:
+            self._lock.release()
+        res = {}
+        for name, vals in samples.items():
+            item = {'count': counts[name]}
+            for p, val in zip(quantiles, percentiles(vals, quantiles)):
+                item['p%s' % p] = val
+            res[name] = item
+        return res
+#class PhaseStats(object):
+
+
+stats = PhaseStats() # process wide
+
+
+class JobMetrics(object):
+    ''' Phases durations, counts and values of one job
+    '''
+
+    def __init__(self, job, stats=stats):
+        self.job = job
+        self.stats = stats
+        self.started = clock()
+        self.startTime = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.phases = {}
+        self.counts = {}
+        self.values = {}
+
+    @contextmanager
+    def phase(self, name):
+        ''' Time block as phase; repeated phase durations summed
+        '''
+        start = clock()
+        try:
+            yield self
+        finally:
+            self.addPhase(name, clock() - start)
+
+    def addPhase(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count(self, name, num=1):
+        self.counts[name] = self.counts.get(name, 0) + num
+
+    def setValue(self, name, value):
+        self.values[name] = value
+
+    def record(self):
+        return {'job': self.job, 'time': self.startTime, 'total': clock() - self.started,
+            'phases': self.phases, 'counts': self.counts, 'values': self.values}
+
+    def finish(self, fileName='', log=None, error=None):
+        ''' Stop job: add phases to stats, write JSON line if fileName, return record.
+        Errors on write logged only.
+        '''
+        if getattr(_local, 'job', None) is self:
+            _local.job = None
+        if error is not None:
+            self.setValue('error', '%s' % error)
+        rec = self.record()
+        if self.stats is not None:
+            for name, seconds in self.phases.items():
+                self.stats.add(name, seconds)
+            self.stats.add('total', rec['total'])
+        if fileName:
+            try:
+                writeRecord(fileName, rec)
+            except Exception, e:
+                if log: log.warning("seismometrics.finish, can't write metrics file '%s': %s" % (fileName, e))
+        if log: log.info("metrics %s" % json.dumps(rec, sort_keys=True))
+        return rec
+#class JobMetrics(object):
+
+
+def writeRecord(fileName, rec):
+    ''' Append record as JSON line
+    '''
+    line = json.dumps(rec, sort_keys=True) + '\n'
+    _writeLock.acquire()
+    try:
+        fh = open(fileName, 'a')
+        try:
+            fh.write(line)
+        finally:
+            fh.close()
+    finally:
+        _writeLock.release()
+#def writeRecord(fileName, rec):
+
+
+def startJob(job, stats=stats):
+    ''' New JobMetrics, current for this thread
+    '''
+    _local.job = JobMetrics(job, stats)
+    return _local.job
+#def startJob(job, stats=stats):
+
+
+def currentJob():
+    return getattr(_local, 'job', None)
+
+
+@contextmanager
+def useJob(job):
+    ''' Make job current for this thread inside block, e.g. in worker thread computing request of other thread
+    '''
+    prev = currentJob()
+    _local.job = job
+    try:
+        yield job
+    finally:
+        _local.job = prev
+#def useJob(job):
+
+
+def count(name, num=1):
+    ''' Add to current job counter, no job - no-op
+    '''
+    job = currentJob()
+    if job is not None:
+        job.count(name, num)
+
+
+def setValue(name, value):
+    job = currentJob()
+    if job is not None:
+        job.setValue(name, value)
+
+
+@contextmanager
+def phase(name):
+    ''' Time block as phase of current job, no job - no-op
+    '''
+    job = currentJob()
+    if job is None:
+        yield None
+    else:
+        with job.phase(name):
+            yield job
+#def phase(name):
+
+
+def timed(name):
+    ''' Decorator: function call timed as phase of current job
+    '''
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+#def timed(name):
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(verbose=True)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# (c) Valik mailto:vasnake@gmail.com
+
+'''
+Parallel profiles clipping for Seismodensity project
+
+Very large polygon (whole basin, thousands of vertices) with no pyramid or below pyramid threshold
+gives millions of index candidates, clipped in one thread. ClipPool splits candidates into chunks
+by segment number (offset range in profiles store) and clips chunks in worker processes.
+Workers open the same store build as pool (seismostore.openStore with pool header), coordinates are memory mapped:
+all processes share one page cache, only polygon edges and segment numbers are sent to workers.
+Each chunk returns clipped lengths of segments touching polygon, parent sums them all by math.fsum,
+so result is identical to serial seismoclip.clippedLength (fsum doesn't depend on order or chunking).
+
+multiprocessing.Pool, not concurrent.futures: tool scripts and service run on ArcGIS Python 2.
+
+Usage
+    pool = ClipPool(storeDir, processes=4)
+    if len(segIdx) >= pool.minSegments:
+        length = pool.clippedLength(rings, segIdx)
+    pool.close()
+
+Doctests
+>>> import tempfile, shutil
+>>> tmp = tempfile.mkdtemp()
+>>> rng = np.random.RandomState(1)
+>>> pts = rng.uniform(0, 1000, (2000, 2, 2))
+>>> prof = seismoclip.ProfileSet.fromParts([[tuple(a), tuple(b)] for a, b in pts])
+>>> seismostore.exportStore(tmp, prof)
+>>> rings = [[(100, 100), (150, 900), (900, 800), (500, 500), (800, 150), (100, 100)]]
+>>> pool = ClipPool(tmp, processes=2)
+>>> pool.clippedLength(rings) == seismoclip.clippedLength(prof, rings)
+True
+>>> segIdx = np.arange(0, 2000, 3)
+>>> pool.clippedLength(rings, segIdx) == seismoclip.clippedLength(prof, rings, segIdx)
+True
+>>> pool.clippedLength(rings, segIdx[:0])
+0.0
+>>> pool.build = (5, pool.build[1]) # segment numbers of other build
+>>> pool.clippedLength(rings) # doctest: +ELLIPSIS
+Traceback (most recent call last):
+...
+NameError: Worker store build (1, ...) is not pool build (5, ...)
+>>> pool.close(); shutil.rmtree(tmp)
+'''
+
+import os, sys
+import math
+import multiprocessing
+import numpy as np
+
+import seismoclip
+import seismostore
+import seismometrics
+
+minSegments = 200000 # candidates, less clipped serially: pool messaging costs more than clip
+chunksPerProcess = 4 # chunks are not equal in work, more chunks - better balance
+chunkTimeout = 600 # seconds, for all chunks of one polygon
+
+_profiles = None # worker process store, opened by _initWorker
+
+
+def buildKey(header):
+    ''' Store build of header: (build number, build folder)
+    '''
+    return (header.get('build'), header.get('dataDir'))
+
+
+def _initWorker(storeDir, header):
+    ''' Pool initializer: open store build of pool header in worker process
+    '''
+    global _profiles
+    _profiles = seismostore.openStore(storeDir, header)
+
+
+def _clipChunk(args):
+    ''' Clipped lengths of chunk segments touching polygon, in worker process.
+    args: (build, edges, start, stop, segIdx); build - buildKey segment numbers belong to,
+    segIdx None - segments range start:stop.
+    '''
+    build, edges, start, stop, segIdx = args
+    if tuple(build) != buildKey(_profiles.header):
+        raise NameError("Worker store build %s is not pool build %s" % (buildKey(_profiles.header), tuple(build)))
+    x0, y0, x1, y1, segPart = _profiles.segments()
+    if segIdx is None:
+        segIdx = slice(start, stop)
+    lengths = seismoclip.segmentsInsideLength(x0[segIdx], y0[segIdx], x1[segIdx], y1[segIdx], edges)
+    return lengths[lengths != 0]
+#def _clipChunk(args):
+
+
+def setExecutable():
+    ''' In ArcMap/ArcCatalog sys.executable is application, not python;
+    worker processes on Windows must be started by python.exe from ArcGIS Python folder
+    '''
+    if sys.platform != 'win32':
+        return
+    if os.path.basename(sys.executable).lower().startswith('python'):
+        return
+    multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'python.exe'))
+#def setExecutable():
+
+
+class ClipPool(object):
+    ''' Worker processes clipping store segments by chunks
+    '''
+
+    def __init__(self, storeDir, processes=None, minSegments=minSegments, chunksPerProcess=chunksPerProcess,
+            header=None):
+        ''' processes None: CPU count;
+        header: store build to open (opened ProfileSet header), current build if None
+        '''
+        if header is None:
+            header = seismostore.readHeader(storeDir)
+        if header is None:
+            raise NameError("Store '%s' not found" % storeDir)
+        self.storeDir = storeDir
+        self.build = buildKey(header)
+        self.segmentCount = header['segmentCount']
+        self.processes = processes or multiprocessing.cpu_count()
+        self.minSegments = minSegments
+        self.chunkCount = self.processes * chunksPerProcess
+        setExecutable()
+        self._pool = multiprocessing.Pool(self.processes, _initWorker, (storeDir, header))
+
+    def chunks(self, edges, segIdx=None):
+        ''' Tasks for workers: segments ranges or sorted candidates parts
+        '''
+        if segIdx is None:
+            bounds = np.linspace(0, self.segmentCount, self.chunkCount + 1).astype(np.int64)
+            return [(self.build, edges, int(a), int(b), None) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+        segIdx = np.sort(np.asarray(segIdx, dtype=np.int64)) # memmap pages locality
+        return [(self.build, edges, 0, 0, part) for part in np.array_split(segIdx, self.chunkCount) if len(part)]
+
+    def clippedLength(self, rings, segIdx=None):
+        ''' Sum length of profiles parts inside polygon, meters, same as seismoclip.clippedLength.
+        segIdx: candidates segments numbers, all store segments otherwise.
+        '''
+        edges = seismoclip.ringsEdges(rings)
+        if len(edges[0]) == 0:
+            return 0.0
+        tasks = self.chunks(edges, segIdx)
+        if not tasks:
+            return 0.0
+        seismometrics.count('chunks', len(tasks))
+        parts = self._pool.map_async(_clipChunk, tasks).get(chunkTimeout)
+        return math.fsum(np.concatenate(parts))
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+#class ClipPool(object):
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(verbose=True)
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# (c) Valik mailto:vasnake@gmail.com
+
+'''
+Cost-based engine planner for Seismodensity project
+
+Caller had to pick seismodensity.py (Oracle calc_seismodensity) or seismodensitynosql.py (in-process clip),
+but the fastest engine depends on polygon size, vertex count and what is loaded already.
+Planner estimates each available engine cost, seconds, from cheap statistics (polygonStats):
+    candidates - profiles segments in polygon envelope, spatial index query if index is in process memory,
+        share of data extent otherwise; vertices - polygon vertices count;
+    cells - envelope size in length pyramid leaf cells; boundary - share of candidates near polygon boundary;
+    loaded state of engines (cold engine pays load or connect cost).
+Engines
+    service - resident seismoservice, request overhead plus warm clip (pyramid for large polygon);
+    memory - in-process clip of spatial index candidates (seismoclip);
+    pyramid - in-process length pyramid, clip of boundary cells candidates only (seismopyramid);
+    oracle - pooled cx_Oracle call of calc_seismodensity (seismodb).
+Cost model is linear in features (defaultCosts coefficients); self-tuning: after each run actual time
+is compared with raw estimate and engine factor moves to their ratio (exponential average of log ratio,
+weight alpha), so thresholds between engines follow measured costs of this server.
+Every exploreEvery-th plan runs least used engine if its estimate is within exploreRatio of the best,
+otherwise overestimated engine would never get a chance to correct its factor.
+Planner state (factors, runs, data extent) saved as JSON next to gdb.
+
+Doctests
+>>> stats = {'candidates': 20000, 'vertices': 5, 'cells': 4.0, 'boundary': 1.0, 'segmentCount': 10 ** 6}
+>>> pl = Planner()
+>>> pl.plan(stats, ['memory', 'oracle'], {'memory': True, 'oracle': True})[0]
+'memory'
+>>> pl.plan(stats, ['memory', 'oracle'], {'memory': False, 'oracle': True})[0]
+'oracle'
+>>> ratios = [pl.record('memory', stats, {'memory': True}, 10.0) for i in range(30)]
+>>> ratios[0] > 100, pl.factors['memory']
+(True, 100.0)
+>>> pl.plan(stats, ['memory', 'oracle'], {'memory': True, 'oracle': True})[0]
+'oracle'
+>>> Planner.fromJson(pl.toJson()).factors == pl.factors
+True
+>>> big = polygonStats([[[0, 0], [0, 900], [900, 900], [900, 0], [0, 0]]], extent=(0, 0, 1000, 1000), segmentCount=10 ** 6)
+>>> big['candidates'], big['vertices'], round(big['boundary'], 3)
+(810000, 5, 0.013)
+>>> Planner().plan(big, ['memory', 'pyramid'], {'memory': True, 'pyramid': True})[0]
+'pyramid'
+'''
+
+import os
+import math
+import json
+import tempfile
+
+import seismoclip
+
+engines = ('service', 'memory', 'pyramid', 'oracle')
+# seconds: fixed - per call; segment - per candidate; pair - per candidate x polygon vertex (clip);
+# vertex - per polygon vertex (transfer, SQL geometry); load - per profiles segment if engine is cold;
+# connect - cold Oracle pool. In-process terms measured by seismobench layouts (walk, 1e6 segments),
+# service and Oracle terms are first guesses, tuned by factors
+defaultCosts = {
+    'service': {'fixed': 0.02, 'segment': 1e-7, 'pair': 5e-8},
+    'memory': {'fixed': 0.0005, 'segment': 1e-7, 'pair': 5e-8, 'load': 5e-7},
+    'pyramid': {'fixed': 0.003, 'segment': 1e-7, 'pair': 5e-8, 'load': 1.5e-6},
+    'oracle': {'fixed': 0.15, 'segment': 1e-6, 'vertex': 2e-5, 'connect': 1.0},
+}
+pyramidMinCells = 64 # envelope leaf cells, smaller polygon gains nothing from pyramid
+alpha = 0.2 # weight of last run in factor
+factorLimits = (0.01, 100.0)
+exploreEvery = 50 # plans
+exploreRatio = 4.0 # explored engine estimate / best estimate
+
+_planners = {} # file name => Planner
+
+
+def polygonStats(rings, index=None, extent=None, segmentCount=0):
+    ''' Cheap statistics of polygon for planner, see module docstring.
+    index: loaded spatial index or None; extent, segmentCount: profiles data (from index if given)
+    '''
+    xmin, ymin, xmax, ymax = seismoclip.ringsExtent(rings)
+    vertices = sum(len(r) for r in rings)
+    if index is not None:
+        extent, segmentCount = index.extent(), index.itemCount
+        candidates = len(index.query((xmin, ymin, xmax, ymax)))
+    elif extent is not None:
+        dx = max(0.0, min(xmax, extent[2]) - max(xmin, extent[0]))
+        dy = max(0.0, min(ymax, extent[3]) - max(ymin, extent[1]))
+        dataArea = max((extent[2] - extent[0]) * (extent[3] - extent[1]), 1.0)
+        candidates = int(segmentCount * dx * dy / dataArea)
+    else:
+        candidates = segmentCount # nothing known, all of them
+    cells, boundary = 0.0, 1.0
+    if extent is not None and segmentCount:
+        import seismopyramid
+        leaf = seismopyramid.leafSize(extent, segmentCount)
+        cells = (xmax - xmin) * (ymax - ymin) / (leaf * leaf)
+        if cells > 0:
+            boundary = min(1.0, 2 * ((xmax - xmin) + (ymax - ymin)) / leaf / cells) # perimeter cells share
+    return {'candidates': candidates, 'vertices': vertices, 'cells': cells, 'boundary': boundary,
+        'segmentCount': segmentCount}
+#def polygonStats(rings, index=None, extent=None, segmentCount=0):
+
+
+def features(engine, stats, cold=False):
+    ''' Cost model terms of engine for polygon stats
+    '''
+    n, v = float(stats['candidates']), float(stats['vertices'])
+    if engine == 'pyramid' or (engine == 'service' and stats['cells'] >= pyramidMinCells):
+        n *= stats['boundary']
+    res = {'fixed': 1.0, 'segment': n, 'pair': n * v, 'vertex': v}
+    if cold:
+        res['load'] = float(stats['segmentCount'])
+        res['connect'] = 1.0
+    return res
+#def features(engine, stats, cold=False):
+
+
+class Planner(object):
+    ''' Engines cost estimates and their self-tuning factors
+    '''
+
+    def __init__(self, costs=None, factors=None, runs=None):
+        self.costs = costs or dict((e, dict(c)) for e, c in defaultCosts.items())
+        self.factors = factors or dict((e, 1.0) for e in engines)
+        self.runs = runs or dict((e, 0) for e in engines)
+        self.plans = 0
+        self.extent = None # profiles data extent and segments count, known from last loaded index
+        self.segmentCount = 0
+
+    def rawEstimate(self, engine, stats, cold=False):
+        ''' Seconds by cost model w/o factor
+        '''
+        coefs = self.costs[engine]
+        return sum(coefs.get(name, 0.0) * value for name, value in features(engine, stats, cold).items())
+
+    def estimate(self, engine, stats, cold=False):
+        return self.rawEstimate(engine, stats, cold) * self.factors.get(engine, 1.0)
+
+    def plan(self, stats, available, loaded):
+        ''' (engine, estimates dict engine => seconds) - cheapest of available engines;
+        loaded: engine => True if it's warm
+        '''
+        available = [e for e in available if e != 'pyramid' or stats['cells'] >= pyramidMinCells]
+        if not available:
+            raise NameError("No density engine available")
+        estimates = dict((e, self.estimate(e, stats, not loaded.get(e, True))) for e in available)
+        best = min(available, key=lambda e: estimates[e])
+        self.plans += 1
+        if self.plans % exploreEvery == 0:
+            near = [e for e in available if e != best and estimates[e] <= exploreRatio * estimates[best]]
+            if near:
+                best = min(near, key=lambda e: self.runs.get(e, 0))
+        return (best, estimates)
+
+    def record(self, engine, stats, loaded, seconds):
+        ''' Tune engine factor by actual run time; return actual / estimated ratio
+        '''
+        raw = max(self.rawEstimate(engine, stats, not loaded.get(engine, True)), 1e-6)
+        ratio = max(seconds, 1e-6) / raw
+        old = self.factors.get(engine, 1.0)
+        factor = math.exp((1 - alpha) * math.log(old) + alpha * math.log(ratio))
+        self.factors[engine] = min(max(factor, factorLimits[0]), factorLimits[1])
+        self.runs[engine] = self.runs.get(engine, 0) + 1
+        return max(seconds, 1e-6) / (raw * old)
+
+    def fail(self, engine):
+        ''' Engine failed: make it look twice as expensive
+        '''
+        self.factors[engine] = min(self.factors.get(engine, 1.0) * 2, factorLimits[1])
+
+    def toJson(self):
+        return json.dumps({'costs': self.costs, 'factors': self.factors, 'runs': self.runs,
+            'extent': self.extent, 'segmentCount': self.segmentCount}, sort_keys=True)
+
+    @classmethod
+    def fromJson(cls, text):
+        state = json.loads(text)
+        costs = dict((e, dict(c)) for e, c in defaultCosts.items())
+        for e, c in state.get('costs', {}).items(): # new terms in defaultCosts kept
+            costs.setdefault(str(e), {}).update(c)
+        pl = cls(costs, dict((str(e), f) for e, f in state.get('factors', {}).items()),
+            dict((str(e), n) for e, n in state.get('runs', {}).items()))
+        pl.extent = state.get('extent')
+        pl.segmentCount = state.get('segmentCount', 0)
+        return pl
+
+    def save(self, fileName):
+        ''' Write planner state, atomically: temp file in the same folder, unique per writer
+        '''
+        fd, tmpName = tempfile.mkstemp('.tmp', os.path.basename(fileName) + '.', os.path.dirname(fileName) or '.')
+        try:
+            fh = os.fdopen(fd, 'w')
+            try:
+                fh.write(self.toJson())
+            finally:
+                fh.close()
+            os.chmod(tmpName, 0644) # mkstemp file is private, planner state is read by other accounts too
+            if os.path.exists(fileName):
+                os.remove(fileName)
+            os.rename(tmpName, fileName)
+        except Exception:
+            if os.path.exists(tmpName):
+                os.remove(tmpName)
+            raise
+#class Planner(object):
+
+
+def getPlanner(fileName='', log=None):
+    ''' Process wide Planner, state read from file at first call; bad file - default costs
+    '''
+    pl = _planners.get(fileName)
+    if pl is not None:
+        return pl
+    pl = Planner()
+    if fileName and os.path.exists(fileName):
+        try:
+            fh = open(fileName)
+            try:
+                pl = Planner.fromJson(fh.read())
+            finally:
+                fh.close()
+        except Exception, e:
+            if log: log.warning("seismoplan.getPlanner, can't read planner file '%s': %s" % (fileName, e))
+    _planners[fileName] = pl
+    return pl
+#def getPlanner(fileName='', log=None):
+
+
+def savePlanner(pl, fileName, log=None):
+    ''' Save planner state if fileName, errors logged only
+    '''
+    if not fileName:
+        return
+    try:
+        pl.save(fileName)
+    except Exception, e:
+        if log: log.warning("seismoplan.savePlanner, can't write planner file '%s': %s" % (fileName, e))
+#def savePlanner(pl, fileName, log=None):
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(verbose=True)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# (c) Valik mailto:vasnake@gmail.com
+
+'''
+Coordinates transformation for Seismodensity project
+
+Input polygon comes in client SR (web map 102100/3857, 4326), seismoprofiles are in projected metric SR.
+Tools created new arcpy.SpatialReference and projected polygon by SearchCursor for every job,
+SQL tool went through WGS84 and Oracle st_transform'ed polygon back to profiles SR.
+Here transformer for (source wkid, target wkid) pair is prepared once per process and cached
+(Esri aliases normalized, 102100 is 3857); all rings vertices transformed in one call, NumPy arrays:
+    4326, 3857 (spherical Mercator) and WGS84 UTM zones (326zz, 327zz, Krueger series, sub-mm accuracy)
+    by formulas here, other pairs through geographic WGS84 if both sides are known;
+    other SR by pyproj if it is installed, otherwise by arcpy (projectAs of one multipoint,
+    SpatialReference objects cached too).
+
+Doctests
+>>> ring = [[6200000, 8000000], [6200000, 8100000], [6400000, 8100000], [6200000, 8000000]]
+>>> tr = getTransformer(102100, 32640)
+>>> tr is getTransformer(3857, 32640), tr.engine
+(True, 'numpy')
+>>> ['%.3f %.3f' % tuple(p) for p in transformRings([ring], 102100, 32640)[0]]
+['423231.777 6446736.358', '424248.242 6499151.436', '528582.589 6498519.964', '423231.777 6446736.358']
+>>> back = transformRings(transformRings([ring], 3857, 32640), 32640, 102100)
+>>> max(abs(a - b) for p, q in zip(ring, back[0]) for a, b in zip(p, q)) < 1e-4 # meters
+True
+>>> transformRings([ring], 102100, 3857) == [ring]
+True
+>>> utmZone(32640), utmZone(32737), utmZone(28410)
+((57.0, False), (39.0, True), None)
+'''
+
+import threading
+import numpy as np
+
+import seismoclip
+
+geographicWkid = 4326 # WGS84 degrees
+mercatorWkid = 3857 # WGS84 web mercator, Esri 102100
+sphereRadius = 6378137.0 # web mercator sphere
+wgs84 = (6378137.0, 1 / 298.257223563) # semimajor axis, flattening
+mercatorMaxLat = 85.0511287798 # web mercator square
+
+_transformers = {} # (source wkid, target wkid) => Transformer, lives as long as process
+_spatialRefs = {} # wkid => arcpy.SpatialReference
+_lock = threading.Lock() # service threads share caches
+
+
+def spatialReference(wkid):
+    ''' arcpy.SpatialReference for wkid, created once per process
+    '''
+    wkid = seismoclip.normalizeWkid(wkid)
+    sr = _spatialRefs.get(wkid)
+    if sr is None:
+        import arcpy
+        sr = arcpy.SpatialReference()
+        sr.factoryCode = wkid
+        sr.create()
+        _spatialRefs[wkid] = sr
+    return sr
+#def spatialReference(wkid):
+
+
+def utmZone(wkid):
+    ''' (central meridian, south) for WGS84 UTM zone wkid, None for other SR
+    '''
+    for base, south in ((32600, False), (32700, True)):
+        if base < wkid <= base + 60:
+            return (-183.0 + 6 * (wkid - base), south)
+    return None
+#def utmZone(wkid):
+
+
+class TransverseMercator(object):
+    ''' Transverse Mercator on ellipsoid, Krueger series to n**4
+    (Karney 2011, sub-millimeter within 3000 km of central meridian)
+    '''
+
+    def __init__(self, lon0, k0=0.9996, falseEasting=500000.0, falseNorthing=0.0, ellipsoid=wgs84):
+        a, f = ellipsoid
+        n = f / (2 - f)
+        self.lon0 = np.radians(lon0)
+        self.k0A = k0 * a / (1 + n) * (1 + n ** 2 / 4 + n ** 4 / 64)
+        self.e = 2 * np.sqrt(n) / (1 + n)
+        self.falseEasting, self.falseNorthing = falseEasting, falseNorthing
+        n2, n3, n4 = n ** 2, n ** 3, n ** 4
+        self.alpha = (n / 2 - 2 * n2 / 3 + 5 * n3 / 16 + 41 * n4 / 180, 13 * n2 / 48 - 3 * n3 / 5 + 557 * n4 / 1440,
+            61 * n3 / 240 - 103 * n4 / 140, 49561 * n4 / 161280)
+        self.beta = (n / 2 - 2 * n2 / 3 + 37 * n3 / 96 - n4 / 360, n2 / 48 + n3 / 15 - 437 * n4 / 1440,
+            17 * n3 / 480 - 37 * n4 / 840, 4397 * n4 / 161280)
+        self.delta = (2 * n - 2 * n2 / 3 - 2 * n3 + 116 * n4 / 45, 7 * n2 / 3 - 8 * n3 / 5 - 227 * n4 / 45,
+            56 * n3 / 15 - 136 * n4 / 35, 4279 * n4 / 630)
+
+    def forward(self, lon, lat):
+        ''' (x, y) meters from degrees arrays
+        '''
+        phi, lam = np.radians(lat), np.radians(lon) - self.lon0
+        sinPhi = np.sin(phi)
+        t = np.sinh(np.arctanh(sinPhi) - self.e * np.arctanh(self.e * sinPhi))
+        xi = np.arctan2(t, np.cos(lam))
+        eta = np.arctanh(np.sin(lam) / np.sqrt(1 + t * t))
+        x, y = eta.copy(), xi.copy()
+        for j, alpha in enumerate(self.alpha, 1):
+            x += alpha * np.cos(2 * j * xi) * np.sinh(2 * j * eta)
+            y += alpha * np.sin(2 * j * xi) * np.cosh(2 * j * eta)
+        return (self.falseEasting + self.k0A * x, self.falseNorthing + self.k0A * y)
+
+    def inverse(self, x, y):
+        ''' (lon, lat) degrees from meters arrays
+        '''
+        xi = (np.asarray(y, dtype=np.float64) - self.falseNorthing) / self.k0A
+        eta = (np.asarray(x, dtype=np.float64) - self.falseEasting) / self.k0A
+        xi1, eta1 = xi.copy(), eta.copy()
+        for j, beta in enumerate(self.beta, 1):
+            xi1 -= beta * np.sin(2 * j * xi) * np.cosh(2 * j * eta)
+            eta1 -= beta * np.cos(2 * j * xi) * np.sinh(2 * j * eta)
+        chi = np.arcsin(np.sin(xi1) / np.cosh(eta1))
+        phi = chi.copy()
+        for j, delta in enumerate(self.delta, 1):
+            phi += delta * np.sin(2 * j * chi)
+        lam = self.lon0 + np.arctan2(np.sinh(eta1), np.cos(xi1))
+        return (np.degrees(lam), np.degrees(phi))
+#class TransverseMercator(object):
+
+
+def mercatorForward(lon, lat):
+    ''' Web mercator (x, y) meters from degrees arrays, latitude clamped to mercator square
+    '''
+    lat = np.clip(lat, -mercatorMaxLat, mercatorMaxLat)
+    return (sphereRadius * np.radians(lon), sphereRadius * np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)))
+
+
+def mercatorInverse(x, y):
+    ''' (lon, lat) degrees from web mercator meters arrays
+    '''
+    return (np.degrees(np.asarray(x, dtype=np.float64) / sphereRadius),
+        np.degrees(2 * np.arctan(np.exp(np.asarray(y, dtype=np.float64) / sphereRadius)) - np.pi / 2))
+
+
+def _identity(x, y):
+    return (x, y)
+
+
+def _geographicSteps(wkid):
+    ''' (to WGS84 degrees, from WGS84 degrees) functions for SR known here, None otherwise
+    '''
+    if wkid == geographicWkid:
+        return (_identity, _identity)
+    if wkid == mercatorWkid:
+        return (mercatorInverse, mercatorForward)
+    zone = utmZone(wkid)
+    if zone is not None:
+        lon0, south = zone
+        tm = TransverseMercator(lon0, falseNorthing=south and 10000000.0 or 0.0)
+        return (tm.inverse, tm.forward)
+    return None
+#def _geographicSteps(wkid):
+
+
+def _pyprojSteps(source, target):
+    ''' pyproj transformation function list, ImportError if there is no pyproj
+    '''
+    import pyproj
+    if hasattr(pyproj, 'Transformer'): # pyproj 2+
+        tr = pyproj.Transformer.from_crs('EPSG:%s' % source, 'EPSG:%s' % target, always_xy=True)
+        return [tr.transform]
+    inProj, outProj = pyproj.Proj(init='epsg:%s' % source), pyproj.Proj(init='epsg:%s' % target)
+    return [lambda x, y: pyproj.transform(inProj, outProj, x, y)]
+#def _pyprojSteps(source, target):
+
+
+def _arcpySteps(source, target):
+    ''' arcpy transformation function list: all points as one multipoint, one projectAs call
+    '''
+    import arcpy
+    inSR, outSR = spatialReference(source), spatialReference(target)
+    def project(x, y):
+        points = arcpy.Array([arcpy.Point(a, b) for a, b in zip(x, y)])
+        geom = arcpy.Multipoint(points, inSR).projectAs(outSR)
+        if geom.pointCount != len(x):
+            raise NameError("Projection '%s' => '%s' lost points" % (source, target))
+        points = [geom.getPart(i) for i in xrange(geom.pointCount)]
+        return (np.array([p.X for p in points]), np.array([p.Y for p in points]))
+    return [project]
+#def _arcpySteps(source, target):
+
+
+class Transformer(object):
+    ''' Prepared transformation source wkid => target wkid, steps applied to coords arrays in order
+    '''
+
+    def __init__(self, source, target, steps, engine):
+        self.source, self.target = source, target
+        self.steps = steps
+        self.engine = engine # 'identity', 'numpy', 'pyproj', 'arcpy'
+
+    def transform(self, x, y):
+        ''' (x, y) float64 arrays in target SR
+        '''
+        x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        for step in self.steps:
+            x, y = step(x, y)
+        return (np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+
+    def transformRings(self, rings):
+        ''' Rings list ([[x, y], ...] each) in target SR, all vertices transformed at once
+        '''
+        if self.engine == 'identity':
+            return rings
+        sizes = [len(r) for r in rings]
+        if not sum(sizes):
+            return [[] for r in rings]
+        xy = np.array([pnt[:2] for r in rings for pnt in r], dtype=np.float64)
+        x, y = self.transform(xy[:, 0], xy[:, 1])
+        xy = np.column_stack((x, y)).tolist()
+        bounds = np.cumsum([0] + sizes)
+        return [xy[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+#class Transformer(object):
+
+
+def makeTransformer(source, target):
+    ''' New Transformer for normalized wkids: formulas here, pyproj, arcpy - first available
+    '''
+    if source == target:
+        return Transformer(source, target, [], 'identity')
+    inSteps, outSteps = _geographicSteps(source), _geographicSteps(target)
+    if inSteps is not None and outSteps is not None:
+        steps = [step for step in (inSteps[0], outSteps[1]) if step is not _identity]
+        return Transformer(source, target, steps, 'numpy')
+    try:
+        return Transformer(source, target, _pyprojSteps(source, target), 'pyproj')
+    except ImportError:
+        pass
+    return Transformer(source, target, _arcpySteps(source, target), 'arcpy')
+#def makeTransformer(source, target):
+
+
+def getTransformer(source, target):
+    ''' Cached Transformer for (source wkid, target wkid), Esri aliases normalized
+    '''
+    key = (seismoclip.normalizeWkid(source), seismoclip.normalizeWkid(target))
+    tr = _transformers.get(key)
+    if tr is None:
+        _lock.acquire()
+        try:
+            tr = _transformers.get(key)
+            if tr is None:
+                tr = makeTransformer(*key)
+                _transformers[key] = tr
+        finally:
+            _lock.release()
+    return tr
+#def getTransformer(source, target):
+
+
+def transformRings(rings, source, target):
+    ''' Rings from source wkid SR to target wkid SR
+    '''
+    return getTransformer(source, target).transformRings(rings)
+#def transformRings(rings, source, target):
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(verbose=True)
@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# (c) Valik mailto:vasnake@gmail.com
+
+'''
+Seismoprofiles length pyramid for Seismodensity project
+
+Quadtree of square cells over seismoprofiles extent, every cell keeps total profiles length inside it.
+Built once from APP_GP_SEISM2D_L: segments split by leaf cells (seismogrid.splitByGrid),
+parents totals are sums of 2x2 children.
+
+Density query goes down from the root, level by level:
+    cell outside polygon - skipped;
+    cell fully inside polygon (no polygon edge crosses it, center inside) - stored total taken;
+    boundary cell - its children checked, on leaf level pieces clipped exactly (seismoclip).
+So large polygon costs about its perimeter in leaf cells, not the profiles count inside.
+
+Approximate query (estimate) stops going down as soon as answer is good enough, no clip at all:
+profiles length inside boundary cell is between 0 and cell total, estimated as
+total * polygon share of cell area; guaranteed error is the distance from estimate to
+the ends of [inside cells sum, inside cells sum + boundary cells sum].
+Relative error not more than tolerance - answer from coarse level, few hundreds cells.
+
+Pyramid saved into .npz file next to Seis_button.gdb, with data stamp, like spatial index.
+Profiles edits (seismodelta) applied without rebuild: deleted and inserted segments pieces
+subtracted from / added to cells totals on every level, inserted pieces kept in extra list.
+
+Doctests
+>>> import seismoclip
+>>> prof = seismoclip.ProfileSet.fromParts([[(x, 0), (x, 100)] for x in range(1, 100, 2)])
+>>> pyr = LengthPyramid(depth=3)
+>>> pyr.build(prof)
+>>> pyr.totals[0].tolist()
+[[5000.0]]
+>>> ring = [[10, 10], [10, 90], [90, 90], [90, 10], [10, 10]]
+>>> '%.3f %.3f' % (pyr.query(prof, [ring]), seismoclip.clippedLength(prof, [ring]))
+'3200.000 3200.000'
+>>> x0, y0, x1, y1, segPart = prof.segments()
+>>> pyr.applyDelta((x0[:5], y0[:5], x1[:5], y1[:5]), (np.array([50]), np.array([1.0]), np.array([50.0]), np.array([99.0]), np.array([50.0])))
+True
+>>> prof = seismoclip.ProfileSet.fromParts([[(x, 0), (x, 0)] for x in range(1, 11, 2)] +
+...     [[(x, 0), (x, 100)] for x in range(11, 100, 2)] + [[(1, 50), (99, 50)]])
+>>> '%.3f %.3f %.3f' % (pyr.query(prof, [ring]), seismoclip.clippedLength(prof, [ring]), pyr.totals[0][0, 0])
+'3280.000 3280.000 4598.000'
+>>> grid = seismoclip.ProfileSet.fromParts([[(x, 0), (x, 1000)] for x in range(5, 1000, 10)] +
+...     [[(0, y), (1000, y)] for y in range(5, 1000, 10)])
+>>> pyr = LengthPyramid(depth=6)
+>>> pyr.build(grid)
+>>> ring = [[100, 100], [150, 900], [900, 850], [800, 120], [100, 100]]
+>>> exact = seismoclip.clippedLength(grid, [ring])
+>>> [abs(length - exact) <= error <= tol * length for tol, (length, error) in [(t, pyr.estimate([ring], t)) for t in (0.2, 0.05)]]
+[True, True]
+'''
+
+import os
+import math
+import tempfile
+import numpy as np
+
+import seismoclip
+import seismogrid
+import seismometrics
+from seismoindex import expandRanges
+
+pyramidFileExt = '.pyramid.npz'
+formatVersion = 1
+maxDepth = 12 # 4096 x 4096 leaf cells
+approxTolerance = 0.05 # relative length error allowed for approximate answer
+approxSamples = 4 # polygon share of boundary cell by approxSamples x approxSamples points
+
+_pyramidCache = {} # file path => LengthPyramid
+
+
+def autoDepth(segmentCount, perLeaf=32):
+    ''' Leaf level for about perLeaf segments per leaf cell
+    '''
+    if segmentCount <= perLeaf:
+        return 1
+    return int(min(maxDepth, max(1, math.ceil(math.log(segmentCount / float(perLeaf), 4)))))
+#def autoDepth(segmentCount, perLeaf=32):
+
+
+def leafSize(extent, segmentCount):
+    ''' Leaf cell size of pyramid built with default depth over profiles extent
+    '''
+    xmin, ymin, xmax, ymax = extent
+    return max(xmax - xmin, ymax - ymin, 1.0) / (1 << autoDepth(segmentCount))
+#def leafSize(extent, segmentCount):
+
+
+def rectsEdgesCrossed(rxmin, rymin, rxmax, rymax, edges):
+    ''' For each rectangle: True if any polygon edge intersects it.
+    Candidate pairs by bbox overlap, then exact Liang-Barsky test.
+    '''
+    ex0, ey0, ex1, ey1 = edges
+    res = np.zeros(len(rxmin), dtype=bool)
+    exmin, exmax = np.minimum(ex0, ex1), np.maximum(ex0, ex1)
+    eymin, eymax = np.minimum(ey0, ey1), np.maximum(ey0, ey1)
+    step = max(1, seismoclip.chunkSize // max(1, len(ex0)))
+    for start in range(0, len(rxmin), step):
+        sl = slice(start, start + step)
+        near = ~((exmin > rxmax[sl, None]) | (exmax < rxmin[sl, None]) |
+            (eymin > rymax[sl, None]) | (eymax < rymin[sl, None]))
+        ri, ei = np.nonzero(near)
+        if len(ri) == 0:
+            continue
+        ri = ri + start
+        t0, t1, cross = seismogrid.clipToRect(ex0[ei], ey0[ei], ex1[ei], ey1[ei],
+            (rxmin[ri], rymin[ri], rxmax[ri], rymax[ri]))
+        # degenerate t0 == t1 touch still counts as a crossing
+        cross |= (t0 == t1) & (t0 >= 0) & (t0 <= 1)
+        res[np.unique(ri[cross])] = True
+    return res
+#def rectsEdgesCrossed(rxmin, rymin, rxmax, rymax, edges):
+
+
+def rectsInsideShare(rxmin, rymin, rxmax, rymax, edges, samples=approxSamples):
+    ''' For each rectangle: polygon share of its area, points of samples x samples grid inside polygon
+    '''
+    t = (np.arange(samples) + 0.5) / samples
+    u, v = [a.ravel() for a in np.meshgrid(t, t)]
+    px = (rxmin[:, None] + (rxmax - rxmin)[:, None] * u).ravel()
+    py = (rymin[:, None] + (rymax - rymin)[:, None] * v).ravel()
+    return seismoclip.pointsInPolygon(px, py, edges).reshape(len(rxmin), -1).mean(axis=1)
+#def rectsInsideShare(rxmin, rymin, rxmax, rymax, edges, samples=approxSamples):
+
+
+class LengthPyramid(object):
+    ''' Quadtree of profiles length totals.
+
+    xmin, ymin, size: root cell lower left corner and size;
+    depth: leaf level, leaf grid is 2**depth x 2**depth;
+    totals: list of 2D arrays, totals[k] is (2**k, 2**k) length per cell of level k, row 0 north;
+    cellStart, pieceSeg, pieceTa, pieceTb: leaf cell i pieces (CSR), piece is
+    segment pieceSeg part from parameter ta to tb;
+    extraCell, extraSeg, extraTa, extraTb: pieces of segments inserted after build (applyDelta), unordered.
+    '''
+
+    def __init__(self, depth=None, stamp=''):
+        self.depth = depth
+        self.stamp = stamp
+        self.xmin = self.ymin = 0.0
+        self.size = 1.0
+        self.totals = []
+        self.cellStart = np.zeros(1, dtype=np.int64)
+        self.pieceSeg = np.zeros(0, dtype=np.int64)
+        self.pieceTa = np.zeros(0)
+        self.pieceTb = np.zeros(0)
+        self.extraCell = np.zeros(0, dtype=np.int64)
+        self.extraSeg = np.zeros(0, dtype=np.int64)
+        self.extraTa = np.zeros(0)
+        self.extraTb = np.zeros(0)
+
+    @property
+    def leafCount(self):
+        return 1 << self.depth
+
+    def leafSize(self):
+        return self.size / self.leafCount
+
+    def build(self, profiles):
+        ''' Split profiles segments by leaf cells, sum totals up to the root
+        '''
+        x0, y0, x1, y1, segPart = profiles.segments()
+        if self.depth is None:
+            self.depth = autoDepth(len(x0))
+        n = self.leafCount
+        if len(x0):
+            xmin, ymin = min(x0.min(), x1.min()), min(y0.min(), y1.min())
+            xmax, ymax = max(x0.max(), x1.max()), max(y0.max(), y1.max())
+        else:
+            xmin, ymin, xmax, ymax = 0.0, 0.0, 1.0, 1.0
+        size = max(xmax - xmin, ymax - ymin, 1.0) * (1 + 1e-9)
+        self.xmin, self.ymin, self.size = float(xmin), float(ymin), float(size)
+
+        segNo, ta, tb, col, row = seismogrid.splitByGrid(x0, y0, x1, y1,
+            (xmin, ymin, xmin + size, ymin + size), size / n)
+        cell = row * n + col
+        order = np.argsort(cell, kind='mergesort')
+        self.pieceSeg, self.pieceTa, self.pieceTb = segNo[order], ta[order], tb[order]
+        counts = np.bincount(cell, minlength=n * n)
+        self.cellStart = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+        seglen = np.hypot(x1 - x0, y1 - y0)
+        leaf = np.bincount(cell, weights=(tb - ta) * seglen[segNo], minlength=n * n).reshape(n, n)
+        self.totals = [leaf]
+        while len(self.totals[0]) > 1:
+            t = self.totals[0]
+            m = len(t) // 2
+            self.totals.insert(0, t.reshape(m, 2, m, 2).sum(axis=3).sum(axis=1))
+        self.extraCell = np.zeros(0, dtype=np.int64)
+        self.extraSeg = np.zeros(0, dtype=np.int64)
+        self.extraTa, self.extraTb = np.zeros(0), np.zeros(0)
+
+    def frame(self):
+        return (self.xmin, self.ymin, self.xmin + self.size, self.ymin + self.size)
+
+    def addToCells(self, rows, cols, weights):
+        ''' Add leaf cells weights to totals of all levels
+        '''
+        for level in range(self.depth, -1, -1):
+            shift = self.depth - level
+            key = (rows >> shift) * (1 << level) + (cols >> shift)
+            cells, inv = np.unique(key, return_inverse=True)
+            self.totals[level].flat[cells] += np.bincount(inv, weights=weights)
+
+    def applyDelta(self, dead, added):
+        ''' Apply profiles edit to totals, w/o rebuild.
+        dead: (x0, y0, x1, y1) deleted segments coords before edit, their pieces stay in cells,
+        length is zero since store moved their ends together;
+        added: (segNo, x0, y0, x1, y1) inserted segments.
+        Return False if inserted segment goes out of pyramid frame, rebuild needed.
+        '''
+        segNo, ax0, ay0, ax1, ay1 = added
+        xmin, ymin, xmax, ymax = self.frame()
+        if len(ax0) and (min(ax0.min(), ax1.min()) < xmin or min(ay0.min(), ay1.min()) < ymin or
+                max(ax0.max(), ax1.max()) > xmax or max(ay0.max(), ay1.max()) > ymax):
+            return False
+        n = self.leafCount
+        for sign, (x0, y0, x1, y1) in ((-1.0, dead), (1.0, (ax0, ay0, ax1, ay1))):
+            if len(x0) == 0:
+                continue
+            no, ta, tb, col, row = seismogrid.splitByGrid(x0, y0, x1, y1, self.frame(), self.size / n)
+            self.addToCells(row, col, sign * (tb - ta) * np.hypot(x1 - x0, y1 - y0)[no])
+            if sign > 0:
+                self.extraCell = np.concatenate([self.extraCell, row * n + col])
+                self.extraSeg = np.concatenate([self.extraSeg, np.asarray(segNo, dtype=np.int64)[no]])
+                self.extraTa = np.concatenate([self.extraTa, ta])
+                self.extraTb = np.concatenate([self.extraTb, tb])
+        return True
+
+    def cellRects(self, level, rows, cols):
+        ''' (xmin, ymin, xmax, ymax) arrays for cells of level
+        '''
+        cs = self.size / (1 << level)
+        ymax = self.ymin + self.size
+        rxmin = self.xmin + cols * cs
+        rymax = ymax - rows * cs
+        return rxmin, rymax - cs, rxmin + cs, rymax
+
+    def boundaryCells(self, edges):
+        ''' Go down from the root, for each level yield (level, inside, rows, cols, tot):
+        inside - total of level cells fully inside polygon;
+        rows, cols, tot - boundary cells with profiles, their children checked on next level.
+        Stops when there is no boundary cell or on leaf level.
+        '''
+        rows = np.zeros(1, dtype=np.int64)
+        cols = np.zeros(1, dtype=np.int64)
+        for level in range(self.depth + 1):
+            tot = self.totals[level][rows, cols]
+            keep = tot > 0
+            rows, cols, tot = rows[keep], cols[keep], tot[keep]
+            inside = 0.0
+            if len(rows):
+                rxmin, rymin, rxmax, rymax = self.cellRects(level, rows, cols)
+                boundary = rectsEdgesCrossed(rxmin, rymin, rxmax, rymax, edges)
+                inner = ~boundary
+                if inner.any():
+                    inPoly = seismoclip.pointsInPolygon(((rxmin + rxmax) / 2.0)[inner], ((rymin + rymax) / 2.0)[inner], edges)
+                    inside = math.fsum(tot[inner][inPoly])
+                rows, cols, tot = rows[boundary], cols[boundary], tot[boundary]
+            yield (level, inside, rows, cols, tot)
+            if len(rows) == 0:
+                return
+            if level < self.depth:
+                rows = (rows[:, None] * 2 + np.array([0, 0, 1, 1])).ravel()
+                cols = (cols[:, None] * 2 + np.array([0, 1, 0, 1])).ravel()
+
+    def query(self, profiles, rings):
+        ''' Profiles length inside polygon, meters
+        '''
+        edges = seismoclip.ringsEdges(rings)
+        if len(edges[0]) == 0 or not self.totals:
+            return 0.0
+        parts = []
+        for level, inside, rows, cols, tot in self.boundaryCells(edges):
+            parts.append(inside)
+
+        # leaf boundary cells, exact clip of pieces
+        if len(rows):
+            cell = rows * self.leafCount + cols
+            pieces = expandRanges(self.cellStart[cell], self.cellStart[cell + 1])
+            x0, y0, x1, y1, segPart = profiles.segments()
+            seg = self.pieceSeg[pieces]
+            ta, tb = self.pieceTa[pieces], self.pieceTb[pieces]
+            if len(self.extraCell):
+                extra = np.in1d(self.extraCell, cell)
+                seg = np.concatenate([seg, self.extraSeg[extra]])
+                ta = np.concatenate([ta, self.extraTa[extra]])
+                tb = np.concatenate([tb, self.extraTb[extra]])
+            dx, dy = x1[seg] - x0[seg], y1[seg] - y0[seg]
+            lengths = seismoclip.segmentsInsideLength(x0[seg] + ta * dx, y0[seg] + ta * dy,
+                x0[seg] + tb * dx, y0[seg] + tb * dy, edges)
+            parts.append(math.fsum(lengths))
+        return math.fsum(parts)
+
+    def estimate(self, rings, tolerance=approxTolerance):
+        ''' (length, error) meters, approximate profiles length inside polygon and its guaranteed bound,
+        from cells totals only. Goes down until error <= tolerance * length or to leaf level.
+        '''
+        edges = seismoclip.ringsEdges(rings)
+        if len(edges[0]) == 0 or not self.totals:
+            return (0.0, 0.0)
+        parts = []
+        for level, inside, rows, cols, tot in self.boundaryCells(edges):
+            parts.append(inside)
+            low = math.fsum(parts)
+            if len(rows) == 0:
+                return (low, 0.0)
+            share = rectsInsideShare(*(self.cellRects(level, rows, cols) + (edges, )))
+            length = low + math.fsum(tot * share)
+            error = max(length - low, low + math.fsum(tot) - length)
+            if error <= tolerance * length:
+                break
+        return (length, error)
+
+    def save(self, fileName):
+        ''' Write pyramid into .npz file, atomically: temp file in the same folder, unique per writer
+        '''
+        arrays = {'meta': np.array([formatVersion, self.depth], dtype=np.int64),
+            'frame': np.array([self.xmin, self.ymin, self.size]),
+            'stamp': np.array([self.stamp]),
+            'leaf': self.totals[-1], 'cellStart': self.cellStart,
+            'pieceSeg': self.pieceSeg, 'pieceTa': self.pieceTa, 'pieceTb': self.pieceTb,
+            'extraCell': self.extraCell, 'extraSeg': self.extraSeg, 'extraTa': self.extraTa, 'extraTb': self.extraTb}
+        fd, tmpName = tempfile.mkstemp('.tmp', os.path.basename(fileName) + '.', os.path.dirname(fileName) or '.')
+        try:
+            fh = os.fdopen(fd, 'wb')
+            try:
+                np.savez(fh, **arrays) # file object: no .npz appended
+            finally:
+                fh.close()
+            os.chmod(tmpName, 0644) # mkstemp file is private, pyramid is read by other accounts too
+            if os.path.exists(fileName):
+                os.remove(fileName)
+            os.rename(tmpName, fileName)
+        except Exception:
+            if os.path.exists(tmpName):
+                os.remove(tmpName)
+            raise
+
+    @classmethod
+    def load(cls, fileName):
+        ''' Read pyramid from .npz file, upper levels summed from leaves
+        '''
+        data = np.load(fileName)
+        try:
+            version, depth = [int(x) for x in data['meta']]
+            if version != formatVersion:
+                raise NameError("Unknown length pyramid format version '%s' in '%s'" % (version, fileName))
+            pyr = cls(depth, str(data['stamp'][0]))
+            pyr.xmin, pyr.ymin, pyr.size = [float(x) for x in data['frame']]
+            pyr.cellStart = data['cellStart']
+            pyr.pieceSeg, pyr.pieceTa, pyr.pieceTb = data['pieceSeg'], data['pieceTa'], data['pieceTb']
+            pyr.totals = [data['leaf']]
+            if 'extraCell' in data.files: # files saved before edits support have no extra list
+                pyr.extraCell, pyr.extraSeg = data['extraCell'], data['extraSeg']
+                pyr.extraTa, pyr.extraTb = data['extraTa'], data['extraTb']
+        finally:
+            data.close()
+        while len(pyr.totals[0]) > 1:
+            t = pyr.totals[0]
+            m = len(t) // 2
+            pyr.totals.insert(0, t.reshape(m, 2, m, 2).sum(axis=3).sum(axis=1))
+        return pyr
+#class LengthPyramid(object):
+
+
+def loadOrBuild(fileName, profiles, stamp='', log=None):
+    ''' Length pyramid for profiles: from process cache, from file or build and save new one.
+    Pyramid from file with other data stamp is stale and will be rebuilt.
+    '''
+    pyr = _pyramidCache.get(fileName)
+    if pyr is not None and pyr.stamp == stamp:
+        return pyr
+    pyr = None
+    if os.path.exists(fileName):
+        try:
+            pyr = LengthPyramid.load(fileName)
+        except Exception, e:
+            if log: log.warning("seismopyramid.loadOrBuild, can't read pyramid '%s': %s" % (fileName, e))
+        if pyr is not None and pyr.stamp != stamp:
+            if log: log.info("seismopyramid.loadOrBuild, pyramid '%s' is stale, stamp '%s'" % (fileName, pyr.stamp))
+            pyr = None
+    if pyr is None:
+        pyr = LengthPyramid(stamp=stamp)
+        pyr.build(profiles)
+        try:
+            pyr.save(fileName)
+        except Exception, e:
+            if log: log.warning("seismopyramid.loadOrBuild, can't save pyramid '%s': %s" % (fileName, e))
+    _pyramidCache[fileName] = pyr
+    return pyr
+#def loadOrBuild(fileName, profiles, stamp='', log=None):
+
+
+def profilesLength(profiles, index, rings, pyramidFile='', stamp='', minCells=64, log=None, clipPool=None):
+    ''' Profiles length inside polygon, meters.
+    Small polygon: clip spatial index candidates; polygon envelope of minCells pyramid leaf cells
+    and more: length pyramid, exact clip only in boundary cells.
+    Pyramid loaded (or built) at first large polygon; no pyramidFile - index only.
+    clipPool: seismoparallel.ClipPool over the same store, candidates clipped in worker processes
+    if there are clipPool.minSegments of them or more; pool failure - serial clip.
+    '''
+    xmin, ymin, xmax, ymax = seismoclip.ringsExtent(rings)
+    if pyramidFile:
+        size = leafSize(index.extent(), index.itemCount)
+        cells = (xmax - xmin) * (ymax - ymin) / (size * size)
+        if cells >= minCells:
+            pyr = loadOrBuild(pyramidFile, profiles, stamp, log)
+            if log: log.info("profilesLength, pyramid query, envelope '%.1f' leaf cells, depth '%s'" % (cells, pyr.depth))
+            seismometrics.setValue('engine', 'pyramid')
+            return pyr.query(profiles, rings)
+    segIdx = index.query((xmin, ymin, xmax, ymax))
+    seismometrics.setValue('engine', 'index')
+    seismometrics.count('candidates', len(segIdx))
+    if log: log.info("profilesLength, spatial index candidates '%s' of '%s' segments" % (len(segIdx), index.itemCount))
+    if clipPool is not None and len(segIdx) >= clipPool.minSegments:
+        try:
+            res = clipPool.clippedLength(rings, segIdx)
+            seismometrics.setValue('engine', 'parallel')
+            return res
+        except Exception, e:
+            if log: log.warning("profilesLength, parallel clip failed, clip serially: %s" % e)
+    return seismoclip.clippedLength(profiles, rings, segIdx)
+#def profilesLength(profiles, index, rings, pyramidFile='', stamp='', minCells=64, log=None, clipPool=None):
+
+
+def approxLength(profiles, index, rings, tolerance=approxTolerance, pyramidFile='', stamp='', minCells=64, log=None, clipPool=None):
+    ''' (length, error) meters, profiles length inside polygon with guaranteed error bound,
+    error <= tolerance * length. Large polygon: pyramid estimate, exact pyramid query
+    if leaf level is not enough for tolerance; small polygon (or no pyramid) - exact, error 0.
+    '''
+    if pyramidFile and tolerance > 0:
+        xmin, ymin, xmax, ymax = seismoclip.ringsExtent(rings)
+        size = leafSize(index.extent(), index.itemCount)
+        if (xmax - xmin) * (ymax - ymin) / (size * size) >= minCells:
+            pyr = loadOrBuild(pyramidFile, profiles, stamp, log)
+            length, error = pyr.estimate(rings, tolerance)
+            if log: log.info("approxLength, estimate '%.1f' m, error '%.1f' m" % (length, error))
+            if error <= tolerance * length:
+                seismometrics.setValue('engine', 'estimate')
+                return (length, error)
+    return (profilesLength(profiles, index, rings, pyramidFile, stamp, minCells, log, clipPool), 0.0)
+#def approxLength(profiles, index, rings, tolerance=approxTolerance, pyramidFile='', stamp='', minCells=64, log=None, clipPool=None):
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(verbose=True)
@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# (c) Valik mailto:vasnake@gmail.com
+
+'''
+Input polygon validation and repair for Seismodensity project
+
+Polygon drawn counterclockwise or with self-intersections becomes zero-part geometry in arcpy
+(geom.partCount <= 0 or geom.area <= 0), and clients had to call GeometryServer simplify first.
+Here polygon is repaired inside the tool:
+    rings closed, consecutive duplicate vertices dropped, rings with less than 3 vertices dropped;
+    self-intersections of all rings found by sweep line (edges sorted by xmin, edge checked against edges
+    starting before its xmax, then exact test), O(n log n + candidates); crossing points inserted into both edges;
+    no crossings and no repeated vertices: ring nesting depth by even-odd rule (as seismoclip clip),
+    even depth - outer ring, made clockwise, odd depth - hole, made counterclockwise;
+    otherwise split edges of all rings together make planar graph: edges passed even times (overlaps,
+    spikes, backtracks) cancel by even-odd rule, faces of the rest traced (traceFaces), face boundary kept
+    if inside is on its right side (test point left of its longest edge is outside), so it is clockwise
+    outer ring or counterclockwise hole; boundary touching itself split at repeated nodes.
+Result covers the same area as input by even-odd rule, so clip result is the same,
+and polygon area (seismoclip.polygonArea) is right; result rings are simple, they may touch
+each other at vertices. Valid polygon comes out unchanged.
+
+Doctests
+>>> bowtie = [[(0, 0), (10, 10), (10, 0), (0, 10)]] # self-intersected, unclosed
+>>> rings, problems = repairRings(bowtie)
+>>> problems # one of two loops is counterclockwise
+['unclosed ring', 'self-intersections: 1', 'counterclockwise outer ring']
+>>> sorted(seismoclip.polygonArea([r]) for r in rings), len(rings[0])
+([25.0, 25.0], 4)
+>>> star = [(0, 100), (59, -81), (-95, 31), (95, 31), (-59, -81)] # pentagram, center covered twice
+>>> rings, problems = repairRings([star])
+>>> len(rings), round(seismoclip.polygonArea(rings), 1), problems
+(2, 7765.4, ['unclosed ring', 'self-intersections: 5', 'clockwise hole'])
+>>> [len(r) - 1 for r in rings] # star outline and center pentagon hole, touching at its corners
+[10, 5]
+>>> cross = [[(0, 0), (0, 10), (10, 10), (10, 0)], [(5, 5), (5, 15), (15, 15), (15, 5)]] # overlap is even-odd hole
+>>> rings, problems = repairRings(cross)
+>>> [seismoclip.polygonArea([r]) for r in rings], problems
+([175.0, -25.0], ['unclosed ring', 'self-intersections: 2', 'clockwise hole'])
+>>> ccw = [[0, 0], [10, 0], [10, 10], [10, 10], [0, 10], [0, 0]]
+>>> rings, problems = repairRings([ccw])
+>>> problems, seismoclip.polygonArea(rings), len(rings[0])
+(['duplicate vertices: 1', 'counterclockwise outer ring'], 100.0, 5)
+>>> square = [[0, 0], [0, 10], [10, 10], [10, 0], [0, 0]]
+>>> repairRings([square, [[2, 2], [2, 4], [4, 4], [4, 2], [2, 2]]])[1] # clockwise hole
+['clockwise hole']
+>>> repairRings([square]) == ([square], [])
+True
+>>> repairRings([[[0, 0], [5, 5], [0, 0]]])
+Traceback (most recent call last):
+...
+NameError: Wrong input polygon, no rings with area left after repair
+'''
+
+import json
+import math
+import numpy as np
+
+import seismoclip
+import seismoproj
+from seismoindex import expandRanges
+
+areaTolerance = 1e-12 # loop area less than this share of polygon extent square is degenerate
+snapTolerance = 1e-10 # crossing point closer than this share of extent size to other node is that node
+parallelTolerance = 1e-12 # edges with angle sine less than this are parallel
+
+
+def cleanRing(ring):
+    ''' (points, problems): ring as (n, 2) array w/o closing vertex and consecutive duplicates
+    '''
+    pts = np.asarray(ring, dtype=np.float64).reshape(-1, 2)
+    if not np.isfinite(pts).all():
+        raise NameError("Wrong input polygon, not finite coordinates")
+    problems = []
+    if len(pts) > 1 and (pts[0] != pts[-1]).any():
+        problems.append('unclosed ring')
+    keep = np.ones(len(pts), dtype=bool)
+    keep[1:] = (pts[1:] != pts[:-1]).any(axis=1)
+    pts = pts[keep]
+    if len(pts) > 1 and (pts[0] == pts[-1]).all():
+        pts = pts[:-1]
+    if not keep.all():
+        problems.append('duplicate vertices: %s' % (len(keep) - keep.sum()))
+    return pts, problems
+#def cleanRing(ring):
+
+
+def sweepPairs(xmin, ymin, xmax, ymax):
+    ''' (i, j) pairs of boxes that intersect, i != j, each pair once.
+    Sweep line along x: boxes sorted by xmin, box checked against boxes with xmin in its [xmin, xmax].
+
+    >>> sweepPairs(np.array([0., 1., 5.]), np.array([0., 0., 0.]), np.array([2., 3., 6.]), np.array([1., 1., 1.]))
+    (array([0]), array([1]))
+    '''
+    order = np.argsort(xmin, kind='mergesort')
+    sx = xmin[order]
+    stop = np.searchsorted(sx, xmax[order], side='right')
+    starts = np.arange(1, len(order) + 1, dtype=np.int64)
+    counts = np.maximum(stop - starts, 0)
+    a = np.repeat(np.arange(len(order), dtype=np.int64), counts)
+    b = expandRanges(starts, starts + counts)
+    i, j = order[a], order[b]
+    near = ~((ymin[j] > ymax[i]) | (ymax[j] < ymin[i]))
+    return i[near], j[near]
+#def sweepPairs(xmin, ymin, xmax, ymax):
+
+
+def _cross(ax, ay, bx, by):
+    return ax * by - ay * bx
+
+
+def edgesCrossings(px0, py0, px1, py1, snap):
+    ''' Nodes to insert into edges: (edge, param, x, y) arrays.
+    Proper crossings, edge end lying inside other edge, collinear overlaps.
+    Crossing point computed once and inserted into both edges, points closer than snap to edge end
+    are that end.
+    '''
+    xmin, xmax = np.minimum(px0, px1), np.maximum(px0, px1)
+    ymin, ymax = np.minimum(py0, py1), np.maximum(py0, py1)
+    if (xmax - xmin).sum() > (ymax - ymin).sum(): # sweep along axis with shorter edges projections
+        i, j = sweepPairs(ymin, xmin, ymax, xmax)
+    else:
+        i, j = sweepPairs(xmin, ymin, xmax, ymax)
+    edge, param, nx, ny = [], [], [], []
+    if len(i) == 0:
+        return edge, param, nx, ny
+
+    rx, ry = px1[i] - px0[i], py1[i] - py0[i]
+    sx, sy = px1[j] - px0[j], py1[j] - py0[j]
+    qx, qy = px0[j] - px0[i], py0[j] - py0[i]
+    denom = _cross(rx, ry, sx, sy)
+    rlen = np.hypot(rx, ry)
+    parallel = np.abs(denom) <= parallelTolerance * rlen * np.hypot(sx, sy)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = _cross(qx, qy, sx, sy) / denom
+        u = _cross(qx, qy, rx, ry) / denom
+        hit = ~parallel & (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)
+    # not parallel edges with common end cross only there (computed point is poor for small angle)
+    same = lambda ax, ay, bx, by: (ax == bx) & (ay == by)
+    hit &= ~(same(px0[i], py0[i], px0[j], py0[j]) | same(px0[i], py0[i], px1[j], py1[j]) |
+        same(px1[i], py1[i], px0[j], py0[j]) | same(px1[i], py1[i], px1[j], py1[j]))
+    if hit.any():
+        k = np.nonzero(hit)[0]
+        ii, jj, tk, uk = i[k], j[k], t[k], u[k]
+        x, y = px0[ii] + tk * rx[k], py0[ii] + tk * ry[k]
+        # snap to edges ends: touch at vertex is that vertex, not a new node
+        for ex, ey in ((px0[ii], py0[ii]), (px1[ii], py1[ii]), (px0[jj], py0[jj]), (px1[jj], py1[jj])):
+            close = np.hypot(x - ex, y - ey) <= snap
+            x, y = np.where(close, ex, x), np.where(close, ey, y)
+        for e, par, ex0, ey0, ex1, ey1 in ((ii, tk, px0, py0, px1, py1), (jj, uk, px0, py0, px1, py1)):
+            inner = ~(((x == ex0[e]) & (y == ey0[e])) | ((x == ex1[e]) & (y == ey1[e])))
+            edge.append(e[inner])
+            param.append(par[inner])
+            nx.append(x[inner])
+            ny.append(y[inner])
+
+    # collinear overlaps: ends of one edge inside the other
+    col = parallel & (np.abs(_cross(qx, qy, rx, ry)) <= parallelTolerance * rlen * np.hypot(qx, qy))
+    if col.any():
+        k = np.nonzero(col)[0]
+        for a, b in ((i[k], j[k]), (j[k], i[k])):
+            dx, dy = px1[a] - px0[a], py1[a] - py0[a]
+            dd = dx * dx + dy * dy
+            for ex, ey in ((px0[b], py0[b]), (px1[b], py1[b])):
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    tt = ((ex - px0[a]) * dx + (ey - py0[a]) * dy) / dd
+                inner = (dd > 0) & (tt > 0) & (tt < 1)
+                edge.append(a[inner])
+                param.append(tt[inner])
+                nx.append(ex[inner])
+                ny.append(ey[inner])
+    return edge, param, nx, ny
+#def edgesCrossings(px0, py0, px1, py1, snap):
+
+
+def _snapNodes(x, y, snap):
+    ''' Crossing points closer than snap get the same coords (several edges crossing at one point)
+    '''
+    if len(x) < 2 or snap <= 0:
+        return x, y
+    cells = np.column_stack((np.round(x / snap), np.round(y / snap))) + 0.0 # snap grid cells as floats: no int64 wrap, -0 made 0
+    uniq, first, inv = np.unique(cells, axis=0, return_index=True, return_inverse=True)
+    return x[first][inv], y[first][inv]
+
+
+def splitLoops(pts):
+    ''' Closed vertex sequence (w/o closing vertex) split at repeated vertices into loops
+    '''
+    loops = []
+    stack, pos = [], {}
+    for p in map(tuple, pts):
+        if p in pos:
+            start = pos[p]
+            loops.append(stack[start:])
+            for q in stack[start + 1:]:
+                del pos[q]
+            del stack[start + 1:]
+        else:
+            pos[p] = len(stack)
+            stack.append(p)
+    if len(stack) > 2:
+        loops.append(stack)
+    return [np.array(loop) for loop in loops if len(loop) > 2]
+#def splitLoops(pts):
+
+
+def traceFaces(segs):
+    ''' Faces boundaries of planar graph, segs: list of (node, node), nodes are (x, y) tuples,
+    segments meet at nodes only. Return list of cycles (lists of nodes), face is on the left of cycle:
+    bounded face boundary is counterclockwise, outer boundary of connected part is clockwise.
+
+    >>> sq = [(0, 0), (1, 0), (1, 1), (0, 1)]
+    >>> sorted(len(c) for c in traceFaces(zip(sq, sq[1:] + sq[:1])))
+    [4, 4]
+    '''
+    nbrs = {}
+    for a, b in segs:
+        nbrs.setdefault(a, []).append(b)
+        nbrs.setdefault(b, []).append(a)
+    pos = {}
+    for p, lst in nbrs.items():
+        lst.sort(key=lambda q: math.atan2(q[1] - p[1], q[0] - p[0]))
+        for k, q in enumerate(lst):
+            pos[(p, q)] = k
+    used = set()
+    cycles = []
+    for a, b in segs:
+        for u, v in ((a, b), (b, a)):
+            cycle = []
+            while (u, v) not in used:
+                used.add((u, v))
+                cycle.append(u)
+                lst = nbrs[v]
+                u, v = v, lst[pos[(v, u)] - 1] # next edge clockwise from way back
+            if cycle:
+                cycles.append(cycle)
+    return cycles
+#def traceFaces(segs):
+
+
+def _faceLoops(seqs, cleaned, size, problems):
+    ''' Loops of even-odd area boundary from nodes sequences of rings (crossings inserted),
+    clockwise outer rings and counterclockwise holes, see module docstring
+    '''
+    count, direction = {}, {}
+    for seq in seqs:
+        pts = map(tuple, seq.tolist())
+        for a, b in zip(pts, pts[1:] + pts[:1]):
+            if a != b:
+                key = a < b and (a, b) or (b, a)
+                count[key] = count.get(key, 0) + 1
+                direction[key] = (a, b)
+    segs = [key for key, num in count.items() if num % 2]
+    if len(segs) < len(count):
+        problems.append('overlapping edges: %s' % (len(count) - len(segs)))
+    if not segs:
+        return []
+    sx0, sy0, sx1, sy1 = [np.array(a, dtype=np.float64) for a in zip(*[a + b for a, b in segs])]
+    segIndex = dict((key, i) for i, key in enumerate(segs))
+
+    # test point left of cycle longest edge middle, closer to it than to any other edge
+    cycles = traceFaces(segs)
+    tx, ty = [], []
+    for cycle in cycles:
+        c = np.array(cycle, dtype=np.float64)
+        d = np.roll(c, -1, axis=0) - c
+        length = np.hypot(d[:, 0], d[:, 1])
+        k = np.argmax(length)
+        mx, my = c[k, 0] + d[k, 0] / 2.0, c[k, 1] + d[k, 1] / 2.0
+        ex, ey = sx1 - sx0, sy1 - sy0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = np.clip(((mx - sx0) * ex + (my - sy0) * ey) / (ex * ex + ey * ey), 0, 1)
+        dist = np.hypot(sx0 + t * ex - mx, sy0 + t * ey - my)
+        a, b = cycle[k], cycle[(k + 1) % len(cycle)]
+        dist = np.delete(dist, segIndex[a < b and (a, b) or (b, a)])
+        delta = min(1e-3 * length[k], dist.min() / 2.0 if len(dist) else size)
+        tx.append(mx - d[k, 1] / length[k] * delta)
+        ty.append(my + d[k, 0] / length[k] * delta)
+    outside = ~seismoclip.pointsInPolygon(tx, ty, seismoclip.ringsEdges(cleaned))
+
+    loops = []
+    for cycle, out in zip(cycles, outside):
+        if not out:
+            continue
+        for loop in splitLoops(np.array(cycle, dtype=np.float64)):
+            pts = map(tuple, loop.tolist())
+            if any(direction[a < b and (a, b) or (b, a)] != (a, b) for a, b in zip(pts, pts[1:] + pts[:1])):
+                name = seismoclip.polygonArea([loop]) > 0 and 'counterclockwise outer ring' or 'clockwise hole'
+                if name not in problems:
+                    problems.append(name)
+            loops.append(loop)
+    loops.sort(key=lambda loop: -seismoclip.polygonArea([loop])) # outer rings first, dict order is random
+    return loops
+#def _faceLoops(seqs, cleaned, size, problems):
+
+
+def repairRings(rings):
+    ''' (rings, problems): valid rings (closed, clockwise outer, counterclockwise holes,
+    each ring simple, rings may touch at vertices) and list of problems found in input.
+    Raise NameError if nothing with area left.
+    '''
+    problems = []
+    cleaned = []
+    for ring in rings:
+        pts, probs = cleanRing(ring)
+        for p in probs:
+            if p not in problems:
+                problems.append(p)
+        if len(pts) >= 3:
+            cleaned.append(pts)
+    if not cleaned:
+        raise NameError("Wrong input polygon, no rings with area left after repair")
+    allPts = np.vstack(cleaned)
+    size = max(allPts[:, 0].max() - allPts[:, 0].min(), allPts[:, 1].max() - allPts[:, 1].min())
+    minArea = areaTolerance * size * size
+
+    # edges of all rings, next vertex with wrap inside ring
+    counts = [len(r) for r in cleaned]
+    first = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    nxt = np.arange(len(allPts)) + 1
+    nxt[first + np.array(counts) - 1] = first
+    px0, py0 = allPts[:, 0], allPts[:, 1]
+    px1, py1 = allPts[nxt, 0], allPts[nxt, 1]
+    edge, param, nx, ny = [np.concatenate(a) if a else np.zeros(0) for a in
+        edgesCrossings(px0, py0, px1, py1, snapTolerance * size)]
+    if len(edge):
+        problems.append('self-intersections: %s' % len(set(zip(nx, ny))))
+        nx, ny = _snapNodes(nx, ny, snapTolerance * size)
+        edge = edge.astype(np.int64)
+        # vertices and inserted nodes ordered by edge, then by param along edge
+        e = np.concatenate([np.arange(len(allPts)), edge])
+        t = np.concatenate([np.zeros(len(allPts)), param])
+        xs, ys = np.concatenate([px0, nx]), np.concatenate([py0, ny])
+        order = np.lexsort((t, e))
+        seqs = np.split(np.column_stack([xs[order], ys[order]]), np.searchsorted(e[order], first[1:]))
+    elif len(set(map(tuple, allPts.tolist()))) < len(allPts): # rings touch themselves or each other
+        seqs = cleaned
+    else:
+        seqs = None
+
+    if seqs is not None:
+        res = []
+        for loop in _faceLoops(seqs, cleaned, size, problems):
+            if abs(seismoclip.polygonArea([loop])) > minArea:
+                res.append(np.vstack([loop, loop[:1]]).tolist())
+            elif 'degenerate ring dropped' not in problems:
+                problems.append('degenerate ring dropped')
+        if not res:
+            raise NameError("Wrong input polygon, no rings with area left after repair")
+        return res, problems
+
+    loops = []
+    for loop in cleaned:
+        if abs(seismoclip.polygonArea([loop])) > minArea:
+            loops.append(loop)
+        elif 'degenerate ring dropped' not in problems:
+            problems.append('degenerate ring dropped')
+    if not loops:
+        raise NameError("Wrong input polygon, no rings with area left after repair")
+
+    # nesting depth by even-odd rule, test point is middle of loop longest edge
+    tx, ty = [], []
+    for loop in loops:
+        d = np.roll(loop, -1, axis=0) - loop
+        k = np.argmax(np.hypot(d[:, 0], d[:, 1]))
+        tx.append(loop[k, 0] + d[k, 0] / 2.0)
+        ty.append(loop[k, 1] + d[k, 1] / 2.0)
+    tx, ty = np.array(tx), np.array(ty)
+    depth = np.zeros(len(loops), dtype=np.int64)
+    for m, loop in enumerate(loops):
+        inside = seismoclip.pointsInPolygon(tx, ty, seismoclip.ringsEdges([loop]))
+        inside[m] = False
+        depth += inside
+
+    res = []
+    for loop, dep in zip(loops, depth):
+        area = seismoclip.polygonArea([loop])
+        hole = dep % 2 == 1
+        if (area < 0) != hole:
+            loop = loop[::-1]
+            name = hole and 'clockwise hole' or 'counterclockwise outer ring'
+            if name not in problems:
+                problems.append(name)
+        res.append(np.vstack([loop, loop[:1]]).tolist())
+    return res, problems
+#def repairRings(rings):
+
+
+def fsetRings(fsetObj, fsetTxt, wkid, log=None):
+    ''' Repaired rings of first polygon of GP tool FeatureSet, coords in wkid SR.
+    Rings taken from FeatureSet JSON (FeatureSet.JSON or parameter text) and transformed
+    by cached seismoproj transformer; arcpy gives zero-part geometry for counterclockwise
+    or self-intersected polygon, so it is read by SearchCursor only if JSON is not available.
+    '''
+    text = getattr(fsetObj, 'JSON', None) or fsetTxt or ''
+    inWkid, polygons = None, []
+    if text.lstrip().startswith('{'):
+        inWkid, polygons = seismoclip.esriJsonPolygons(json.loads(text))
+        if not polygons:
+            raise NameError("Input FeatureSet has no features")
+
+    if inWkid:
+        rings, problems = repairRings(polygons[0][1])
+        if log: log.info("seismorepair.fsetRings, rings from JSON, wkid '%s', problems %s" % (inWkid, problems))
+        rings = seismoproj.transformRings(rings, inWkid, wkid)
+    else:
+        import arcpy
+        rings = []
+        rows = arcpy.SearchCursor(fsetObj, '', seismoproj.spatialReference(wkid))
+        for row in rows:
+            geom = row.shape
+            if geom is not None and geom.partCount > 0:
+                rings = seismoclip.geometryRings(geom)
+            break # only one polygon
+        del rows
+        if not rings:
+            raise NameError("Wrong input polygon, you should send no selfintersected clockwise drawed single ring")
+
+    rings, problems = repairRings(rings)
+    if problems and log:
+        log.info("seismorepair.fsetRings, input polygon repaired: %s" % ', '.join(problems))
+    return rings
+#def fsetRings(fsetObj, fsetTxt, wkid, log=None):
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(verbose=True)
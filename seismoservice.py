@@ -0,0 +1,671 @@
+#!/usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# (c) Valik mailto:vasnake@gmail.com
+
+'''
+Resident density service for Seismodensity project
+
+GP job startup (arcpy import, log setup, Describe, SR creation) dominates small polygons latency.
+This service loads seismoprofiles store, spatial index and SR once and answers over local HTTP;
+toolbox scripts become thin clients and fall back to in-process computation if service is down.
+Computations go through dispatcher (seismodispatch): limited workers, bounded queue,
+same polygon requested concurrently computed once.
+Store edited (seismodelta) or exported again: service notices new build not later than storeCheckInterval
+and reopens store and index, results cache dropped.
+
+Requests
+    GET /info
+        {"wkid": 32640, "partCount": ..., "segmentCount": ..., "stamp": "..."}
+    GET /metrics
+        requests phases durations percentiles, {"clip": {"count": n, "p50": sec, "p95": sec, "p99": sec}, ...}
+        and dispatcher counters, {"dispatcher": {"queued": n, "coalesced": n, "rejected": n, ...}}
+    POST /density
+        body: {"inputPolygon": <Esri JSON FeatureSet>} or FeatureSet itself,
+        same inputPolygon shape as GP tool (see seismodensitynosql.py docstring);
+        polygon in other SR (wkid 102100, 4326, ...) transformed into service SR (wkid from /info) by seismoproj.
+        Optional "session": "id" - start polygon editing session (seismosession), answer has "session" too;
+        polygon must be valid as is (no repair), HTTP 400 otherwise.
+        Optional "tolerance": 0.05 - approximate answer is good enough: length pyramid estimate
+        (seismopyramid.approxLength) with error not more than tolerance * length;
+        "refine": true with it - answer is two JSON lines, estimate at once, then exact result.
+        Optional "filter": "YEAR >= 2005 and CREW = 'SMNG'" - only profiles passing attribute filter (seismofilter),
+        "breakdown": "CREW" - answer has "lengthBreakdown": {"SMNG": km, ...}; both exact, tolerance ignored.
+        Answer: {"seismoDens": km/km2, "profilesLength": km, "shapeArea": km2, "accuracy": "exact"}
+        or with "accuracy": "approximate" and bounds "profilesLengthError": km, "seismoDensError": km/km2
+        or {"error": "message"} with HTTP status 400 (bad input), 503 (queue is full, retry later),
+        504 (not computed in request timeout) or 500.
+    POST /edit
+        body: {"session": "id", "edits": [{"ring": 0, "index": 3, "point": [x, y]}, ...]},
+        vertices moved, inserted or deleted (see seismosession), coords in SR of session polygon;
+        density recomputed incrementally, answer as for /density; unknown or expired session - HTTP 400,
+        send polygon to /density again. Sessions dropped when store changes.
+
+Start
+    python seismoservice.py [--host 127.0.0.1] [--port 8765] [--store DIR] [--index FILE] [--pyramid FILE] [--metrics FILE] [--log FILE]
+        [--workers 4] [--queue 32] [--timeout 60] [--policy reject|wait] [--processes 0]
+    defaults are seismodensitynosql.py constants.
+
+Doctests
+>>> import tempfile, shutil
+>>> tmp = tempfile.mkdtemp()
+>>> prof = seismoclip.ProfileSet.fromParts([[(0, 0), (100, 100)], [(0, 50), (100, 50)]])
+>>> seismostore.exportStore(os.path.join(tmp, 'store'), prof, wkid=32640, stamp='v1')
+>>> svc = DensityService(os.path.join(tmp, 'store'), os.path.join(tmp, 'index.npz'), workers=2)
+>>> fset = seismoclip.esriJsonFeatureSet([[(0, 0), (0, 100), (100, 100), (100, 0), (0, 0)]], 32640)
+>>> res = svc.density({'inputPolygon': fset})
+>>> round(res['profilesLength'], 6), res['shapeArea'], res['accuracy']
+(0.241421, 0.01, 'exact')
+>>> svc.dispatcher.stats()['completed']
+1
+>>> svc.density({'inputPolygon': fset, 'tolerance': 0.05})['accuracy'] # no pyramid, small polygon
+'exact'
+>>> svc.density({'inputPolygon': fset, 'filter': 'OBJECTID = 1'})
+Traceback (most recent call last):
+...
+NameError: Attribute 'OBJECTID' is not in store, add it to storeFields
+>>> ring = seismoproj.transformRings([[(0, 0), (0, 100), (100, 100), (100, 0), (0, 0)]], 32640, 102100)
+>>> res = svc.density(seismoclip.esriJsonFeatureSet(ring, 102100))
+>>> round(res['profilesLength'], 6), round(res['shapeArea'], 6)
+(0.241421, 0.01)
+>>> res = svc.density({'inputPolygon': fset, 'session': 's1'})
+>>> res = svc.edit({'session': 's1', 'edits': [{'ring': 0, 'index': 2, 'point': [100, 50]}]})
+>>> res['session'], round(res['profilesLength'], 6), res['shapeArea']
+('s1', 0.194281, 0.0075)
+>>> ccw = seismoclip.esriJsonFeatureSet([[(0, 0), (100, 0), (100, 100), (0, 100)]], 32640)
+>>> svc.density({'inputPolygon': ccw, 'session': 's2'}) # doctest: +ELLIPSIS
+Traceback (most recent call last):
+...
+NameError: Wrong input polygon for editing session (counterclockwise outer ring), ...
+>>> svc.sessions.get('s2') is None
+True
+>>> svc.dispatcher.stop(); shutil.rmtree(tmp)
+'''
+
+import os, sys, time
+import json
+import logging
+import threading
+try:
+    import urllib2
+except ImportError: # python 3
+    import urllib.request as urllib2
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError: # python 3
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+import seismoclip
+import seismorepair
+import seismoproj
+import seismoindex
+import seismopyramid
+import seismofilter
+import seismostore
+import seismocache
+import seismometrics
+import seismodispatch
+import seismoparallel
+import seismosession
+import seismolog
+
+serviceHost = '127.0.0.1'
+servicePort = 8765
+serviceUrl = 'http://%s:%s' % (serviceHost, servicePort)
+infoTimeout = 1 # seconds, service is local, no answer means it's down
+maxBodySize = 64 * 1024 * 1024
+storeCheckInterval = 5 # seconds between store header reads
+
+log = logging.getLogger('seismodens.service')
+
+
+class DensityService(object):
+    ''' Seismoprofiles, spatial index and results cache loaded once for all requests
+    '''
+
+    def __init__(self, storeDir, indexFile, pyramidFile='', pyramidMinCells=64,
+            workers=seismodispatch.workers, maxQueue=seismodispatch.maxQueue, policy='reject',
+            requestTimeout=seismodispatch.requestTimeout, processes=0):
+        ''' workers 0: no dispatcher, requests computed in HTTP threads;
+        processes > 1: large candidates sets clipped by seismoparallel.ClipPool of that many processes
+        '''
+        self.storeDir = storeDir
+        self.indexFile = indexFile
+        self.pyramidFile = pyramidFile
+        self.pyramidMinCells = pyramidMinCells
+        self.processes = processes
+        self._oldPool = None # clip pool of previous build, requests which took previous engine may use it
+        self.engine = self.openEngine()
+        self.wkid = self.profiles.header.get('wkid', 0)
+        self.cache = seismocache.ResultCache(stamp=self.stamp)
+        self.sessions = seismocache.ResultCache(seismosession.maxSessions, stamp=self.stamp)
+        self._cacheLock = threading.Lock()
+        self._engineLock = threading.Lock()
+        self._checked = time.time()
+        self.requestTimeout = requestTimeout
+        self.dispatcher = None
+        if workers > 0:
+            self.dispatcher = seismodispatch.Dispatcher(workers, maxQueue, policy)
+        log.info("DensityService, store '%s' loaded, wkid '%s', segments '%s'" % (
+            storeDir, self.wkid, self.index.itemCount))
+
+    profiles = property(lambda self: self.engine[0])
+    index = property(lambda self: self.engine[1])
+    stamp = property(lambda self: self.engine[2])
+    clipPool = property(lambda self: self.engine[3])
+
+    def openEngine(self):
+        ''' (profiles, index, stamp, clipPool) of current store build; one tuple, so request sees them consistent.
+        clipPool (processes > 1, None otherwise) workers open the same build as profiles.
+        '''
+        profiles = seismostore.openStore(self.storeDir)
+        stamp = profiles.header.get('stamp', '')
+        index = seismoindex.loadOrBuild(self.indexFile, profiles, stamp, log)
+        clipPool = None
+        if self.processes > 1:
+            clipPool = seismoparallel.ClipPool(self.storeDir, self.processes, header=profiles.header)
+        return (profiles, index, stamp, clipPool)
+
+    def checkStore(self):
+        ''' Reopen store, index and clip processes if store was edited or replaced.
+        Store header read not more often than storeCheckInterval. Return True if reopened.
+        Clip processes of previous build closed at next reopen, requests still running on it may use them.
+        '''
+        if time.time() - self._checked < storeCheckInterval:
+            return False
+        self._engineLock.acquire()
+        try:
+            if time.time() - self._checked < storeCheckInterval:
+                return False
+            self._checked = time.time()
+            if not seismostore.isStale(self.profiles):
+                return False
+            engine = self.openEngine()
+            profiles, index, stamp, clipPool = engine
+            oldPool, self._oldPool = self._oldPool, self.clipPool
+            self.wkid = profiles.header.get('wkid', 0)
+            self.engine = engine
+            self._cacheLock.acquire()
+            try:
+                self.cache.checkStamp(stamp)
+                self.sessions.checkStamp(stamp)
+            finally:
+                self._cacheLock.release()
+            if oldPool is not None:
+                oldPool.close()
+        finally:
+            self._engineLock.release()
+        log.info("DensityService.checkStore, store '%s' reopened, build '%s', segments '%s'" % (
+            self.storeDir, profiles.header.get('build'), index.itemCount))
+        return True
+
+    def close(self):
+        ''' Stop dispatcher workers and clip processes
+        '''
+        if self.dispatcher is not None:
+            self.dispatcher.stop()
+        for pool in (self.clipPool, self._oldPool):
+            if pool is not None:
+                pool.close()
+
+    def info(self):
+        return {'wkid': self.wkid, 'partCount': self.profiles.partCount,
+            'segmentCount': self.index.itemCount, 'stamp': self.stamp}
+
+    def _cachePut(self, key, res, stamp):
+        ''' Cache result computed over engine of data stamp; not cached if store was reopened meanwhile
+        '''
+        self._cacheLock.acquire()
+        try:
+            if self.cache.stamp == stamp:
+                self.cache.put(key, res)
+        finally:
+            self._cacheLock.release()
+
+    def calcDensity(self, rings, key=None):
+        ''' (density km/km2, length km, area km2) for polygon in service SR, cached.
+        Rings repaired (seismorepair) if not valid.
+        '''
+        profiles, index, stamp, clipPool = self.engine # taken once, checkStore may swap engine meanwhile
+        seismometrics.count('vertices', sum(len(r) for r in rings))
+        rings, problems = seismorepair.repairRings(rings)
+        if problems:
+            log.info("DensityService.calcDensity, input polygon repaired: %s" % ', '.join(problems))
+        if key is None:
+            key = seismocache.polygonKey(rings, self.wkid)
+        self._cacheLock.acquire()
+        try:
+            res = self.cache.get(key)
+        finally:
+            self._cacheLock.release()
+        if res is not None:
+            seismometrics.setValue('cache', 'hit')
+            return res
+        seismometrics.setValue('cache', 'miss')
+        area = seismoclip.polygonArea(rings) / 1000000.0
+        if area <= 0:
+            raise NameError("Wrong input polygon, you should send no selfintersected clockwise drawed single ring")
+        with seismometrics.phase('clip'):
+            length = seismopyramid.profilesLength(profiles, index, rings,
+                self.pyramidFile, stamp, self.pyramidMinCells, log, clipPool) / 1000.0
+        res = (length / area, length, area)
+        self._cachePut(key, res, stamp)
+        return res
+
+    def estimateDensity(self, rings, tolerance):
+        ''' (density km/km2, length km, area km2, length error km) for polygon in service SR:
+        cached exact result, pyramid estimate or exact result if polygon is small (error 0, cached).
+        '''
+        profiles, index, stamp, clipPool = self.engine
+        rings, problems = seismorepair.repairRings(rings)
+        if problems:
+            log.info("DensityService.estimateDensity, input polygon repaired: %s" % ', '.join(problems))
+        key = seismocache.polygonKey(rings, self.wkid)
+        self._cacheLock.acquire()
+        try:
+            res = self.cache.get(key)
+        finally:
+            self._cacheLock.release()
+        if res is not None:
+            seismometrics.setValue('cache', 'hit')
+            return res + (0.0, )
+        area = seismoclip.polygonArea(rings) / 1000000.0
+        if area <= 0:
+            raise NameError("Wrong input polygon, you should send no selfintersected clockwise drawed single ring")
+        with seismometrics.phase('estimate'):
+            length, error = seismopyramid.approxLength(profiles, index, rings, tolerance,
+                self.pyramidFile, stamp, self.pyramidMinCells, log, clipPool)
+        length, error = length / 1000.0, error / 1000.0
+        res = (length / area, length, area)
+        if error == 0:
+            self._cachePut(key, res, stamp)
+        return res + (error, )
+
+    def filteredDensity(self, rings, filterText, breakdown):
+        ''' (density km/km2, length km, area km2, breakdown value => km) for profiles passing
+        attribute filter, polygon in service SR; cached
+        '''
+        profiles, index, stamp, clipPool = self.engine
+        rings, problems = seismorepair.repairRings(rings)
+        if problems:
+            log.info("DensityService.filteredDensity, input polygon repaired: %s" % ', '.join(problems))
+        key = '%s:%s:%s' % (seismocache.polygonKey(rings, self.wkid), filterText, breakdown)
+        self._cacheLock.acquire()
+        try:
+            res = self.cache.get(key)
+        finally:
+            self._cacheLock.release()
+        if res is not None:
+            seismometrics.setValue('cache', 'hit')
+            return res
+        seismometrics.setValue('cache', 'miss')
+        area = seismoclip.polygonArea(rings) / 1000000.0
+        if area <= 0:
+            raise NameError("Wrong input polygon, you should send no selfintersected clockwise drawed single ring")
+        with seismometrics.phase('filter'):
+            mask = seismofilter.partsMask(profiles, filterText)
+        with seismometrics.phase('clip'):
+            length, parts = seismofilter.filteredLength(profiles, index, rings, mask, breakdown, clipPool, log)
+        length = length / 1000.0
+        res = (length / area, length, area, dict((k, v / 1000.0) for k, v in parts.items()))
+        self._cachePut(key, res, stamp)
+        return res
+
+    def _calcInJob(self, job, rings, key):
+        ''' calcDensity in dispatcher worker, metrics go to request job
+        '''
+        with seismometrics.useJob(job):
+            return self.calcDensity(rings, key)
+
+    def _filterInJob(self, job, rings, filterText, breakdown):
+        ''' filteredDensity in dispatcher worker, metrics go to request job
+        '''
+        with seismometrics.useJob(job):
+            return self.filteredDensity(rings, filterText, breakdown)
+
+    def _estimateInJob(self, job, rings, tolerance):
+        ''' estimateDensity in dispatcher worker, metrics go to request job
+        '''
+        with seismometrics.useJob(job):
+            return self.estimateDensity(rings, tolerance)
+
+    def density(self, request):
+        ''' Answer for /density request dict
+        '''
+        self.checkStore()
+        fset = request.get('inputPolygon', request)
+        if isinstance(fset, basestring):
+            fset = json.loads(fset)
+        with seismometrics.phase('parse'):
+            wkid, polygons = seismoclip.esriJsonPolygons(fset)
+        if not polygons:
+            raise NameError("Input FeatureSet has no features")
+        if not wkid:
+            raise NameError("Input FeatureSet has no spatialReference wkid")
+        rings = polygons[0][1] # only one polygon
+        if seismoclip.normalizeWkid(wkid) != seismoclip.normalizeWkid(self.wkid):
+            with seismometrics.phase('project'):
+                rings = seismoproj.transformRings(rings, wkid, self.wkid)
+        filterText, breakdown = request.get('filter') or '', request.get('breakdown') or ''
+        if (filterText or breakdown) and not request.get('session'):
+            return self.filteredAnswer(rings, filterText, breakdown)
+        tolerance = float(request.get('tolerance') or 0)
+        if tolerance > 0 and not request.get('session'):
+            return self.approxAnswer(rings, tolerance)
+        if request.get('session'):
+            sessionRings(rings) # before computation: invalid polygon can't be edited
+        if self.dispatcher is None:
+            density, length, area = self.calcDensity(rings)
+        else:
+            key = seismocache.polygonKey(rings, self.wkid)
+            with seismometrics.phase('dispatch'):
+                density, length, area = self.dispatcher.call(key, self._calcInJob,
+                    (seismometrics.currentJob(), rings, key), self.requestTimeout)
+        if request.get('session'):
+            return self.startSession('%s' % request['session'], rings, wkid, length)
+        return {'seismoDens': density, 'profilesLength': length, 'shapeArea': area, 'accuracy': 'exact'}
+
+    def filteredAnswer(self, rings, filterText, breakdown):
+        ''' /density answer with attribute filter and breakdown for polygon in service SR
+        '''
+        if self.dispatcher is None:
+            density, length, area, parts = self.filteredDensity(rings, filterText, breakdown)
+        else:
+            key = '%s:%s:%s' % (seismocache.polygonKey(rings, self.wkid), filterText, breakdown)
+            with seismometrics.phase('dispatch'):
+                density, length, area, parts = self.dispatcher.call(key, self._filterInJob,
+                    (seismometrics.currentJob(), rings, filterText, breakdown), self.requestTimeout)
+        return {'seismoDens': density, 'profilesLength': length, 'shapeArea': area, 'accuracy': 'exact',
+            'filter': filterText, 'lengthBreakdown': dict((u'%s' % k, v) for k, v in parts.items())}
+
+    def approxAnswer(self, rings, tolerance):
+        ''' /density answer with estimate for polygon in service SR
+        '''
+        if self.dispatcher is None:
+            density, length, area, error = self.estimateDensity(rings, tolerance)
+        else:
+            key = '%s:%s' % (seismocache.polygonKey(rings, self.wkid), tolerance)
+            with seismometrics.phase('dispatch'):
+                density, length, area, error = self.dispatcher.call(key, self._estimateInJob,
+                    (seismometrics.currentJob(), rings, tolerance), self.requestTimeout)
+        if error == 0:
+            return {'seismoDens': density, 'profilesLength': length, 'shapeArea': area, 'accuracy': 'exact'}
+        return {'seismoDens': density, 'profilesLength': length, 'shapeArea': area, 'accuracy': 'approximate',
+            'profilesLengthError': error, 'seismoDensError': error / area}
+
+    def startSession(self, sessionId, rings, wkid, length):
+        ''' New editing session for polygon, rings in service SR with client vertices numbering (sessionRings),
+        client SR wkid; length km computed already. Return /density answer with session id.
+        '''
+        profiles, index, stamp, clipPool = self.engine
+        session = seismosession.EditSession(profiles, index, sessionRings(rings), wkid, length * 1000.0)
+        density, length, area = session.density() # broken session not kept
+        self._cacheLock.acquire()
+        try:
+            if self.sessions.stamp == stamp: # store not reopened meanwhile, session over current build
+                self.sessions.put(sessionId, session)
+        finally:
+            self._cacheLock.release()
+        return {'seismoDens': density, 'profilesLength': length, 'shapeArea': area, 'accuracy': 'exact',
+            'session': sessionId}
+
+    def edit(self, request):
+        ''' Answer for /edit request dict
+        '''
+        self.checkStore()
+        sessionId, edits = request.get('session'), request.get('edits')
+        if not sessionId or not isinstance(edits, list):
+            raise NameError("Edit request needs session id and edits list")
+        sessionId = '%s' % sessionId
+        self._cacheLock.acquire()
+        try:
+            session = self.sessions.get(sessionId)
+        finally:
+            self._cacheLock.release()
+        if session is None:
+            raise NameError("Unknown or expired session '%s', send polygon to /density again" % sessionId)
+        seismometrics.count('edits', len(edits))
+        if seismoclip.normalizeWkid(session.wkid) != seismoclip.normalizeWkid(self.wkid):
+            with seismometrics.phase('project'):
+                edits = projectEdits(edits, session.wkid, self.wkid)
+        session.lock.acquire()
+        try:
+            with seismometrics.phase('edit'):
+                density, length, area = session.edit(edits)
+        finally:
+            session.lock.release()
+        return {'seismoDens': density, 'profilesLength': length, 'shapeArea': area, 'accuracy': 'exact',
+            'session': sessionId}
+#class DensityService(object):
+
+
+def projectEdits(edits, source, target):
+    ''' Edits with vertices coords transformed from source wkid SR to target, one transform call
+    '''
+    edits = [dict(e) for e in edits if isinstance(e, dict)]
+    points = [(e, k) for e in edits for k in ('point', 'insert') if k in e]
+    if points:
+        moved = seismoproj.transformRings([[e[k] for e, k in points]], source, target)[0]
+        for (e, k), pnt in zip(points, moved):
+            e[k] = pnt
+    return edits
+#def projectEdits(edits, source, target):
+
+
+def sessionRings(rings):
+    ''' Rings for editing session, NameError if polygon needs repair (seismorepair):
+    edits use client vertices numbering, so polygon can't be repaired, and session area and clip
+    of counterclockwise or self-intersected rings differ from density of repaired polygon.
+    Missing closing vertex is fine.
+    '''
+    problems = [p for p in seismorepair.repairRings(rings)[1] if p != 'unclosed ring']
+    if problems:
+        raise NameError("Wrong input polygon for editing session (%s), you should send no selfintersected "
+            "clockwise drawed rings or request density without session" % ', '.join(problems))
+    return rings
+#def sessionRings(rings):
+
+
+class DensityHandler(BaseHTTPRequestHandler):
+    ''' HTTP front of DensityService, server.service is DensityService
+    '''
+
+    def _reply(self, code, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _replyLine(self, obj):
+        ''' JSON line of streamed answer
+        '''
+        self.wfile.write(json.dumps(obj).encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+    def _refine(self, request, estimate):
+        ''' Two lines answer: estimate at once, exact result when computed (or error line).
+        HTTP/1.0 w/o Content-Length, client reads lines till connection closed.
+        '''
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        self._replyLine(estimate)
+        request = dict(request, tolerance=0)
+        try:
+            res = self.server.service.density(request)
+        except Exception, e:
+            log.warning("DensityHandler, refine failed: %s" % e)
+            res = {'error': '%s' % e}
+        self._replyLine(res)
+        return res
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/info':
+            self._reply(200, self.server.service.info())
+        elif self.path.rstrip('/') == '/metrics':
+            res = seismometrics.stats.summary()
+            if self.server.service.dispatcher is not None:
+                res['dispatcher'] = self.server.service.dispatcher.stats()
+            self._reply(200, res)
+        else:
+            self._reply(404, {'error': "Unknown path '%s'" % self.path})
+
+    def do_POST(self):
+        call = {'/density': self.server.service.density, '/edit': self.server.service.edit}.get(self.path.rstrip('/'))
+        if call is None:
+            self._reply(404, {'error': "Unknown path '%s'" % self.path})
+            return
+        job = seismometrics.startJob('service')
+        try:
+            with job.phase('read'):
+                size = int(self.headers.get('Content-Length') or 0)
+                if size > maxBodySize:
+                    raise NameError("Request too large, '%s' bytes" % size)
+                request = json.loads(self.rfile.read(size).decode('utf-8'))
+            res = call(request)
+        except NameError, e:
+            log.warning("DensityHandler, bad request: %s" % e)
+            job.finish(self.server.metricsFile, None, e)
+            self._reply(400, {'error': '%s' % e})
+            return
+        except seismodispatch.Saturated, e:
+            log.warning("DensityHandler, rejected: %s" % e)
+            job.finish(self.server.metricsFile, None, e)
+            self._reply(503, {'error': '%s' % e})
+            return
+        except seismodispatch.Timeout, e:
+            log.warning("DensityHandler, timeout: %s" % e)
+            job.finish(self.server.metricsFile, None, e)
+            self._reply(504, {'error': '%s' % e})
+            return
+        except Exception, e:
+            log.exception("DensityHandler, request failed")
+            job.finish(self.server.metricsFile, None, e)
+            self._reply(500, {'error': '%s' % e})
+            return
+        if res.get('accuracy') == 'approximate' and request.get('refine'):
+            res = self._refine(request, res)
+            rec = job.finish(self.server.metricsFile)
+            log.info("DensityHandler, refined %s, '%.3f' sec" % (res, rec['total']))
+            return
+        rec = job.finish(self.server.metricsFile)
+        log.info("DensityHandler, %s, '%.3f' sec" % (res, rec['total']))
+        self._reply(200, res)
+
+    def log_message(self, format, *args):
+        log.debug("DensityHandler, %s %s" % (self.address_string(), format % args))
+#class DensityHandler(BaseHTTPRequestHandler):
+
+
+class DensityServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, service, metricsFile=''):
+        HTTPServer.__init__(self, address, DensityHandler)
+        self.service = service
+        self.metricsFile = metricsFile
+#class DensityServer(ThreadingMixIn, HTTPServer):
+
+
+def _call(url, body=None, timeout=infoTimeout):
+    ''' HTTP GET (body None) or POST JSON, return decoded JSON answer
+    '''
+    data = None
+    if body is not None:
+        data = json.dumps(body).encode('utf-8')
+    req = urllib2.Request(url, data, {'Content-Type': 'application/json'})
+    fh = urllib2.urlopen(req, timeout=timeout)
+    try:
+        return json.loads(fh.read().decode('utf-8'))
+    finally:
+        fh.close()
+#def _call(url, body=None, timeout=infoTimeout):
+
+
+def serviceInfo(url=serviceUrl, timeout=infoTimeout):
+    ''' Service /info dict, None if service is down
+    '''
+    try:
+        return _call(url.rstrip('/') + '/info', timeout=timeout)
+    except Exception, e:
+        log.info("serviceInfo, service '%s' is not available: %s" % (url, e))
+        return None
+#def serviceInfo(url=serviceUrl, timeout=infoTimeout):
+
+
+def requestDensity(rings, wkid, url=serviceUrl, timeout=60):
+    ''' Ask service for polygon density. Return (density, length, area), raise on any failure
+    '''
+    res = _call(url.rstrip('/') + '/density',
+        {'inputPolygon': seismoclip.esriJsonFeatureSet(rings, wkid)}, timeout)
+    return (float(res['seismoDens']), float(res['profilesLength']), float(res['shapeArea']))
+#def requestDensity(rings, wkid, url=serviceUrl, timeout=60):
+
+
+def requestEstimate(rings, wkid, tolerance, url=serviceUrl, timeout=60):
+    ''' Ask service for polygon density, approximate answer allowed.
+    Return (density, length, area, length error), raise on any failure
+    '''
+    res = _call(url.rstrip('/') + '/density',
+        {'inputPolygon': seismoclip.esriJsonFeatureSet(rings, wkid), 'tolerance': tolerance}, timeout)
+    return (float(res['seismoDens']), float(res['profilesLength']), float(res['shapeArea']),
+        float(res.get('profilesLengthError', 0)))
+#def requestEstimate(rings, wkid, tolerance, url=serviceUrl, timeout=60):
+
+
+def requestFiltered(rings, wkid, filterText, breakdown='', url=serviceUrl, timeout=60):
+    ''' Ask service for density of profiles passing attribute filter.
+    Return (density, length, area, breakdown value => km), raise on any failure
+    '''
+    res = _call(url.rstrip('/') + '/density', {'inputPolygon': seismoclip.esriJsonFeatureSet(rings, wkid),
+        'filter': filterText, 'breakdown': breakdown}, timeout)
+    return (float(res['seismoDens']), float(res['profilesLength']), float(res['shapeArea']),
+        res.get('lengthBreakdown', {}))
+#def requestFiltered(rings, wkid, filterText, breakdown='', url=serviceUrl, timeout=60):
+
+
+def main():
+    import optparse
+    import seismodensitynosql as nosql
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--host', default=serviceHost)
+    parser.add_option('--port', type='int', default=servicePort)
+    parser.add_option('--store', default=os.path.join(nosql.toolDirPath, nosql.storeFName))
+    parser.add_option('--index', default=os.path.join(nosql.toolDirPath, nosql.indexFName))
+    parser.add_option('--pyramid', default=os.path.join(nosql.toolDirPath, nosql.pyramidFName))
+    parser.add_option('--metrics', default='', help='requests metrics file, JSON line per request')
+    parser.add_option('--log', default='', help='log file, written by background thread; stderr by default')
+    parser.add_option('--workers', type='int', default=seismodispatch.workers, help='computing threads, 0 - no dispatcher')
+    parser.add_option('--queue', type='int', default=seismodispatch.maxQueue, help='max jobs waiting for worker')
+    parser.add_option('--timeout', type='float', default=seismodispatch.requestTimeout, help='request timeout, seconds')
+    parser.add_option('--policy', default='reject', help="full queue: 'reject' (HTTP 503) or 'wait'")
+    parser.add_option('--processes', type='int', default=0, help='clip processes for large polygons, 0 - clip in worker thread')
+    opts, args = parser.parse_args()
+
+    if opts.log:
+        seismolog.setupLogger(logging.getLogger('seismodens'), opts.log, logging.INFO)
+    else:
+        logging.basicConfig(level=logging.INFO, format=seismolog.logFormat)
+    service = DensityService(opts.store, opts.index, opts.pyramid, nosql.pyramidMinCells,
+        opts.workers, opts.queue, opts.policy, opts.timeout, opts.processes)
+    server = DensityServer((opts.host, opts.port), service, opts.metrics)
+    log.info("main, serving on %s:%s" % (opts.host, opts.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info("main, stopped")
+    server.server_close()
+    service.close()
+#def main():
+
+
+if __name__ == "__main__":
+    if '--test' in sys.argv:
+        import doctest
+        doctest.testmod(verbose=True)
+    else:
+        main()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# (c) Valik mailto:vasnake@gmail.com
+
+'''
+Incremental density for interactive polygon editing, Seismodensity project
+
+Analyst draws polygon in web client and moves its vertices one by one, every move was full computation.
+EditSession keeps polygon, its area, total clipped length and clipped lengths of segments
+computed for previous edits. Edit (vertices moved, inserted, deleted) replaces few edges:
+    area corrected by shoelace terms of removed and added edges;
+    polygon changed only inside extent of removed and added edges, only index candidates there processed:
+        segment touching changed edge - clipped against new polygon edges in its y range (rayEdges);
+        other segment is inside or outside of changed region entirely: even-odd parity of changed edges
+        at segment midpoint (ray to +X, as seismoclip) tells if its inside part is flipped,
+        new length = segment length - old length; not flipped - not changed;
+        old lengths of changed segments known from previous edits, clipped against old polygon otherwise;
+    total length corrected by changed segments difference (math.fsum).
+Edit cost is about segments in changed edges neighbourhood, not profiles inside polygon;
+session start costs one ordinary computation (service gives length by pyramid).
+
+Vertices numbering is client's: ring vertices without closing one, so polygon is not repaired
+(seismorepair) in session; service starts session only for valid polygon (seismoservice.sessionRings),
+edits making it self-intersected give even-odd clip and shoelace area.
+Session is built for one store build (segments numbers); service drops sessions when store changes.
+
+Edits
+    {"ring": 0, "index": 3, "point": [x, y]} - move vertex;
+    {"ring": 0, "index": 3, "insert": [x, y]} - insert vertex before index (index = vertex count: append);
+    {"ring": 0, "index": 3, "delete": true} - delete vertex, ring keeps at least 3 vertices.
+
+Doctests
+>>> import seismoindex
+>>> rng = np.random.RandomState(2)
+>>> pts = rng.uniform(0, 100, (3000, 2, 2))
+>>> prof = seismoclip.ProfileSet.fromParts([[tuple(a), tuple(b)] for a, b in pts])
+>>> index = seismoindex.segmentsTree(prof)
+>>> ring = [[20, 20], [20, 80], [50, 90], [80, 80], [80, 20], [20, 20]]
+>>> ses = EditSession(prof, index, [ring])
+>>> ses.density() == seismoclip.calcDensity(prof, [ring])
+True
+>>> res = ses.edit([{'ring': 0, 'index': 2, 'point': [50, 40]}, {'ring': 0, 'index': 4, 'insert': [90, 50]}])
+>>> edited = [[[20, 20], [20, 80], [50, 40], [80, 80], [90, 50], [80, 20], [20, 20]]]
+>>> full = seismoclip.calcDensity(prof, edited)
+>>> ses.rings[0].tolist() == edited[0][:-1], abs(res[1] - full[1]) < 1e-12, res[2] == full[2]
+(True, True, True)
+>>> ses.edit([{'ring': 0, 'index': 4, 'delete': True}])[1] == seismoclip.calcDensity(prof, [ses.rings[0]])[1]
+True
+>>> ses.edit([{'ring': 0, 'index': 9, 'point': [1, 1]}])
+Traceback (most recent call last):
+...
+NameError: Wrong edit, ring 0 has no vertex 9
+'''
+
+import math
+import time
+import threading
+import numpy as np
+
+import seismoclip
+
+maxSessions = 64 # sessions kept by service, LRU
+maxKnown = 1000000 # known segments lengths kept by session, more - forgotten (clipped again when needed)
+
+
+def _openRing(ring):
+    ''' Ring vertices float64 array (n, 2) without closing vertex
+    '''
+    ring = np.array(ring, dtype=np.float64).reshape(-1, 2)
+    if len(ring) > 1 and ring[0][0] == ring[-1][0] and ring[0][1] == ring[-1][1]:
+        ring = ring[:-1]
+    return ring
+#def _openRing(ring):
+
+
+def segmentsTouchEdges(x0, y0, x1, y1, edges):
+    ''' Bool array: segment intersects or touches any of (few) edges, collinear overlap too
+    '''
+    ex0, ey0, ex1, ey1 = [e[None, :] for e in edges]
+    x0, y0, x1, y1 = x0[:, None], y0[:, None], x1[:, None], y1[:, None]
+    rx, ry = x1 - x0, y1 - y0
+    sx, sy = ex1 - ex0, ey1 - ey0
+    qx, qy = ex0 - x0, ey0 - y0
+    denom = rx * sy - ry * sx
+    qr = qx * ry - qy * rx
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (qx * sy - qy * sx) / denom
+        u = qr / denom
+        cross = (denom != 0) & (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)
+    # parallel: collinear and projections overlap
+    rr = rx * rx + ry * ry
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ta = (qx * rx + qy * ry) / rr
+        tb = ((ex1 - x0) * rx + (ey1 - y0) * ry) / rr
+        overlap = (denom == 0) & (qr == 0) & (np.maximum(ta, tb) >= 0) & (np.minimum(ta, tb) <= 1)
+    return (cross | overlap).any(axis=1)
+#def segmentsTouchEdges(x0, y0, x1, y1, edges):
+
+
+def rayEdges(edges, x0, y0, x1, y1):
+    ''' Polygon edges that may cross segments or +X rays from their points (seismoclip inside tests):
+    edges in segments y range, not entirely left of them. Clip against these edges gives the same result.
+    '''
+    ex0, ey0, ex1, ey1 = edges
+    keep = ((np.maximum(ex0, ex1) >= min(x0.min(), x1.min())) &
+        (np.maximum(ey0, ey1) >= min(y0.min(), y1.min())) & (np.minimum(ey0, ey1) <= max(y0.max(), y1.max())))
+    return (ex0[keep], ey0[keep], ex1[keep], ey1[keep])
+#def rayEdges(edges, x0, y0, x1, y1):
+
+
+def clipNear(x0, y0, x1, y1, edges):
+    ''' seismoclip.segmentsInsideLength with edges filtered by rayEdges
+    '''
+    if len(x0) == 0:
+        return np.zeros(0)
+    return seismoclip.segmentsInsideLength(x0, y0, x1, y1, rayEdges(edges, x0, y0, x1, y1), prefilter=False)
+
+
+class EditSession(object):
+    ''' Polygon, its area, clipped length and known per-segment clipped lengths for incremental edits
+    '''
+
+    def __init__(self, profiles, index, rings, wkid=0, length=None):
+        ''' index: seismoindex.STRTree over profiles segments or None (all segments are candidates);
+        rings in profiles SR, wkid: SR of client coords (edits);
+        length: clipped length, meters, if computed already (service, pyramid), clip of index candidates otherwise.
+        '''
+        self.profiles, self.index = profiles, index
+        self.wkid = wkid
+        self.rings = [r for r in (_openRing(r) for r in rings) if len(r) >= 3]
+        if not self.rings:
+            raise NameError("Wrong input polygon, no rings")
+        self.lock = threading.Lock() # edits of one session one at a time
+        self.used = time.time()
+        self.known = {} # segment number => clipped length for current polygon
+        self._edges = None
+        if length is None:
+            edges = self.edges()
+            segIdx = self.candidates(seismoclip.edgesExtent(edges))
+            length = math.fsum(seismoclip.segmentsInsideLength(*(self.segmentCoords(segIdx) + (edges, ))))
+        self.length = length
+        self.area = seismoclip.polygonArea(self.rings)
+
+    def edges(self):
+        ''' Polygon edges arrays (seismoclip.ringsEdges), cached until next edit
+        '''
+        if self._edges is None:
+            self._edges = seismoclip.ringsEdges(self.rings)
+        return self._edges
+
+    def candidates(self, envelope):
+        ''' Sorted segments numbers with bbox intersecting envelope
+        '''
+        if self.index is not None:
+            return self.index.query(envelope)
+        x0, y0, x1, y1, segPart = self.profiles.segments()
+        xmin, ymin, xmax, ymax = envelope
+        return np.nonzero(~((np.maximum(x0, x1) < xmin) | (np.minimum(x0, x1) > xmax) |
+            (np.maximum(y0, y1) < ymin) | (np.minimum(y0, y1) > ymax)))[0]
+
+    def segmentCoords(self, segIdx):
+        x0, y0, x1, y1, segPart = self.profiles.segments()
+        return (x0[segIdx], y0[segIdx], x1[segIdx], y1[segIdx])
+
+    def knownLengths(self, segIdx, edges):
+        ''' Clipped lengths of segments against current polygon (edges):
+        known from previous edits or clipped now and kept
+        '''
+        res = np.array([self.known.get(seg, -1.0) for seg in segIdx])
+        todo = res < 0
+        if todo.any():
+            res[todo] = clipNear(*(self.segmentCoords(segIdx[todo]) + (edges, )))
+            if len(self.known) > maxKnown:
+                self.known = {}
+            self.known.update(zip(segIdx[todo], res[todo]))
+        return res
+
+    def density(self):
+        ''' (density km/km2, length km, area km2), as seismoclip.calcDensity
+        '''
+        area = self.area / 1000000.0
+        if area <= 0:
+            raise NameError("Wrong input polygon, you should send no selfintersected clockwise drawed single ring")
+        length = self.length / 1000.0
+        return (length / area, length, area)
+
+    def applyEdits(self, edits):
+        ''' New rings list and (removed, added) edges lists of (x0, y0, x1, y1); session rings not changed
+        '''
+        rings = list(self.rings)
+        removed, added = [], []
+        for edit in edits:
+            try:
+                r, i = int(edit.get('ring', 0)), int(edit['index'])
+                ring = rings[r]
+            except (KeyError, IndexError, TypeError, ValueError, AttributeError):
+                raise NameError("Wrong edit '%s'" % (edit, ))
+            n = len(ring)
+            if not (0 <= i < n or (i == n and 'insert' in edit)):
+                raise NameError("Wrong edit, ring %s has no vertex %s" % (r, i))
+            prev = tuple(ring[i - 1])
+            if 'insert' in edit:
+                new = tuple(float(c) for c in edit['insert'][:2])
+                cur = tuple(ring[i % n])
+                removed.append(prev + cur)
+                added.extend([prev + new, new + cur])
+                rings[r] = np.insert(ring, i, new, axis=0)
+                continue
+            cur, nxt = tuple(ring[i]), tuple(ring[(i + 1) % n])
+            removed.extend([prev + cur, cur + nxt])
+            if edit.get('delete'):
+                if n <= 3:
+                    raise NameError("Wrong edit, ring %s can't have less than 3 vertices" % r)
+                added.append(prev + nxt)
+                rings[r] = np.delete(ring, i, axis=0)
+            elif 'point' in edit:
+                new = tuple(float(c) for c in edit['point'][:2])
+                added.extend([prev + new, new + nxt])
+                rings[r] = ring.copy()
+                rings[r][i] = new
+            else:
+                raise NameError("Wrong edit '%s'" % (edit, ))
+        return rings, removed, added
+
+    def edit(self, edits):
+        ''' Apply edits (see module docstring), return new (density km/km2, length km, area km2)
+        '''
+        self.used = time.time()
+        rings, removed, added = self.applyEdits(edits)
+        oldEdges = self.edges()
+        self.rings, self._edges = rings, None
+        if not removed:
+            return self.density()
+        # area: shoelace terms, as seismoclip.polygonArea
+        cross = lambda e: [x0 * y1 - x1 * y0 for x0, y0, x1, y1 in e]
+        self.area -= math.fsum(cross(added) + [-c for c in cross(removed)]) / 2.0
+
+        changedEdges = tuple(np.array(c, dtype=np.float64) for c in zip(*(removed + added)))
+        segIdx = self.candidates(seismoclip.edgesExtent(changedEdges))
+        if len(segIdx) == 0:
+            return self.density()
+        x0, y0, x1, y1 = self.segmentCoords(segIdx)
+        touch = segmentsTouchEdges(x0, y0, x1, y1, changedEdges)
+        # other segments: inside part flipped where segment lies in changed region (odd parity of changed edges)
+        flip = np.zeros(len(segIdx), dtype=bool)
+        whole = ~touch
+        flip[whole] = seismoclip.pointsInPolygon((x0[whole] + x1[whole]) / 2.0, (y0[whole] + y1[whole]) / 2.0,
+            changedEdges)
+        changed = touch | flip
+        if not changed.any():
+            return self.density()
+        segIdx, x0, y0, x1, y1 = segIdx[changed], x0[changed], y0[changed], x1[changed], y1[changed]
+        touch, flip = touch[changed], flip[changed]
+        old = self.knownLengths(segIdx, oldEdges)
+        new = np.hypot(x1 - x0, y1 - y0) - old
+        if touch.any():
+            new[touch] = clipNear(x0[touch], y0[touch], x1[touch], y1[touch], self.edges())
+        self.known.update(zip(segIdx, new))
+        self.length += math.fsum(np.concatenate([new, -old]))
+        return self.density()
+#class EditSession(object):
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(verbose=True)
@@ -0,0 +1,669 @@
+#!/usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# (c) Valik mailto:vasnake@gmail.com
+
+'''
+Columnar seismoprofiles store for Seismodensity project
+
+APP_GP_SEISM2D_L exported once from Seis_button.gdb into flat binary files;
+density engine opens them by np.memmap, zero-copy: cold start costs page faults
+instead of geometry decoding through arcpy, and many worker processes share one page cache.
+
+On-disk format, folder (APP_GP_SEISM2D_L.store) with header.json and build folders:
+    header.json - format name and version, counts, SR WKID, data stamp, build number, columns list,
+        dataDir - name of current build folder;
+build folder (build.XXXX, unique name for each export or edit) files:
+    x.f8, y.f8 - vertices coords, little-endian float64, vertexCount items each;
+    offsets.i8 - parts offsets, little-endian int64, partCount + 1 items,
+        part i vertices is x[offsets[i]:offsets[i+1]];
+    oids.i8 - OBJECTID of each part, int64, partCount items, deadOid for deleted part;
+    bbox.f8 - parts bounding boxes, float64, partCount rows of (xmin, ymin, xmax, ymax);
+    seg.x0.f8, seg.y0.f8, seg.x1.f8, seg.y1.f8 - segments ends, float64, segmentCount items each;
+    segpart.i8 - part number of each segment, int64, segmentCount items, ascending;
+    manifest.i8, manifest.u8 - live features OBJECTID (ascending, int64) and geometry hash (uint64),
+        featureCount items each;
+    attr.NAME.f8 / attr.NAME.i8 - numeric attribute column, one item per part;
+    attr.NAME.i4 + attr.NAME.json - text attribute column: int32 codes per part
+        and JSON list of values (code is index in list).
+All files are raw arrays w/o headers, so they can be read by any tool knowing counts from header.json.
+
+Build files are never rewritten after header.json points to them: other processes (service, ClipPool workers)
+have them memory mapped, truncated mapped file kills reader by SIGBUS (on Windows truncation fails).
+Export writes new build folder and switches header.json to it (writeHeader, temp file rename);
+old builds removed by removeBuilds, except current and previous one (readers which read previous header
+and didn't map files yet); removal errors ignored (Windows: files mapped by reader), retried next time.
+
+Writers (export, seismodelta edit) hold exclusive store lock (storeLock, lock file created by O_CREAT | O_EXCL);
+edit copies current build (copyBuild) and changes the copy, so readers never see files changed underneath them.
+Files edit only appends to are hard linked into new build instead of copied (where os.link works):
+reader maps header count items of file, appended items are after them.
+
+Edits (seismodelta): deleted part keeps its place, oid set to deadOid and all vertices and segments ends
+moved to part first vertex, so its length is zero for every engine; new parts appended to the ends of files.
+Files may be longer than header counts (interrupted edit), extra items are ignored and cut by next edit.
+header.json 'build' grows by one on every edit, reader compares it and build folder (isStale) to reopen store.
+
+Doctests
+>>> import tempfile, shutil, seismoclip
+>>> tmp = tempfile.mkdtemp()
+>>> prof = seismoclip.ProfileSet.fromParts([[(0, 0), (10, 0)], [(0, 5), (5, 5), (5, 10)]], oids=[7, 8])
+>>> exportStore(tmp, prof, {'YEAR': [1999, 2005], 'CREW': ['A', 'B']}, wkid=32640, stamp='v1')
+>>> st = openStore(tmp)
+>>> st.header['wkid'], st.vertexCount, st.segmentCount(), list(st.oids)
+(32640, 5, 3, [7, 8])
+>>> isinstance(st.x.base, np.memmap) # no copy
+True
+>>> first = st.header['dataDir']
+>>> exportStore(tmp, seismoclip.ProfileSet.fromParts([[(0, 0), (3, 0)]], oids=[5]), stamp='v0')
+>>> isStale(st), list(st.oids), st.x[-1] # old build files untouched
+(True, [7, 8], 5.0)
+>>> exportStore(tmp, prof, {'YEAR': [1999, 2005], 'CREW': ['A', 'B']}, wkid=32640, stamp='v1')
+>>> os.path.isdir(buildPath(tmp, st.header)), len([n for n in os.listdir(tmp) if n.startswith('build.')])
+(False, 2)
+>>> st = openStore(tmp)
+>>> [str(v) for v in st.attrs['CREW'].values], list(st.attrs['CREW'].codes), list(st.attrs['YEAR'])
+(['A', 'B'], [0, 1], [1999, 2005])
+>>> header = readHeader(tmp)
+>>> lock = storeLock(tmp); lock.__enter__()
+>>> try: storeLock(tmp, wait=0).__enter__()
+... except NameError: print 'locked'
+locked
+>>> newData = copyBuild(tmp, header)
+>>> list(deleteParts(tmp, header, [7])[0]), st.x[1] # opened build not changed
+([0], 10.0)
+>>> appendParts(tmp, header, seismoclip.ProfileSet.fromParts([[(1, 1), (1, 4)]], oids=[9]), {'YEAR': [2012], 'CREW': ['C']})
+(3, 4)
+>>> header['build'] += 1; writeHeader(tmp, header); isStale(st)
+True
+>>> st = openStore(tmp)
+>>> list(st.oids), st.segmentCount(), seismoclip.clippedLength(st, [[(0, -1), (0, 11), (11, 11), (11, -1)]])
+([-1, 8, 9], 4, 13.0)
+>>> [str(st.attrs['CREW'][i]) for i in range(3)], header['build']
+(['A', 'B', 'C'], 2)
+>>> newData = copyBuild(tmp, header, appendOnly=True) # no deletes: all files linked
+>>> os.path.samefile(os.path.join(buildPath(tmp, st.header), 'x.f8'), os.path.join(tmp, newData, 'x.f8')) == hasattr(os, 'link')
+True
+>>> appendParts(tmp, header, seismoclip.ProfileSet.fromParts([[(2, 1), (2, 3)]], oids=[10]), {'YEAR': [2013], 'CREW': ['C']})
+(4, 5)
+>>> header['build'] += 1; writeHeader(tmp, header)
+>>> list(st.oids), st.segmentCount(), list(openStore(tmp).oids) # opened build sees its counts only
+([-1, 8, 9], 4, [-1, 8, 9, 10])
+>>> lock.__exit__(None, None, None)
+>>> shutil.rmtree(tmp)
+'''
+
+import os
+import time
+import json
+import errno
+import shutil
+import tempfile
+from contextlib import contextmanager
+import struct
+import hashlib
+import numpy as np
+
+import seismoclip
+from seismoindex import expandRanges
+
+storeDirExt = '.store'
+formatName = 'seismostore'
+formatVersion = 3
+deadOid = -1 # oids.i8 value of deleted part
+segmentFiles = ('seg.x0.f8', 'seg.y0.f8', 'seg.x1.f8', 'seg.y1.f8')
+lockFName = 'lock'
+lockWait = 300.0 # seconds writer waits for other writer (export of large archive is slow)
+lockStale = 3600.0 # seconds, older lock file left by crashed process, broken
+
+_storeCache = {} # store folder => ProfileSet
+
+
+class CategoryColumn(object):
+    ''' Text attribute: codes array (int32 per part) and values list, code is index in values
+    '''
+
+    def __init__(self, codes, values):
+        self.codes = codes
+        self.values = values
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        return self.values[self.codes[i]]
+
+    @classmethod
+    def fromList(cls, items):
+        values = sorted(set(items))
+        lookup = dict((v, i) for i, v in enumerate(values))
+        return cls(np.array([lookup[v] for v in items], dtype=np.int32), values)
+#class CategoryColumn(object):
+
+
+def _writeArray(fileName, arr, dtype):
+    np.ascontiguousarray(arr, dtype=np.dtype(dtype)).tofile(fileName)
+
+
+def _appendArray(fileName, arr, dtype, count):
+    ''' Write arr after first count items of file, items after them (interrupted edit) dropped
+    '''
+    dtype = np.dtype(dtype)
+    fh = open(fileName, os.path.exists(fileName) and 'r+b' or 'w+b')
+    try:
+        fh.truncate(count * dtype.itemsize)
+        fh.seek(0, 2)
+        np.ascontiguousarray(arr, dtype=dtype).tofile(fh)
+    finally:
+        fh.close()
+#def _appendArray(fileName, arr, dtype, count):
+
+
+def _mapArray(fileName, dtype, count, mode='r'):
+    if count == 0:
+        return np.zeros(0, dtype=np.dtype(dtype))
+    return np.memmap(fileName, dtype=np.dtype(dtype), mode=mode, shape=(count,))
+
+
+def partsBBox(profiles):
+    ''' Parts bounding boxes, partCount x 4 array of (xmin, ymin, xmax, ymax), zeros for empty part
+    '''
+    bbox = np.zeros((profiles.partCount, 4))
+    if profiles.vertexCount:
+        starts = profiles.offsets[:-1]
+        nonEmpty = profiles.offsets[1:] > starts
+        st = starts[nonEmpty]
+        bbox[nonEmpty, 0] = np.minimum.reduceat(profiles.x, st)
+        bbox[nonEmpty, 1] = np.minimum.reduceat(profiles.y, st)
+        bbox[nonEmpty, 2] = np.maximum.reduceat(profiles.x, st)
+        bbox[nonEmpty, 3] = np.maximum.reduceat(profiles.y, st)
+    return bbox
+#def partsBBox(profiles):
+
+
+def featureHashes(profiles):
+    ''' (oids, hashes): ascending OBJECTID of live features and geometry hash of each,
+    hash is first 8 bytes of md5 over feature parts vertices counts and coords, as uint64.
+
+    >>> prof = seismoclip.ProfileSet.fromParts([[(0, 0), (1, 0)], [(5, 5), (6, 6)], [(0, 0), (1, 0)]], oids=[3, 1, 2])
+    >>> oids, hashes = featureHashes(prof)
+    >>> list(oids), hashes[1] == hashes[2], hashes[0] == hashes[1]
+    ([1, 2, 3], True, False)
+    '''
+    oids = np.asarray(profiles.oids, dtype=np.int64)
+    live = np.nonzero(oids != deadOid)[0]
+    order = live[np.argsort(oids[live], kind='mergesort')]
+    uniq, first = np.unique(oids[order], return_index=True)
+    bounds = list(first) + [len(order)]
+    x = np.ascontiguousarray(profiles.x, dtype='<f8')
+    y = np.ascontiguousarray(profiles.y, dtype='<f8')
+    offsets = profiles.offsets
+    hashes = np.zeros(len(uniq), dtype=np.uint64)
+    for i in range(len(uniq)):
+        md = hashlib.md5()
+        for part in order[bounds[i]:bounds[i + 1]]:
+            a, b = int(offsets[part]), int(offsets[part + 1])
+            md.update(struct.pack('<q', b - a))
+            md.update(x[a:b].tostring())
+            md.update(y[a:b].tostring())
+        hashes[i] = struct.unpack('<Q', md.digest()[:8])[0]
+    return uniq.astype(np.int64), hashes
+#def featureHashes(profiles):
+
+
+def newBuild(storeDir):
+    ''' Create new empty build folder in store, return its name
+    '''
+    dataDir = tempfile.mkdtemp(prefix='build.', dir=storeDir)
+    os.chmod(dataDir, 0755) # readable by service account as store folder is
+    return os.path.basename(dataDir)
+#def newBuild(storeDir):
+
+
+def buildPath(storeDir, header):
+    ''' Folder of build files for store header
+    '''
+    return os.path.join(storeDir, header['dataDir'])
+
+
+def removeBuilds(storeDir, keep=()):
+    ''' Remove store build folders (and files of old format stores) except header.json and keep names.
+    Errors ignored: file mapped by reader on Windows can't be removed, next call retries.
+    '''
+    for name in os.listdir(storeDir):
+        if name in keep or name.startswith('header.json') or name == lockFName:
+            continue
+        path = os.path.join(storeDir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path, True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+#def removeBuilds(storeDir, keep=()):
+
+
+def copyBuild(storeDir, header, appendOnly=False):
+    ''' Copy files of header build into new build folder, header 'dataDir' set to it (header not written).
+    Edits (deleteParts, appendParts) then change the copy, readers of current build don't see them till writeHeader.
+    Files appendParts only appends to are hard linked, not copied; appendOnly (no deleteParts in edit):
+    vertices, segments, bbox and oids files too. Copied if os.link is missing (Windows Python 2) or fails.
+    '''
+    src = buildPath(storeDir, header)
+    dataDir = newBuild(storeDir)
+    link = set(['offsets.i8', 'segpart.i8'] + [col['file'] for col in header['columns']])
+    if appendOnly:
+        link.update(['x.f8', 'y.f8', 'oids.i8', 'bbox.f8'] + list(segmentFiles))
+    for name in os.listdir(src):
+        source, target = os.path.join(src, name), os.path.join(storeDir, dataDir, name)
+        if name in link and hasattr(os, 'link'):
+            try:
+                os.link(source, target)
+                continue
+            except OSError:
+                pass # file system w/o hard links
+        shutil.copyfile(source, target)
+    header['dataDir'] = dataDir
+    return dataDir
+#def copyBuild(storeDir, header, appendOnly=False):
+
+
+@contextmanager
+def storeLock(storeDir, wait=lockWait, log=None):
+    ''' Exclusive lock of store writers for block: lock file in store folder, created with O_CREAT | O_EXCL.
+    Lock file older than lockStale seconds is left by crashed process and broken.
+    Raise NameError if store is locked by other process longer than wait seconds.
+    '''
+    try:
+        os.makedirs(storeDir)
+    except OSError:
+        if not os.path.isdir(storeDir):
+            raise
+    lockName = os.path.join(storeDir, lockFName)
+    start = time.time()
+    while True:
+        try:
+            fd = os.open(lockName, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        try:
+            if time.time() - os.path.getmtime(lockName) > lockStale:
+                if log: log.warning("seismostore.storeLock, stale lock '%s' removed" % lockName)
+                os.remove(lockName)
+                continue
+        except OSError:
+            continue # released meanwhile
+        if time.time() - start >= wait:
+            raise NameError("Store '%s' is locked by other process" % storeDir)
+        time.sleep(0.1)
+    try:
+        os.write(fd, '%s' % os.getpid())
+    finally:
+        os.close(fd)
+    try:
+        yield
+    finally:
+        os.remove(lockName)
+#def storeLock(storeDir, wait=lockWait, log=None):
+
+
+def exportStore(storeDir, profiles, attrs=None, wkid=0, stamp='', build=1):
+    ''' Write ProfileSet and per part attributes into new build folder of store, then switch header.json to it.
+
+    attrs: dict name => list or array, one item per part;
+    numbers stored as int64 or float64, text as category column.
+    Current build files are not touched, readers keep working on them till they reopen store (isStale);
+    half written build has no header pointing to it and will not be opened.
+    Builds older than replaced one removed (removeBuilds).
+    '''
+    if not os.path.isdir(storeDir):
+        os.makedirs(storeDir)
+    keep = []
+    try:
+        old = readHeader(storeDir)
+        if old and old.get('dataDir'):
+            keep.append(old['dataDir'])
+    except Exception:
+        pass
+    dataDir = newBuild(storeDir)
+    path = lambda name: os.path.join(storeDir, dataDir, name)
+
+    nparts = profiles.partCount
+    x0, y0, x1, y1, segPart = profiles.segments()
+    featOids, featHashes = featureHashes(profiles)
+
+    _writeArray(path('x.f8'), profiles.x, '<f8')
+    _writeArray(path('y.f8'), profiles.y, '<f8')
+    _writeArray(path('offsets.i8'), profiles.offsets, '<i8')
+    _writeArray(path('oids.i8'), profiles.oids, '<i8')
+    _writeArray(path('bbox.f8'), partsBBox(profiles), '<f8')
+    for name, arr in zip(segmentFiles, (x0, y0, x1, y1)):
+        _writeArray(path(name), arr, '<f8')
+    _writeArray(path('segpart.i8'), segPart, '<i8')
+    _writeArray(path('manifest.i8'), featOids, '<i8')
+    _writeArray(path('manifest.u8'), featHashes, '<u8')
+
+    columns = []
+    for name, items in sorted((attrs or {}).items()):
+        if len(items) != nparts:
+            raise NameError("Attribute '%s' has %s items, expected %s" % (name, len(items), nparts))
+        if isinstance(items, CategoryColumn):
+            col = items
+        else:
+            arr = np.asarray(items)
+            col = None
+            if arr.dtype.kind in 'iub':
+                _writeArray(path('attr.%s.i8' % name), arr, '<i8')
+                columns.append({'name': name, 'kind': 'int', 'file': 'attr.%s.i8' % name})
+            elif arr.dtype.kind == 'f':
+                _writeArray(path('attr.%s.f8' % name), arr, '<f8')
+                columns.append({'name': name, 'kind': 'float', 'file': 'attr.%s.f8' % name})
+            else:
+                col = CategoryColumn.fromList([u'%s' % v for v in items])
+        if col is not None:
+            _writeArray(path('attr.%s.i4' % name), col.codes, '<i4')
+            _writeValues(path('attr.%s.json' % name), col.values)
+            columns.append({'name': name, 'kind': 'category', 'file': 'attr.%s.i4' % name,
+                'values': 'attr.%s.json' % name})
+
+    header = {'format': formatName, 'version': formatVersion, 'byteorder': 'little',
+        'partCount': int(nparts), 'vertexCount': int(profiles.vertexCount),
+        'segmentCount': int(len(x0)), 'featureCount': int(len(featOids)),
+        'deadParts': 0, 'deadSegments': 0, 'build': int(build),
+        'wkid': int(wkid or 0), 'stamp': stamp, 'columns': columns, 'dataDir': dataDir}
+    writeHeader(storeDir, header)
+    removeBuilds(storeDir, keep + [dataDir])
+#def exportStore(storeDir, profiles, attrs=None, wkid=0, stamp='', build=1):
+
+
+def _writeValues(fileName, values):
+    fh = open(fileName, 'w')
+    try:
+        json.dump(list(values), fh)
+    finally:
+        fh.close()
+
+
+def _readValues(fileName):
+    fh = open(fileName)
+    try:
+        return json.load(fh)
+    finally:
+        fh.close()
+
+
+def writeHeader(storeDir, header):
+    ''' Replace header.json by temp file rename, readers never see half written header;
+    on Windows rename can't replace file, header is removed first and reader may find no header for a moment.
+    '''
+    headerName = os.path.join(storeDir, 'header.json')
+    fh = open(headerName + '.tmp', 'w')
+    try:
+        json.dump(header, fh, indent=1, sort_keys=True)
+    finally:
+        fh.close()
+    if os.path.exists(headerName):
+        os.remove(headerName)
+    os.rename(headerName + '.tmp', headerName)
+#def writeHeader(storeDir, header):
+
+
+def readHeader(storeDir):
+    ''' header.json as dict, None if store not found or not complete
+    '''
+    headerName = os.path.join(storeDir, 'header.json')
+    if not os.path.exists(headerName):
+        return None
+    fh = open(headerName)
+    try:
+        header = json.load(fh)
+    finally:
+        fh.close()
+    if header.get('format') != formatName or header.get('version') != formatVersion:
+        raise NameError("Unknown store format '%s' version '%s' in '%s'" % (
+            header.get('format'), header.get('version'), storeDir))
+    return header
+#def readHeader(storeDir):
+
+
+def isStale(profiles):
+    ''' True if store of opened profiles was edited or replaced after openStore
+    '''
+    try:
+        header = readHeader(profiles.storeDir)
+    except Exception:
+        return True
+    return header is None or header.get('build') != profiles.header.get('build') or (
+        header.get('stamp') != profiles.header.get('stamp')) or header.get('dataDir') != profiles.header.get('dataDir')
+#def isStale(profiles):
+
+
+def openStore(storeDir, header=None):
+    ''' ProfileSet over memory mapped files of store current build (header None) or of header build.
+    Result has extra members: header (dict), storeDir, bbox (partCount x 4), attrs (name => column).
+    '''
+    if header is None:
+        header = readHeader(storeDir)
+    if header is None:
+        raise NameError("Store '%s' not found" % storeDir)
+    nv, npart, nseg = header['vertexCount'], header['partCount'], header['segmentCount']
+    path = lambda name: os.path.join(buildPath(storeDir, header), name)
+
+    profiles = seismoclip.ProfileSet(_mapArray(path('x.f8'), '<f8', nv), _mapArray(path('y.f8'), '<f8', nv),
+        _mapArray(path('offsets.i8'), '<i8', npart + 1), _mapArray(path('oids.i8'), '<i8', npart))
+    profiles._segments = tuple(_mapArray(path(name), '<f8', nseg) for name in segmentFiles) + (
+        _mapArray(path('segpart.i8'), '<i8', nseg), )
+    profiles.bbox = _mapArray(path('bbox.f8'), '<f8', 4 * npart).reshape(npart, 4)
+    profiles.header = header
+    profiles.storeDir = storeDir
+    profiles.attrs = {}
+    for col in header['columns']:
+        if col['kind'] == 'category':
+            profiles.attrs[col['name']] = CategoryColumn(_mapArray(path(col['file']), '<i4', npart),
+                _readValues(path(col['values'])))
+        elif col['kind'] == 'int':
+            profiles.attrs[col['name']] = _mapArray(path(col['file']), '<i8', npart)
+        else:
+            profiles.attrs[col['name']] = _mapArray(path(col['file']), '<f8', npart)
+    return profiles
+#def openStore(storeDir, header=None):
+
+
+def readManifest(storeDir, header):
+    ''' (oids, hashes) of live features, see featureHashes
+    '''
+    count = header['featureCount']
+    return (np.array(_mapArray(os.path.join(buildPath(storeDir, header), 'manifest.i8'), '<i8', count)),
+        np.array(_mapArray(os.path.join(buildPath(storeDir, header), 'manifest.u8'), '<u8', count)))
+#def readManifest(storeDir, header):
+
+
+def writeManifest(storeDir, header, oids, hashes):
+    _writeArray(os.path.join(buildPath(storeDir, header), 'manifest.i8'), oids, '<i8')
+    _writeArray(os.path.join(buildPath(storeDir, header), 'manifest.u8'), hashes, '<u8')
+    header['featureCount'] = int(len(oids))
+
+
+def deleteParts(storeDir, header, oids):
+    ''' Mark all parts of features oids deleted, in files of header build (copyBuild first): oid set to deadOid,
+    vertices, segments ends and bbox moved to part first vertex.
+    Return (segNo, x0, y0, x1, y1): deleted segments numbers and their coords before edit.
+    header counts updated, caller writes it (writeHeader) after all edits.
+    '''
+    path = lambda name: os.path.join(buildPath(storeDir, header), name)
+    nv, npart, nseg = header['vertexCount'], header['partCount'], header['segmentCount']
+    empty = np.zeros(0)
+    if npart == 0 or len(oids) == 0:
+        return (np.zeros(0, dtype=np.int64), empty, empty, empty, empty)
+    partOids = _mapArray(path('oids.i8'), '<i8', npart, 'r+')
+    parts = np.nonzero(np.in1d(partOids, np.asarray(oids, dtype=np.int64)) & (partOids != deadOid))[0]
+    segPart = _mapArray(path('segpart.i8'), '<i8', nseg)
+    segNo = expandRanges(np.searchsorted(segPart, parts, 'left'), np.searchsorted(segPart, parts, 'right'))
+    seg = [_mapArray(path(name), '<f8', nseg, 'r+') for name in segmentFiles]
+    old = tuple(np.array(a[segNo]) for a in seg)
+
+    offsets = _mapArray(path('offsets.i8'), '<i8', npart + 1)
+    starts, ends = offsets[parts], offsets[parts + 1]
+    nonEmpty = ends > starts
+    x = _mapArray(path('x.f8'), '<f8', nv, 'r+')
+    y = _mapArray(path('y.f8'), '<f8', nv, 'r+')
+    vert = expandRanges(starts[nonEmpty], ends[nonEmpty])
+    firstX = np.repeat(x[starts[nonEmpty]], (ends - starts)[nonEmpty])
+    firstY = np.repeat(y[starts[nonEmpty]], (ends - starts)[nonEmpty])
+    x[vert], y[vert] = firstX, firstY
+    segFirst = np.searchsorted(vert, offsets[segPart[segNo]]) # part first vertex position in vert
+    seg[0][segNo] = seg[2][segNo] = firstX[segFirst]
+    seg[1][segNo] = seg[3][segNo] = firstY[segFirst]
+    bbox = _mapArray(path('bbox.f8'), '<f8', 4 * npart, 'r+').reshape(npart, 4)
+    live = parts[nonEmpty]
+    bbox[live, 0] = bbox[live, 2] = x[starts[nonEmpty]]
+    bbox[live, 1] = bbox[live, 3] = y[starts[nonEmpty]]
+    partOids[parts] = deadOid
+    for arr in seg + [x, y, bbox, partOids]:
+        if isinstance(arr, np.memmap):
+            arr.flush()
+    del seg, x, y, bbox, partOids
+
+    header['deadParts'] = header.get('deadParts', 0) + len(parts)
+    header['deadSegments'] = header.get('deadSegments', 0) + len(segNo)
+    return (segNo, ) + old
+#def deleteParts(storeDir, header, oids):
+
+
+def appendParts(storeDir, header, profiles, attrs=None):
+    ''' Append ProfileSet parts and their attributes (name => list, one item per part) to files of header build
+    (copyBuild first).
+    Return (start, stop) of appended segments numbers.
+    header counts updated, caller writes it (writeHeader) after all edits.
+    '''
+    path = lambda name: os.path.join(buildPath(storeDir, header), name)
+    nv, npart, nseg = header['vertexCount'], header['partCount'], header['segmentCount']
+    x0, y0, x1, y1, segPart = profiles.segments()
+    _appendArray(path('x.f8'), profiles.x, '<f8', nv)
+    _appendArray(path('y.f8'), profiles.y, '<f8', nv)
+    _appendArray(path('offsets.i8'), profiles.offsets[1:] + nv, '<i8', npart + 1)
+    _appendArray(path('oids.i8'), profiles.oids, '<i8', npart)
+    _appendArray(path('bbox.f8'), partsBBox(profiles), '<f8', 4 * npart)
+    for name, arr in zip(segmentFiles, (x0, y0, x1, y1)):
+        _appendArray(path(name), arr, '<f8', nseg)
+    _appendArray(path('segpart.i8'), segPart + npart, '<i8', nseg)
+
+    attrs = attrs or {}
+    for col in header['columns']:
+        items = attrs.get(col['name'])
+        if items is None or len(items) != profiles.partCount:
+            raise NameError("Attribute '%s' expected for %s parts" % (col['name'], profiles.partCount))
+        if col['kind'] == 'category':
+            values = _readValues(path(col['values']))
+            lookup = dict((v, i) for i, v in enumerate(values))
+            codes = []
+            for item in items:
+                item = u'%s' % item
+                if item not in lookup:
+                    lookup[item] = len(values)
+                    values.append(item)
+                codes.append(lookup[item])
+            _appendArray(path(col['file']), codes, '<i4', npart)
+            _writeValues(path(col['values']), values)
+        elif col['kind'] == 'int':
+            _appendArray(path(col['file']), items, '<i8', npart)
+        else:
+            _appendArray(path(col['file']), items, '<f8', npart)
+
+    header['vertexCount'] = int(nv + profiles.vertexCount)
+    header['partCount'] = int(npart + profiles.partCount)
+    header['segmentCount'] = int(nseg + len(x0))
+    return (nseg, nseg + len(x0))
+#def appendParts(storeDir, header, profiles, attrs=None):
+
+
+def readFeatureClass(fcPath, fields=()):
+    ''' Read seismoprofiles FeatureClass by arcpy.
+    Return (profiles, values, wkid); values: field => list,
+    field values repeated for each part of multipart feature.
+    '''
+    import arcpy
+    wkid = arcpy.Describe(fcPath).spatialReference.factoryCode
+    xs, ys, offsets, oids = [], [], [0], []
+    values = dict((fn, []) for fn in fields)
+    rows = arcpy.SearchCursor(fcPath)
+    for row in rows:
+        geom = row.shape
+        if geom is None:
+            continue
+        rowValues = [(fn, row.getValue(fn)) for fn in fields]
+        for part in geom:
+            for pnt in part:
+                if pnt is None:
+                    continue
+                xs.append(pnt.X)
+                ys.append(pnt.Y)
+            offsets.append(len(xs))
+            oids.append(row.getValue(seismoclip.oidFieldName))
+            for fn, val in rowValues:
+                values[fn].append(val)
+    del rows
+    return seismoclip.ProfileSet(xs, ys, offsets, oids), values, wkid
+#def readFeatureClass(fcPath, fields=()):
+
+
+def exportFeatureClass(fcPath, storeDir, fields=(), stamp=''):
+    ''' Read seismoprofiles FeatureClass by arcpy and write store.
+    fields: attribute fields to export, values repeated for each part of multipart feature.
+    '''
+    profiles, values, wkid = readFeatureClass(fcPath, fields)
+    exportStore(storeDir, profiles, values, wkid, stamp)
+    return profiles
+#def exportFeatureClass(fcPath, storeDir, fields=(), stamp=''):
+
+
+def missingFields(header, fields):
+    ''' Fields not exported into store (storeFields changed after export)
+    '''
+    names = set(col['name'] for col in header.get('columns', []))
+    return [fn for fn in fields if fn not in names]
+#def missingFields(header, fields):
+
+
+def _freshHeader(storeDir, stamp, fields, log=None):
+    ''' Store header if store has data stamp and all fields, None otherwise
+    '''
+    header = None
+    try:
+        header = readHeader(storeDir)
+    except Exception, e:
+        if log: log.warning("seismostore.loadStore, can't read store '%s': %s" % (storeDir, e))
+    if header is None or header.get('stamp') != stamp or missingFields(header, fields):
+        return None
+    return header
+
+
+def loadStore(storeDir, fcPath, stamp='', fields=(), log=None):
+    ''' Profiles from store if it is fresh (same data stamp, has all fields), otherwise
+    from FeatureClass by arcpy, with store export (under storeLock) for next processes.
+    Failure to write store is not an error.
+    '''
+    profiles = _storeCache.get(storeDir)
+    if profiles is not None and profiles.header.get('stamp') == stamp and not isStale(profiles) and (
+            not missingFields(profiles.header, fields)):
+        return profiles
+    if _freshHeader(storeDir, stamp, fields, log) is None:
+        if log: log.info("seismostore.loadStore, export '%s' into store '%s'" % (fcPath, storeDir))
+        try:
+            with storeLock(storeDir, log=log):
+                if _freshHeader(storeDir, stamp, fields) is None: # not exported by other process meanwhile
+                    exportFeatureClass(fcPath, storeDir, fields, stamp)
+        except Exception, e:
+            if log: log.warning("seismostore.loadStore, can't export store '%s': %s" % (storeDir, e))
+            return seismoclip.loadProfiles(fcPath)
+    profiles = openStore(storeDir)
+    _storeCache[storeDir] = profiles
+    return profiles
+#def loadStore(storeDir, fcPath, stamp='', fields=(), log=None):
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(verbose=True)
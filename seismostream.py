@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# (c) Valik mailto:vasnake@gmail.com
+
+'''
+Streaming clip for Seismodensity project
+
+Merged national archive doesn't fit in memory: loading it (seismoclip.loadProfiles,
+seismostore export) builds all vertices lists at once, spatial index and pyramid need all segments too.
+Here profiles read from source by chunks of about chunkVertices vertices (whole parts),
+each chunk clipped and summed, then dropped: peak memory is chunk size, not dataset size,
+one sequential pass over data, no index.
+
+Sources (openSource by path):
+    store folder (seismostore, header.json inside) - segments files read by ranges;
+    .ndjson / .geojsonl / .jsonl file - GeoJSON text sequence, feature per line
+        (LineString or MultiLineString geometry, or Esri JSON feature with "paths"),
+        coords in seismoprofiles SR, written by exportNdjson;
+    .compact.npz file - compact profiles (seismocompact), decoded by blocks;
+    other path - FeatureClass, arcpy SearchCursor.
+Sum over chunks: each chunk gives math.fsum and its rounding residual, final sum is fsum of those,
+so result doesn't depend on chunk size.
+
+Doctests
+>>> import tempfile, shutil, seismostore
+>>> tmp = tempfile.mkdtemp()
+>>> prof = seismoclip.ProfileSet.fromParts([[(x, 0), (x, 50), (x, 100)] for x in range(1, 100, 2)])
+>>> ring = [[10, 10], [10, 90], [90, 90], [90, 10], [10, 10]]
+>>> exportNdjson(os.path.join(tmp, 'prof.ndjson'), [prof])
+50
+>>> [streamLength(openSource(os.path.join(tmp, 'prof.ndjson'), chunkVertices=n), [ring]) for n in (1, 7, 1000)]
+[3200.0, 3200.0, 3200.0]
+>>> seismostore.exportStore(os.path.join(tmp, 'store'), prof)
+>>> streamLengths(openSource(os.path.join(tmp, 'store'), chunkVertices=10), [[ring], [ring[:3] + ring[:1]]])
+[3200.0, 1600.0]
+>>> [len(c[0]) for c in openSource(os.path.join(tmp, 'store'), chunkVertices=40)]
+[40, 40, 20]
+>>> list(partChunks(iter(['{"type": "LineString", "coordinates": [[0, 0], [3, 4]]}',
+...     '{"geometry": {"paths": [[[0, 0], [1, 0]], [[5, 5], [5, 6], [6, 6]]]}, "attributes": {"OBJECTID": 7}}']))
+...     )[0].oids.tolist()
+[1, 7, 7]
+>>> shutil.rmtree(tmp)
+'''
+
+import os
+import json
+import math
+import array
+import tempfile
+import numpy as np
+
+import seismoclip
+import seismocompact
+
+chunkVertices = 1000000 # vertices per chunk, about 100 MB of chunk arrays and clip buffers
+ndjsonExts = ('.ndjson', '.geojsonl', '.geojsons', '.jsonl')
+
+
+class _ChunkBuffer(object):
+    ''' Vertices and parts of chunk being read, compact arrays instead of float objects lists
+    '''
+
+    def __init__(self):
+        self.xs, self.ys = array.array('d'), array.array('d')
+        self.offsets, self.oids = [0], []
+
+    def addPart(self, points, oid):
+        for pnt in points:
+            self.xs.append(float(pnt[0]))
+            self.ys.append(float(pnt[1]))
+        self.offsets.append(len(self.xs))
+        self.oids.append(oid)
+
+    def profiles(self):
+        return seismoclip.ProfileSet(np.frombuffer(self.xs, dtype=np.float64) if len(self.xs) else [],
+            np.frombuffer(self.ys, dtype=np.float64) if len(self.ys) else [], self.offsets, self.oids)
+#class _ChunkBuffer(object):
+
+
+def _featureParts(feature):
+    ''' (oid, parts list) from GeoJSON Feature or geometry, or Esri JSON feature; oid None if unknown
+    '''
+    geom = feature.get('geometry', feature)
+    props = feature.get('properties') or feature.get('attributes') or {}
+    oid = props.get(seismoclip.oidFieldName, feature.get('id'))
+    if geom is None:
+        return (oid, [])
+    if 'paths' in geom:
+        return (oid, geom['paths'])
+    kind = geom.get('type')
+    if kind == 'LineString':
+        return (oid, [geom['coordinates']])
+    if kind == 'MultiLineString':
+        return (oid, geom['coordinates'])
+    raise NameError("Unsupported geometry '%s', profiles are lines" % kind)
+#def _featureParts(feature):
+
+
+def partChunks(lines, chunkVertices=chunkVertices):
+    ''' ProfileSet chunks from NDJSON lines iterator, feature without id gets its line number
+    '''
+    buf = _ChunkBuffer()
+    for lineNo, line in enumerate(lines, 1):
+        line = line.strip().lstrip('\x1e') # RFC 8142 record separator
+        if not line:
+            continue
+        oid, parts = _featureParts(json.loads(line))
+        if oid is None:
+            oid = lineNo
+        for part in parts:
+            buf.addPart(part, oid)
+        if len(buf.xs) >= chunkVertices:
+            yield buf.profiles()
+            buf = _ChunkBuffer()
+    if buf.oids:
+        yield buf.profiles()
+#def partChunks(lines, chunkVertices=chunkVertices):
+
+
+def ndjsonChunks(fileName, chunkVertices=chunkVertices):
+    ''' ProfileSet chunks from NDJSON file, read line by line
+    '''
+    fh = open(fileName)
+    try:
+        for chunk in partChunks(fh, chunkVertices):
+            yield chunk
+    finally:
+        fh.close()
+#def ndjsonChunks(fileName, chunkVertices=chunkVertices):
+
+
+def cursorChunks(fcPath, chunkVertices=chunkVertices, sr=None):
+    ''' ProfileSet chunks from FeatureClass by arcpy SearchCursor, parts of a feature in one chunk
+    '''
+    import arcpy
+    if sr is None:
+        rows = arcpy.SearchCursor(fcPath)
+    else:
+        rows = arcpy.SearchCursor(fcPath, '', sr)
+    try:
+        buf = _ChunkBuffer()
+        for row in rows:
+            geom = row.shape
+            if geom is None:
+                continue
+            oid = row.getValue(seismoclip.oidFieldName)
+            for part in geom:
+                buf.addPart([(pnt.X, pnt.Y) for pnt in part if pnt is not None], oid)
+            if len(buf.xs) >= chunkVertices:
+                yield buf.profiles()
+                buf = _ChunkBuffer()
+        if buf.oids:
+            yield buf.profiles()
+    finally:
+        del rows
+#def cursorChunks(fcPath, chunkVertices=chunkVertices, sr=None):
+
+
+def storeChunks(storeDir, chunkSegments=chunkVertices):
+    ''' (x0, y0, x1, y1) segments chunks from store files, read by ranges
+    (not memmap: mapped pages stay in process memory)
+    '''
+    import seismostore
+    header = seismostore.readHeader(storeDir)
+    if header is None:
+        raise NameError("Store '%s' not found" % storeDir)
+    nseg = header['segmentCount']
+    files = [open(os.path.join(seismostore.buildPath(storeDir, header), name), 'rb') for name in seismostore.segmentFiles]
+    try:
+        for start in range(0, nseg, chunkSegments):
+            count = min(chunkSegments, nseg - start)
+            yield tuple(np.fromfile(fh, dtype=np.dtype('<f8'), count=count) for fh in files)
+    finally:
+        for fh in files:
+            fh.close()
+#def storeChunks(storeDir, chunkSegments=chunkVertices):
+
+
+def segmentChunks(chunks):
+    ''' (x0, y0, x1, y1) segments chunks from ProfileSet chunks
+    '''
+    for profiles in chunks:
+        yield profiles.segments()[:4]
+#def segmentChunks(chunks):
+
+
+def openSource(source, chunkVertices=chunkVertices, sr=None):
+    ''' Segments chunks iterator for store folder, NDJSON file, compact profiles file or FeatureClass path
+    '''
+    if os.path.isdir(source) and os.path.exists(os.path.join(source, 'header.json')):
+        return storeChunks(source, chunkVertices)
+    if os.path.splitext(source)[1].lower() in ndjsonExts:
+        return segmentChunks(ndjsonChunks(source, chunkVertices))
+    if source.lower().endswith(seismocompact.compactFileExt):
+        return segmentChunks(seismocompact.loadCompact(source).chunks(blockVertices=chunkVertices))
+    return segmentChunks(cursorChunks(source, chunkVertices, sr))
+#def openSource(source, chunkVertices=chunkVertices, sr=None):
+
+
+def streamLengths(chunks, polygons):
+    ''' Profiles length inside each polygon (list of rings), meters, one pass over segments chunks
+    '''
+    edges = [seismoclip.ringsEdges(rings) for rings in polygons]
+    sums = [[] for rings in polygons]
+    for x0, y0, x1, y1 in chunks:
+        for polyEdges, polySums in zip(edges, sums):
+            lengths = seismoclip.segmentsInsideLength(x0, y0, x1, y1, polyEdges)
+            total = math.fsum(lengths)
+            polySums.append(total)
+            polySums.append(math.fsum(np.append(lengths, -total))) # rounding residual
+    return [math.fsum(s) for s in sums]
+#def streamLengths(chunks, polygons):
+
+
+def streamLength(chunks, rings):
+    ''' Profiles length inside polygon, meters, one pass over segments chunks
+    '''
+    return streamLengths(chunks, [rings])[0]
+#def streamLength(chunks, rings):
+
+
+def exportNdjson(fileName, chunks):
+    ''' Write ProfileSet chunks into NDJSON file, LineString feature per part with OBJECTID as id,
+    atomically: temp file in the same folder, unique per writer. Return parts count.
+    '''
+    count = 0
+    fd, tmpName = tempfile.mkstemp('.tmp', os.path.basename(fileName) + '.', os.path.dirname(fileName) or '.')
+    try:
+        fh = os.fdopen(fd, 'w')
+        try:
+            for profiles in chunks:
+                x, y, offsets, oids = profiles.x, profiles.y, profiles.offsets, profiles.oids
+                for i in range(profiles.partCount):
+                    a, b = int(offsets[i]), int(offsets[i + 1])
+                    coords = np.column_stack((x[a:b], y[a:b])).tolist()
+                    fh.write(json.dumps({'type': 'Feature', 'id': int(oids[i]), 'properties': {},
+                        'geometry': {'type': 'LineString', 'coordinates': coords}}))
+                    fh.write('\n')
+                count += profiles.partCount
+        finally:
+            fh.close()
+        os.chmod(tmpName, 0644) # mkstemp file is private, source is read by other accounts too
+        if os.path.exists(fileName):
+            os.remove(fileName)
+        os.rename(tmpName, fileName)
+    except Exception:
+        if os.path.exists(tmpName):
+            os.remove(tmpName)
+        raise
+    return count
+#def exportNdjson(fileName, chunks):
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(verbose=True)